@@ -4,30 +4,131 @@ import os
 # Aggiungi il path al livello superiore (dove si trova 'src')
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import folium
 import os 
-from src.spatial_module.visualization import visualize_no_rag, visualize_rag
+import gzip
+import time
+import uuid
+from src.spatial_module.visualization import visualize_no_rag, visualize_rag, map_payload, no_rag_map_payload, extract_place_entities, geocode_entities, encode_map_payload
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from src.spatial_module.spatial import spatialModule
+from src.spatial_module.route_cache import RouteStateCache
+from src.spatial_module.warmup import load_snapshot
+from src.spatial_module.geocoding import get_geocoder
+from src.spatial_module.metrics import IN_FLIGHT, CACHE_ENTRIES, CONTENT_TYPE, render_metrics
+from src.spatial_module.profiling import profiling_requested, profile_request
+from response_cache import ResponseCache
 
 app = Flask(__name__)
 CORS(app)  # Enable Cross-Origin Resource Sharing
 
+# Enriched routes, a change of constraints does not hit the external services again
+route_cache = RouteStateCache(max_size=64)
+
+# City warm-up snapshot (built with `python -m spatial_module.warmup` from src/): graph, POIs, landmark geocodes
+SNAPSHOT_DIR = os.environ.get("RAGTRIP_SNAPSHOT_DIR")
+if SNAPSHOT_DIR:
+    load_snapshot(SNAPSHOT_DIR)
+
+# Final responses; cached answers are only valid for the models and index that produced them
+MODEL_FINGERPRINT = "|".join([
+    os.environ.get("RAGTRIP_LLM_ID", "meta-llama/Llama-3.1-8B-Instruct"),
+    os.environ.get("RAGTRIP_ENCODER_ID", "Snowflake/snowflake-arctic-embed-l-v2.0"),
+    os.environ.get("RAGTRIP_INDEX_VERSION", "1"),
+])
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get("RAGTRIP_RESPONSE_CACHE_ENTRIES", 256)),
+    max_bytes=int(os.environ.get("RAGTRIP_RESPONSE_CACHE_MB", 64)) * 1024 * 1024,
+    ttl_seconds=float(os.environ.get("RAGTRIP_RESPONSE_CACHE_TTL_S", 3600)),
+    fingerprint=MODEL_FINGERPRINT,
+)
+
+# Cache sizes are read at scrape time
+CACHE_ENTRIES.set_function(lambda: len(route_cache), "routes")
+CACHE_ENTRIES.set_function(lambda: response_cache.stats()['entries'], "responses")
+CACHE_ENTRIES.set_function(lambda: len(get_geocoder()), "geocodes")
+
+def cached_response(body, etag, cache_status):
+    """
+    JSON response for a cached body, 304 if the client already holds this version.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)  # weak: the body may be re-encoded by compress_response
+    response.headers['X-Cache'] = cache_status
+    return response
+
+@app.after_request
+def compress_response(response):
+    """
+    Brotli (if available) or gzip encoding of the JSON responses, as accepted by the client.
+    """
+    accept_encoding = request.headers.get('Accept-Encoding', '').lower()
+    if (response.direct_passthrough or response.status_code != 200 or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers or (response.content_length or 0) < 500):
+        return response
+
+    data = response.get_data()
+    if brotli is not None and 'br' in accept_encoding:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accept_encoding:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Uncompressed-Length'] = str(len(data))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 @app.route('/api/query', methods=['POST'])
 def handle_query():
+    IN_FLIGHT.inc()
+    try:
+        # Opt-in sampling profile (RAGTRIP_PROFILING=request plus X-Profile: 1 or ?profile=1)
+        if profiling_requested(request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'):
+            request_id = request.headers.get('X-Request-ID', uuid.uuid4().hex)
+            with profile_request(request_id) as profile:
+                response = answer_query()
+            response.headers['X-Profile'] = os.path.basename(profile['path'])
+            return response
+        return answer_query()
+    finally:
+        IN_FLIGHT.dec()
+
+def answer_query():
     data = request.get_json()
     user_query = data.get('query')     
     rag_enabled = data.get('rag', True)
-    
-    result, route_gdf, pois_near_segments, start, end = spatialModule("Notre-dame, Paris", "Louvre museum, Paris", pois_list=['restaurant','museum'], time_constraint="", space_constraint="400 meters")
+    # 'html' for the folium map, 'geojson' for the compact map payload
+    map_format = data.get('map_format', 'html')
+
+    cache_key = response_cache.make_key(user_query, rag_enabled, map_format)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached_response(*cached, 'HIT')
+
+    result, route_gdf, pois_near_segments, start, end = spatialModule("Notre-dame, Paris", "Louvre museum, Paris", pois_list=['restaurant','museum'], time_constraint="", space_constraint="400 meters", route_cache=route_cache)
     # compute center of the route
     answer = ""
     map_html = "" 
+    map_data = None
+    render_start = time.perf_counter()
     
     if rag_enabled:
-    
-        map_rag, center = visualize_rag(route_gdf, pois_near_segments, result, start, end)
         
         if user_query.startswith('I would like to go'):
             answer = """Here's your walking route from the Notre-Dame to the Louvre museum in Paris:
@@ -162,7 +263,11 @@ def handle_query():
                         
                         You have arrived at the Louvre museum. Enjoy your visit!"""
             
-            map_html = map_rag._repr_html_()#.replace('width="100%"', 'width="100%" height="500"')
+            if map_format == 'geojson':
+                map_data = map_payload(route_gdf, pois_near_segments, result, start, end)
+            else:
+                map_rag, center = visualize_rag(route_gdf, pois_near_segments, result, start, end)
+                map_html = map_rag._repr_html_()#.replace('width="100%"', 'width="100%" height="500"')
         elif user_query.startswith('What can I find'):
             answer = "The Crypte Archéologique in Paris is located under the Notre Dame forecourt, now known as the Place of Pope John Paul II. It houses an Early Christian archaeological crypt."
     else:
@@ -174,8 +279,12 @@ def handle_query():
             route_gdf_ = route_gdf_.to_crs(epsg=4326)  # Convert to WGS84 for folium
             center = route_gdf_.geometry.unary_union.centroid
     
-            map_no_rag = visualize_no_rag(answer, "", center, start, end)
-            map_html = map_no_rag._repr_html_().replace('width="100%"', 'width="100%" height="300"')
+            if map_format == 'geojson':
+                entities = geocode_entities(extract_place_entities([answer])[0])
+                map_data = no_rag_map_payload(entities, center, start, end)
+            else:
+                map_no_rag = visualize_no_rag(answer, "", center, start, end)
+                map_html = map_no_rag._repr_html_().replace('width="100%"', 'width="100%" height="300"')
         elif user_query.startswith('What can I find'):
             answer = """The Crypte Archéologique (also known as the Crypte des Arènes de Lutèce) is an archaeological museum located in Paris, France. It is situated beneath the Place Marguerite de Navarre, near the Boulevard Saint-Michel.
  
@@ -194,12 +303,30 @@ def handle_query():
      
     # map_html = m._repr_html_()#.replace('width="100%"', 'width="100%" height="500"')
 
+    render_time = time.perf_counter() - render_start
+    map_bytes = len(encode_map_payload(map_data).encode('utf-8')) if map_data is not None else len(map_html.encode('utf-8'))
+    print(f"Map ({map_format}) rendered in {render_time:.3f} s, {map_bytes / 1024:.1f} KB")
+
     response = {
         'response': f'{answer}',
         'map_html': map_html
     }
+    if map_data is not None:
+        response['map_data'] = map_data
+
+    body = app.json.dumps(response).encode('utf-8')
+    etag = response_cache.put(cache_key, body)
+
+    response = cached_response(body, etag, 'MISS')
+    response.headers['Server-Timing'] = f'map;dur={render_time * 1000:.1f}'
+    return response
 
-    return jsonify(response)
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'responses': response_cache.stats(),
+        'routes': {'entries': len(route_cache), 'hits': route_cache.hits, 'misses': route_cache.misses},
+    })
 
 if __name__ == '__main__':
     app.run(port=8000)
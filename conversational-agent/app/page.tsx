@@ -9,6 +9,7 @@ import { Button } from "@/components/ui/button"
 import { Card, CardContent, CardFooter, CardHeader, CardTitle } from "@/components/ui/card"
 import { Input } from "@/components/ui/input"
 import { ScrollArea } from "@/components/ui/scroll-area"
+import { RouteMap, type MapPayload } from "@/components/route-map"
 
 interface Message {
   id: string
@@ -16,6 +17,7 @@ interface Message {
   sender: "user" | "agent"
   timestamp: Date
   mapHtml?: string
+  mapData?: MapPayload
 }
 
 export default function ConversationalAgent() {
@@ -75,7 +77,8 @@ export default function ConversationalAgent() {
         },
         body: JSON.stringify({ 
           query: inputValue,
-          rag: isRag  // Include the RAG toggle state in the request
+          rag: isRag,  // Include the RAG toggle state in the request
+          map_format: "geojson"  // Compact map payload instead of the folium HTML
         }),
       });
 
@@ -89,6 +92,7 @@ export default function ConversationalAgent() {
         id: Date.now().toString(),
         content: data.response,
         mapHtml: data.map_html,  // Store the map HTML
+        mapData: data.map_data,  // Or the compact GeoJSON payload
         sender: "agent",
         timestamp: new Date(),
       };
@@ -224,6 +228,11 @@ export default function ConversationalAgent() {
                         </div>
                       </div>
                       <span className="text-xs text-muted-foreground mt-1">{formatTime(message.timestamp)}</span>
+                      {message.mapData && (
+                        <div className="mt-2 w-full overflow-hidden rounded-lg border shadow">
+                          <RouteMap data={message.mapData} />
+                        </div>
+                      )}
                       {(message.mapHtml ?? '').trim() && (
                         <div
                           className="mt-2 w-full overflow-hidden rounded-lg border shadow"
@@ -0,0 +1,303 @@
+import sys
+import os
+
+# RAGTrip uses absolute imports from 'src' (ir_module, spatial_module)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import asyncio
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from spatial_module.visualization import map_payload
+from spatial_module.warmup import load_snapshot
+from spatial_module.geocoding import get_geocoder
+from spatial_module.metrics import IN_FLIGHT, CACHE_ENTRIES, CONTENT_TYPE, render_metrics
+from spatial_module.profiling import follow, profiling_requested, profile_request
+from ir_module.utils import GENERATION_DEADLINE
+
+# ----- CONFIGURATION -----
+DATA_PATH = os.environ.get("RAGTRIP_DATA_PATH", "./")
+CACHE_DIR = os.environ.get("RAGTRIP_CACHE_DIR", None)
+ENCODER_ID = os.environ.get("RAGTRIP_ENCODER_ID", "Snowflake/snowflake-arctic-embed-l-v2.0")
+LLM_ID = os.environ.get("RAGTRIP_LLM_ID", "meta-llama/Llama-3.1-8B-Instruct")  # same setting as ir_module.utils.LLM_ID (benchmark_llm.py)
+LLM_DEVICE = os.environ.get("RAGTRIP_LLM_DEVICE", "auto")  # 'cpu' for the CPU fleet
+LLM_QUANTIZATION = os.environ.get("RAGTRIP_LLM_QUANTIZATION") or None  # 'int8' or 'int4' weight-only (torchao)
+LLM_THREADS = int(os.environ.get("RAGTRIP_LLM_THREADS", 0)) or None  # default: one per allowed core
+LLM_CORES = [int(c) for c in os.environ.get("RAGTRIP_LLM_CORES", "").split(",") if c]  # CPU affinity of the process
+RETRIEVAL = os.environ.get("RAGTRIP_RETRIEVAL", "ivf")  # 'pq': compressed first stage + exact re-ranking, 'sharded'
+SHARD_WORKERS = [w for w in os.environ.get("RAGTRIP_SHARD_WORKERS", "").split(",") if w]  # host:port of serve_shards workers
+SHARD_AUTHKEY = os.environ.get("RAGTRIP_SHARD_AUTHKEY", "").encode() or None  # required with shard workers, no default
+CONTEXT_BUDGET = int(os.environ.get("RAGTRIP_CONTEXT_BUDGET", 0)) or None  # prompt tokens of packed passages (e.g. 512), 0 sends them in full
+CONTEXT_THRESHOLD = float(os.environ["RAGTRIP_CONTEXT_THRESHOLD"]) if os.environ.get("RAGTRIP_CONTEXT_THRESHOLD") else None
+NARRATION = os.environ.get("RAGTRIP_NARRATION", "llm")  # 'template': templated directions, LLM intro/outro only
+DEDUP_THRESHOLD = float(os.environ["RAGTRIP_DEDUP_THRESHOLD"]) if os.environ.get("RAGTRIP_DEDUP_THRESHOLD") else None  # e.g. 0.8
+SNAPSHOT_DIR = os.environ.get("RAGTRIP_SNAPSHOT_DIR")  # city warm-up snapshot, see spatial_module/warmup.py
+ROUTES_DIR = os.environ.get("RAGTRIP_ROUTES_DIR")  # optional per-request copy of the route summaries
+
+IO_WORKERS = int(os.environ.get("RAGTRIP_IO_WORKERS", 16))  # HTTP calls and geo processing
+MAX_PENDING = int(os.environ.get("RAGTRIP_MAX_PENDING", 32))  # admitted requests, queued or running
+REQUEST_TIMEOUT_S = float(os.environ.get("RAGTRIP_REQUEST_TIMEOUT_S", 120))
+SHUTDOWN_GRACE_S = float(os.environ.get("RAGTRIP_SHUTDOWN_GRACE_S", 30))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ServingState:
+    """
+    Executors and admission control of the ASGI server.
+
+    I/O-bound stages (geocoding, routing, Overpass, spatial join, map payload) run in a
+    thread pool; model stages (classification, retrieval, generation) are serialized on
+    a single worker, so only one request at a time uses the GPU/CPU model.
+    """
+
+    def __init__(self, io_workers=IO_WORKERS, max_pending=MAX_PENDING):
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="ragtrip-io")
+        self.model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ragtrip-model")
+        self.max_pending = max_pending
+        self.pending = 0
+        self.accepting = True
+        self.trip = None
+        self.snapshot = None
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def try_admit(self):
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        self.idle.clear()
+        return True
+
+    def release(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.idle.set()
+
+    async def _run(self, executor, deadline, fn, *args, **kwargs):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        cancelled = threading.Event()
+
+        def job():
+            # A stage reaching the worker after the request gave up is skipped, and the LLM
+            # generation of a running one stops at the deadline (query_llm)
+            if cancelled.is_set() or time.monotonic() >= deadline:
+                raise DeadlineExceeded()
+            token = GENERATION_DEADLINE.set(deadline)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                GENERATION_DEADLINE.reset(token)
+
+        future = asyncio.get_running_loop().run_in_executor(executor, follow(job))
+        try:
+            return await asyncio.wait_for(future, timeout=remaining)
+        except asyncio.TimeoutError:
+            cancelled.set()
+            raise DeadlineExceeded()
+
+    async def run_io(self, deadline, fn, *args, **kwargs):
+        return await self._run(self.io_executor, deadline, fn, *args, **kwargs)
+
+    async def run_model(self, deadline, fn, *args, **kwargs):
+        return await self._run(self.model_executor, deadline, fn, *args, **kwargs)
+
+    def shutdown(self):
+        self.io_executor.shutdown(wait=False, cancel_futures=True)
+        self.model_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def load_pipeline(model_executor=None):
+    """
+    Load the encoder, index, corpus and LLM and build the RAGTrip orchestrator. The route
+    POI prefetches are queued on `model_executor` with the other model stages.
+    """
+    from ir_module.utils import load_llm
+    from ir_module.RAG import RAG
+    from RAGTrip import RAGTrip
+
+    tokenizer, model = load_llm(LLM_ID, CACHE_DIR, device=LLM_DEVICE, quantization=LLM_QUANTIZATION,
+                                num_threads=LLM_THREADS, cpu_cores=LLM_CORES)
+    rag = RAG(DATA_PATH, CACHE_DIR, ENCODER_ID, tokenizer, model, retrieval=RETRIEVAL,
+              shard_workers=SHARD_WORKERS, shard_authkey=SHARD_AUTHKEY,
+              dedup_threshold=DEDUP_THRESHOLD, context_budget=CONTEXT_BUDGET, context_threshold=CONTEXT_THRESHOLD,
+              narration=NARRATION, prefetch_executor=model_executor)
+    return RAGTrip(rag, tokenizer, model, routes_dir=ROUTES_DIR)
+
+
+async def answer_query(state, query, mode, deadline, request_id=None, session_id=None):
+    """
+    RAGTrip.handle_query split in stages, each on its executor.
+    """
+    trip = state.trip
+    classification = await state.run_model(deadline, trip.classify_intent, query)
+
+    if "Spatial Request" in classification:
+        spatial_request = trip.parse_spatial_request(classification)
+        if spatial_request is None:
+            return {"response": "Intent could not be classified or required file missing."}
+
+        route = await state.run_io(deadline, trip.plan_route, spatial_request, request_id=request_id)
+        if not route:
+            return {"response": "No valid route found or required file missing."}
+
+        result, route_gdf, pois_near_segments, start, end = route
+        map_data = await state.run_io(deadline, map_payload, route_gdf, pois_near_segments, result, start, end)
+        answer = await state.run_model(deadline, trip.rag.handle_spatial_request, query, result)
+        trip.rag.prefetch(session_id, result)  # queued on the model worker, the POI passages of the next question
+        return {"response": answer, "map_data": map_data}
+
+    if "Information Request" in classification:
+        answer = await state.run_model(deadline, trip.rag.handle_information_request, query, mode=mode,
+                                       session_id=session_id)
+        return {"response": answer}
+
+    return {"response": "Intent could not be classified or required file missing."}
+
+
+async def handle_query(request):
+    state = request.app.state.serving
+
+    if not state.accepting or state.trip is None:
+        return JSONResponse({"error": "Service unavailable"}, status_code=503, headers={"Retry-After": "5"})
+    if not state.try_admit():
+        return JSONResponse({"error": "Too many requests"}, status_code=429, headers={"Retry-After": "2"})
+
+    request_id = request.headers.get("X-Request-ID", uuid.uuid4().hex)
+    started = time.monotonic()
+    IN_FLIGHT.inc()
+    try:
+        try:
+            data = await request.json()
+            query = data.get("query")
+            mode = "RAG" if data.get("rag", True) else "NO_RAG"
+            timeout = data.get("timeout_s", REQUEST_TIMEOUT_S)
+            timeout = float(timeout) if not isinstance(timeout, bool) else float("nan")
+        except (ValueError, TypeError, AttributeError):
+            return JSONResponse({"error": "Expected a JSON body {\"query\": string, \"timeout_s\": number}"},
+                                status_code=400, headers={"X-Request-ID": request_id})
+        if not timeout > 0:
+            return JSONResponse({"error": "timeout_s must be a positive number of seconds"}, status_code=400,
+                                headers={"X-Request-ID": request_id})
+        timeout = min(timeout, REQUEST_TIMEOUT_S)
+        if not isinstance(query, str) or not query.strip():
+            return JSONResponse({"error": "Missing query"}, status_code=400, headers={"X-Request-ID": request_id})
+
+        session_id = request.headers.get("X-Session-ID") or data.get("session_id")
+        headers = {"X-Request-ID": request_id}
+        # Opt-in sampling profile of the stages (RAGTRIP_PROFILING=request plus X-Profile: 1 or ?profile=1)
+        if profiling_requested(request.headers.get("X-Profile") == "1" or request.query_params.get("profile") == "1"):
+            with profile_request(request_id, detached=True) as profile:
+                response = await answer_query(state, query, mode, deadline=started + timeout,
+                                              request_id=request_id, session_id=session_id)
+            headers["X-Profile"] = os.path.basename(profile["path"])
+        else:
+            response = await answer_query(state, query, mode, deadline=started + timeout, request_id=request_id,
+                                          session_id=session_id)
+        response.setdefault("map_html", "")
+        return JSONResponse(response, headers=headers)
+    except DeadlineExceeded:
+        return JSONResponse({"error": "Deadline exceeded"}, status_code=504, headers={"X-Request-ID": request_id})
+    finally:
+        IN_FLIGHT.dec()
+        state.release()
+        print(f"[{request_id}] /api/query served in {time.monotonic() - started:.2f} s ({state.pending} pending)")
+
+
+async def passages(request):
+    """
+    POST {"passages": [{"id", "text"}]} adds new and changed passages to the live index,
+    DELETE {"ids": [...]} tombstones passages. Both run on the model worker (encoder, index).
+    """
+    state = request.app.state.serving
+    if state.trip is None or state.trip.rag.live_index is None:
+        return JSONResponse({"error": "No live index (resources/ingest.py migrate)"}, status_code=409)
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
+    if request.method == "DELETE":
+        ids = data.get("ids") if isinstance(data, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(doc_id, str) for doc_id in ids):
+            return JSONResponse({"error": "Expected {\"ids\": [string, ...]}"}, status_code=400)
+    else:
+        items = data.get("passages") if isinstance(data, dict) else None
+        if not isinstance(items, list) or not all(
+                isinstance(p, dict) and isinstance(p.get("id"), str) and isinstance(p.get("text"), str) for p in items):
+            return JSONResponse({"error": "Expected {\"passages\": [{\"id\": string, \"text\": string}, ...]}"},
+                                status_code=400)
+    deadline = time.monotonic() + REQUEST_TIMEOUT_S
+    try:
+        if request.method == "DELETE":
+            removed = await state.run_model(deadline, state.trip.rag.remove, ids)
+            return JSONResponse({"removed": removed})
+        added, replaced = await state.run_model(deadline, state.trip.rag.ingest,
+                                                [p["id"] for p in items], [p["text"] for p in items])
+        return JSONResponse({"added": added, "replaced": replaced, "unchanged": len(items) - added - replaced})
+    except DeadlineExceeded:
+        return JSONResponse({"error": "Deadline exceeded"}, status_code=504)
+
+
+async def health(request):
+    state = request.app.state.serving
+    return JSONResponse({"ready": state.trip is not None and state.accepting, "pending": state.pending,
+                         "max_pending": state.max_pending,
+                         "warmup": state.snapshot.coverage() if state.snapshot is not None else None})
+
+
+async def metrics(request):
+    return Response(render_metrics(), headers={"Content-Type": CONTENT_TYPE})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    state = ServingState()
+    app.state.serving = state
+    CACHE_ENTRIES.set_function(lambda: len(get_geocoder()), "geocodes")
+    loop = asyncio.get_running_loop()
+    # The snapshot loads on the I/O pool while the models load on the model worker, the thread that will use them
+    snapshot = loop.run_in_executor(state.io_executor, load_snapshot, SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+    state.trip = await loop.run_in_executor(state.model_executor, load_pipeline, state.model_executor)
+    if snapshot is not None:
+        state.snapshot = await snapshot
+    if state.trip.rag.prefetcher is not None:
+        CACHE_ENTRIES.set_function(lambda: len(state.trip.rag.prefetcher.cache), "prefetch_sessions")
+    yield
+    # Graceful shutdown: refuse new requests, let the admitted ones finish
+    state.accepting = False
+    try:
+        await asyncio.wait_for(state.idle.wait(), timeout=SHUTDOWN_GRACE_S)
+    except asyncio.TimeoutError:
+        print(f"Shutdown grace period expired with {state.pending} requests pending")
+    state.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/query", handle_query, methods=["POST"]),
+        Route("/api/passages", passages, methods=["POST", "DELETE"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+        Middleware(GZipMiddleware, minimum_size=500),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=8000, timeout_graceful_shutdown=int(SHUTDOWN_GRACE_S))
@@ -0,0 +1,105 @@
+"use client"
+
+import { useEffect, useRef } from "react"
+
+// Same Leaflet build folium embeds in the HTML maps, loaded once from the CDN
+const LEAFLET_JS = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"
+const LEAFLET_CSS = "https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"
+
+export interface MapPayload {
+  type: "FeatureCollection"
+  center: [number, number]
+  features: {
+    type: "Feature"
+    geometry: { type: string; coordinates: unknown }
+    properties: {
+      kind: "route" | "buffer" | "poi" | "start" | "end" | "entity"
+      name?: string
+      icon_key?: string | null
+      icon?: string
+      color?: string
+      number?: number
+    }
+  }[]
+}
+
+// folium marker color names mapped to CSS colors
+const MARKER_COLORS: { [name: string]: string } = {
+  red: "#d63e2a", blue: "#38aadd", green: "#72b026", purple: "#d252b9", orange: "#f69730",
+  darkred: "#a23336", lightred: "#ff8e7f", beige: "#ffcb92", darkblue: "#0067a3", darkgreen: "#728224",
+  cadetblue: "#436978", darkpurple: "#5b396b", white: "#fbfbfb", pink: "#ff91ea", lightblue: "#8adaff",
+  lightgreen: "#bbf970", gray: "#575757", black: "#303030", lightgray: "#a3a3a3",
+}
+
+let leafletLoader: Promise<any> | null = null
+
+function loadLeaflet(): Promise<any> {
+  const w = window as any
+  if (w.L) return Promise.resolve(w.L)
+  if (!leafletLoader) {
+    leafletLoader = new Promise((resolve, reject) => {
+      const css = document.createElement("link")
+      css.rel = "stylesheet"
+      css.href = LEAFLET_CSS
+      document.head.appendChild(css)
+
+      const script = document.createElement("script")
+      script.src = LEAFLET_JS
+      script.onload = () => resolve(w.L)
+      script.onerror = reject
+      document.head.appendChild(script)
+    })
+  }
+  return leafletLoader
+}
+
+export function RouteMap({ data, height = 400 }: { data: MapPayload; height?: number }) {
+  const containerRef = useRef<HTMLDivElement>(null)
+
+  useEffect(() => {
+    let map: any = null
+    let cancelled = false
+
+    loadLeaflet().then((L) => {
+      if (cancelled || !containerRef.current) return
+
+      map = L.map(containerRef.current).setView(data.center, 14)
+      L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
+        attribution: "&copy; OpenStreetMap contributors",
+      }).addTo(map)
+
+      L.geoJSON(data, {
+        style: (feature: any) =>
+          feature.properties.kind === "buffer"
+            ? { color: "yellowgreen", weight: 1, opacity: 0.1 }
+            : { color: "green", weight: 3, opacity: 1 },
+        pointToLayer: (feature: any, latlng: any) => {
+          const { kind, color, number } = feature.properties
+          const fill =
+            kind === "start" ? "green" : kind === "end" ? "red" : kind === "entity" ? "crimson" : color ?? "gray"
+          const marker = L.circleMarker(latlng, {
+            radius: kind === "poi" ? 7 : 9,
+            color: "#ffffff",
+            weight: 2,
+            fillColor: MARKER_COLORS[fill] ?? fill,
+            fillOpacity: 0.9,
+          })
+          if (number !== undefined) {
+            marker.bindTooltip(String(number), { permanent: true, direction: "center" })
+          }
+          return marker
+        },
+        onEachFeature: (feature: any, layer: any) => {
+          if (feature.properties.name) layer.bindPopup(feature.properties.name)
+        },
+      }).addTo(map)
+    })
+
+    return () => {
+      cancelled = true
+      if (map) map.remove()
+    }
+  }, [data])
+
+  return <div ref={containerRef} style={{ height, width: "100%" }} />
+}
@@ -0,0 +1,87 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache with TTL for the serialized /api/query responses.
+
+    Entries are the final JSON body (answer and map) with its ETag, keyed by
+    (normalized query, rag flag, map format, model/version fingerprint), so a
+    repeated request is answered without running the pipeline again.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, ttl_seconds=3600, fingerprint=""):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.fingerprint = fingerprint
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize_query(query):
+        return " ".join((query or "").lower().split())
+
+    def make_key(self, query, rag_enabled, map_format="html"):
+        return (self.normalize_query(query), bool(rag_enabled), map_format, self.fingerprint)
+
+    @staticmethod
+    def make_etag(body):
+        return hashlib.sha1(body).hexdigest()
+
+    def get(self, key):
+        """
+        (body, etag) of a fresh entry, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body):
+        """
+        Store a response body, returns its ETag. Bodies larger than the whole cache are not stored.
+        """
+        etag = self.make_etag(body)
+        if len(body) > self.max_bytes:
+            return etag
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, etag, time.monotonic() + self.ttl_seconds)
+            self.bytes += len(body)
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return etag
+
+    def _remove(self, key):
+        body, _, _ = self._entries.pop(key)
+        self.bytes -= len(body)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,182 @@
+"""
+Load-test driver for /api/query.
+
+Sends the synthetic queries at a fixed concurrency (closed loop: every worker sends
+its next query when the previous one returns) and reports throughput, client-side
+latency percentiles and errors per intent. If the server exposes /metrics, the
+difference between a scrape before and after the run gives the per-stage latencies
+(geocode, routing, POI fetch, sjoin, ...) and per-stage errors of this run only.
+
+Run it against conversational-agent/asgi.py, which has no response or route cache: the
+numbers then describe the pipeline. Against app.py, repeated queries are answered from
+its caches after the first one, and the report says so.
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from queries import generate_queries
+
+SAMPLE = re.compile(r'^(\w+)\{(\w+)="([^"]*)"(?:,le="([^"]+)")?\} (\S+)$')
+
+
+def scrape(base_url):
+    """
+    {(metric, label value, le): value} from the Prometheus text of /metrics, None if unavailable.
+    """
+    try:
+        text = requests.get(f"{base_url}/metrics", timeout=10).text
+    except requests.RequestException:
+        return None
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            name, _, value, le, sample = match.groups()
+            samples[(name, value, le)] = float(sample)
+    return samples
+
+def histogram_quantile(q, bounds, cumulative):
+    """
+    Prometheus-style quantile estimate from cumulative bucket counts (linear within a bucket).
+    """
+    total = cumulative[-1]
+    if total == 0:
+        return float('nan')
+    rank = q * total
+    i = int(np.searchsorted(cumulative, rank))
+    if i >= len(bounds) - 1:
+        return bounds[-2]  # falls in +Inf, report the highest finite bound
+    lower = bounds[i - 1] if i > 0 else 0.0
+    below = cumulative[i - 1] if i > 0 else 0.0
+    in_bucket = cumulative[i] - below
+    return lower + (bounds[i] - lower) * ((rank - below) / in_bucket if in_bucket else 0)
+
+def stage_report(before, after):
+    rows = {}
+    for metric in ("ragtrip_stage_seconds", "ragtrip_llm_seconds"):
+        stages = {value for name, value, le in after if name == f"{metric}_count"}
+        for stage in sorted(stages):
+            count = after.get((f"{metric}_count", stage, None), 0) - before.get((f"{metric}_count", stage, None), 0)
+            if count == 0:
+                continue
+            total = after.get((f"{metric}_sum", stage, None), 0) - before.get((f"{metric}_sum", stage, None), 0)
+            buckets = sorted(((float(le), after[key] - before.get(key, 0))
+                              for key in after if key[0] == f"{metric}_bucket" and key[1] == stage
+                              for le in [key[2]]), key=lambda b: b[0])
+            bounds, cumulative = [b[0] for b in buckets], [b[1] for b in buckets]
+            label = stage if metric == "ragtrip_stage_seconds" else f"llm:{stage}"
+            rows[label] = {
+                "count": int(count),
+                "errors": int(after.get(("ragtrip_stage_errors_total", stage, None), 0)
+                              - before.get(("ragtrip_stage_errors_total", stage, None), 0)),
+                "mean_ms": 1000 * total / count,
+                "p50_ms": 1000 * histogram_quantile(0.5, bounds, cumulative),
+                "p95_ms": 1000 * histogram_quantile(0.95, bounds, cumulative),
+            }
+    return rows
+
+def send(session, base_url, query, timeout):
+    started = time.perf_counter()
+    try:
+        response = session.post(f"{base_url}/api/query", timeout=timeout,
+                                json={"query": query["query"], "rag": query["rag"], "map_format": "geojson"})
+        error = None if response.status_code == 200 else f"http_{response.status_code}"
+        cache = response.headers.get("X-Cache")
+    except requests.Timeout:
+        error, cache = "timeout", None
+    except requests.RequestException:
+        error, cache = "connection", None
+    return {"intent": query["intent"], "latency_s": time.perf_counter() - started, "error": error, "cache": cache}
+
+def run(base_url, queries, concurrency, timeout=300):
+    sessions = [requests.Session() for _ in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda iq: send(sessions[iq[0] % concurrency], base_url, iq[1], timeout),
+                                    enumerate(queries)))
+    return results, time.perf_counter() - started
+
+def summarize(results, elapsed):
+    def latency_stats(rows):
+        latencies = np.array([r["latency_s"] for r in rows if r["error"] is None]) * 1000
+        stats = {"requests": len(rows), "errors": sum(r["error"] is not None for r in rows)}
+        if len(latencies):
+            stats.update({f"p{q}_ms": float(np.percentile(latencies, q)) for q in (50, 90, 95, 99)})
+            stats["max_ms"] = float(latencies.max())
+        return stats
+
+    by_intent = defaultdict(list)
+    for r in results:
+        by_intent[r["intent"]].append(r)
+
+    error_kinds = defaultdict(int)
+    for r in results:
+        if r["error"]:
+            error_kinds[r["error"]] += 1
+
+    return {
+        "elapsed_s": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+        "overall": latency_stats(results),
+        "by_intent": {intent: latency_stats(rows) for intent, rows in sorted(by_intent.items())},
+        "errors": dict(error_kinds),
+        "cache_hits": sum(r["cache"] == "HIT" for r in results),
+    }
+
+def print_report(summary, stages):
+    print(f"\n{summary['overall']['requests']} requests in {summary['elapsed_s']:.1f} s, "
+          f"{summary['throughput_rps']:.2f} req/s, {summary['cache_hits']} response-cache hits")
+    print(f"{'':14}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in [("overall", summary["overall"])] + list(summary["by_intent"].items()):
+        print(f"{name:14}{stats['requests']:>9}{stats['errors']:>8}"
+              + "".join(f"{stats.get(k, float('nan')):>10.0f}" for k in ("p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms")))
+    if summary["errors"]:
+        print("errors:", ", ".join(f"{kind}={n}" for kind, n in summary["errors"].items()))
+    if summary["cache_hits"]:
+        print(f"warning: {summary['cache_hits']} answers came from the server's response cache, the latencies "
+              "describe the cache rather than the pipeline (run against conversational-agent/asgi.py)")
+
+    if stages:
+        print(f"\n{'stage':18}{'calls':>8}{'errors':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for stage, row in stages.items():
+            print(f"{stage:18}{row['count']:>8}{row['errors']:>8}{row['mean_ms']:>10.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}")
+    elif stages is None:
+        print("\n(no /metrics on the server, per-stage report skipped)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test /api/query at a target concurrency")
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8000")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--n', type=int, default=200, help="Number of queries")
+    parser.add_argument('--spatial_ratio', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries', type=str, default=None, help="JSON lines from queries.py instead of generating")
+    parser.add_argument('--timeout', type=float, default=300, help="Client timeout per request in seconds")
+    parser.add_argument('--output', type=str, default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [json.loads(line) for line in f if line.strip()]
+    else:
+        queries = generate_queries(args.n, args.spatial_ratio, args.seed)
+
+    before = scrape(args.url)
+    results, elapsed = run(args.url, queries, args.concurrency, args.timeout)
+    after = scrape(args.url)
+
+    summary = summarize(results, elapsed)
+    stages = stage_report(before, after) if before is not None and after is not None else None
+    print_report(summary, stages)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"summary": summary, "stages": stages, "concurrency": args.concurrency}, f, indent=4)
+    sys.exit(1 if summary["overall"]["errors"] == len(results) else 0)
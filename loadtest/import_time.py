@@ -0,0 +1,90 @@
+"""
+Import-time guard for the cold start of the workers and CLI tools.
+
+Imports every entry point in a fresh `python -X importtime` process (src/ on the path)
+and reports its import time with the breakdown per top-level package. The heavy
+dependencies must only load on first use of the feature that needs them: the run fails
+(exit code 1) if an entry point imports one of its LAZY packages, fails to import, or
+exceeds --budget_s, so it can guard against regressions in CI.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+MARKER = "-- entry point --"
+
+MODELS = ('torch', 'transformers', 'faiss')
+SPATIAL = ('spacy', 'folium', 'osmnx', 'geopy', 'routingpy')
+
+# entry point -> packages it must not import
+ENTRY_POINTS = {
+    'spatial_module.spatial': MODELS + SPATIAL,
+    'spatial_module.visualization': MODELS + SPATIAL,
+    'spatial_module.warmup': MODELS + SPATIAL,
+    'ir_module.utils': MODELS + SPATIAL,
+    'ir_module.RAG': ('torch', 'transformers') + SPATIAL,  # faiss: the index is what RAG is for
+    'RAGTrip': MODELS + SPATIAL,
+}
+
+
+def import_time(module):
+    """
+    (seconds, {top-level package: self seconds}, error) of importing `module` in a fresh interpreter.
+    """
+    code = f"import sys; sys.stderr.write({MARKER!r} + '\\n'); sys.stderr.flush(); import {module}"
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SRC_DIR,
+                             capture_output=True, text=True)
+    lines = process.stderr.splitlines()
+    lines = lines[lines.index(MARKER) + 1:] if MARKER in lines else []
+    total, packages = 0.0, defaultdict(float)
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_us) / 1e6
+        if not name[1:].startswith(' '):  # top level: not imported by another module of this run
+            total += int(cumulative_us) / 1e6
+    error = None
+    if process.returncode != 0:
+        error = next((line for line in reversed(process.stderr.splitlines()) if line.strip()), "import failed")
+    return total, dict(packages), error
+
+def check(entry_points, budget_s=None, top=5):
+    """Report of every entry point, and whether all of them pass."""
+    reports, passed = [], True
+    for module, lazy in entry_points.items():
+        total, packages, error = import_time(module)
+        loaded = sorted(package for package in lazy if package in packages)
+        ok = error is None and not loaded and (budget_s is None or total <= budget_s)
+        passed &= ok
+        heaviest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+        reports.append({'entry_point': module, 'seconds': round(total, 3), 'ok': ok, 'eagerly_loaded': loaded,
+                        'error': error, 'heaviest': {name: round(seconds, 3) for name, seconds in heaviest}})
+    return reports, passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import time of the entry points, failing on eager heavy imports")
+    parser.add_argument('--entry_points', type=str, nargs='*', default=None, help=f"Default: {' '.join(ENTRY_POINTS)}")
+    parser.add_argument('--budget_s', type=float, default=None, help="Fail above this import time per entry point")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    entry_points = {module: ENTRY_POINTS.get(module, MODELS + SPATIAL) for module in args.entry_points or ENTRY_POINTS}
+    reports, passed = check(entry_points, args.budget_s)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            status = "ok" if report['ok'] else "FAIL"
+            heaviest = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in report['heaviest'].items())
+            print(f"{status:4} {report['entry_point']:30} {report['seconds']:7.3f}s  {heaviest}")
+            if report['eagerly_loaded']:
+                print(f"     eagerly imports {', '.join(report['eagerly_loaded'])}")
+            if report['error']:
+                print(f"     {report['error']}")
+    sys.exit(0 if passed else 1)
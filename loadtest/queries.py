@@ -0,0 +1,68 @@
+"""
+Synthetic user queries for the load tests, spatial and information intents mixed.
+Same seed, same queries.
+"""
+import argparse
+import json
+import random
+
+LANDMARKS = [
+    "Notre-Dame", "Louvre museum", "Eiffel Tower", "Arc de Triomphe", "Sacré-Cœur", "Panthéon",
+    "Musée d'Orsay", "Centre Pompidou", "Place de la Concorde", "Opéra Garnier", "Sainte-Chapelle",
+    "Jardin du Luxembourg", "Place des Vosges", "Hôtel de Ville", "Les Invalides", "Pont Neuf",
+]
+
+POI_PHRASES = {
+    "cafe": "drink a coffee", "restaurant": "have lunch", "bakery": "buy a croissant",
+    "museum": "visit a museum", "park": "rest in a park", "bench": "sit on a bench",
+    "ice_cream": "get an ice cream", "books": "look for books", "toilets": "find toilets",
+    "drinking_water": "refill my bottle", "church": "see a church", "bar": "have a drink",
+}
+
+SPATIAL_TEMPLATES = [
+    "I would like to go from {a} to {b}.",
+    "I would like to go from {a} to {b} and {poi} on the way.",
+    "I would like to go from {a} to {b}, and {poi} about {minutes} minutes before arriving.",
+    "Walk me from {a} to {b}, I want to {poi} within {meters} meters of {b}.",
+    "How do I get from {a} to {b} on foot? I'd like to {poi} and {poi2}.",
+]
+
+INFORMATION_TEMPLATES = [
+    "What can I find at {a}?",
+    "Tell me about the history of {a}.",
+    "When was {a} built?",
+    "What are the opening hours of {a}?",
+    "Is {a} worth a visit with children?",
+]
+
+
+def generate_queries(n, spatial_ratio=0.6, seed=0):
+    """
+    Returns n dicts {"intent": "spatial" | "information", "query": str, "rag": bool}.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        a, b = rng.sample(LANDMARKS, 2)
+        poi, poi2 = rng.sample(list(POI_PHRASES.values()), 2)
+
+        if rng.random() < spatial_ratio:
+            intent, template = "spatial", rng.choice(SPATIAL_TEMPLATES)
+        else:
+            intent, template = "information", rng.choice(INFORMATION_TEMPLATES)
+
+        query = template.format(a=a, b=b, poi=poi, poi2=poi2, minutes=rng.choice([5, 10, 15]),
+                                meters=rng.choice([100, 200, 400]))
+        queries.append({"intent": intent, "query": query, "rag": rng.random() < 0.8})
+    return queries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic RAGTrip queries")
+    parser.add_argument('--n', type=int, default=100)
+    parser.add_argument('--spatial_ratio', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for query in generate_queries(args.n, args.spatial_ratio, args.seed):
+        print(json.dumps(query, ensure_ascii=False))
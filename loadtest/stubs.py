@@ -0,0 +1,206 @@
+"""
+Local stand-ins for GraphHopper, Nominatim and Overpass.
+
+Every service answers after a configurable latency (mean +- jitter) with a synthetic
+but well-formed response, deterministic for a given request, or with a recorded
+fixture (--fixtures DIR containing graphhopper.json, nominatim.json, overpass.json).
+Point the servers at them with:
+
+    RAGTRIP_GRAPHHOPPER_URL=http://127.0.0.1:8091
+    RAGTRIP_NOMINATIM_URL=http://127.0.0.1:8092  RAGTRIP_NOMINATIM_MIN_DELAY_S=0
+    RAGTRIP_OVERPASS_URL=http://127.0.0.1:8093/api
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import polyline
+
+# Synthetic places are spread over central Paris
+PARIS_BBOX = (2.28, 48.83, 2.40, 48.89)
+WALKING_SPEED_M_S = 1.39
+
+
+def _seeded(text):
+    return random.Random(int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:12], 16))
+
+def _haversine(lat1, lon1, lat2, lon2):
+    dlat, dlon = math.radians(lat2 - lat1), math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+
+def graphhopper_response(points, max_paths=1, vertices_per_instruction=4):
+    """
+    Straight-ish walking paths between the first and last point, one per alternative.
+    points: [(lat, lon), ...]
+    """
+    (lat1, lon1), (lat2, lon2) = points[0], points[-1]
+    rng = _seeded(f"{lat1:.5f},{lon1:.5f},{lat2:.5f},{lon2:.5f}")
+    n_vertices = max(8, int(_haversine(lat1, lon1, lat2, lon2) / 40))
+
+    paths = []
+    for p in range(max_paths):
+        bend = (p - (max_paths - 1) / 2) * 0.002
+        coords = []
+        for i in range(n_vertices):
+            t = i / (n_vertices - 1)
+            offset = math.sin(math.pi * t) * bend + (rng.uniform(-2e-5, 2e-5) if 0 < i < n_vertices - 1 else 0)
+            coords.append((lat1 + (lat2 - lat1) * t + offset, lon1 + (lon2 - lon1) * t - offset))
+
+        distance = sum(_haversine(*a, *b) for a, b in zip(coords[:-1], coords[1:]))
+        instructions = []
+        for start in range(0, n_vertices - 1, vertices_per_instruction):
+            end = min(start + vertices_per_instruction, n_vertices - 1)
+            length = sum(_haversine(*a, *b) for a, b in zip(coords[start:end], coords[start + 1:end + 1]))
+            instructions.append({"text": rng.choice(["Continue", "Turn left", "Turn right", "Keep right"]) + f" onto Rue {start}",
+                                 "distance": round(length, 1), "time": int(length / WALKING_SPEED_M_S * 1000),
+                                 "interval": [start, end], "sign": 0})
+        instructions.append({"text": "Arrive at destination", "distance": 0, "time": 0,
+                             "interval": [n_vertices - 1, n_vertices - 1], "sign": 4})
+
+        paths.append({"distance": round(distance, 1), "time": int(distance / WALKING_SPEED_M_S * 1000),
+                      "points": polyline.encode(coords, precision=5), "points_encoded": True,
+                      "instructions": instructions})
+    return {"paths": paths, "info": {"copyrights": ["stub"]}}
+
+def nominatim_response(query):
+    if not query.strip():
+        return []
+    rng = _seeded(query.lower())
+    minx, miny, maxx, maxy = PARIS_BBOX
+    lat, lon = rng.uniform(miny, maxy), rng.uniform(minx, maxx)
+    return [{"place_id": rng.randrange(10 ** 8), "osm_type": "node", "osm_id": rng.randrange(10 ** 10),
+             "lat": f"{lat:.7f}", "lon": f"{lon:.7f}", "display_name": f"{query}, Paris, France",
+             "class": "tourism", "type": "attraction", "importance": 0.5,
+             "boundingbox": [f"{lat - 1e-3:.7f}", f"{lat + 1e-3:.7f}", f"{lon - 1e-3:.7f}", f"{lon + 1e-3:.7f}"]}]
+
+def overpass_response(query, density=40):
+    """
+    Tagged nodes inside the query polygon, `density` per requested tag value and 0.01 square degrees.
+    """
+    elements = []
+    polygon = re.search(r'poly:"([^"]+)"', query)
+    if polygon:
+        values = [float(v) for v in polygon.group(1).split()]
+        lats, lons = values[0::2], values[1::2]
+    else:
+        lats, lons = PARIS_BBOX[1::2], PARIS_BBOX[0::2]
+    miny, maxy, minx, maxx = min(lats), max(lats), min(lons), max(lons)
+
+    tags = dict.fromkeys(re.findall(r'\["([^"]+)"(?:[=~]"([^"]+)")?\]', query))
+    rng = _seeded(query)
+    n = max(1, int(density * (maxx - minx) * (maxy - miny) / 1e-4))
+    for key, value in tags:
+        for poi_value in (value.split('|') if value else ["yes"]):
+            for _ in range(n):
+                node_id = rng.randrange(10 ** 10)
+                elements.append({"type": "node", "id": node_id,
+                                 "lat": rng.uniform(miny, maxy), "lon": rng.uniform(minx, maxx),
+                                 "tags": {key: poi_value, "name": f"{poi_value.replace('_', ' ').title()} {node_id % 1000}"}})
+    return {"version": 0.6, "generator": "stub", "elements": elements}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    service = None
+    latency_s = 0.0
+    jitter_s = 0.0
+    fixture = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload, content_type="application/json"):
+        delay = max(0.0, random.gauss(self.latency_s, self.jitter_s)) if self.jitter_s else self.latency_s
+        time.sleep(delay)
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode('utf-8') if length else ""
+
+    def _handle(self, body):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+
+        if self.service == "overpass" and url.path.endswith("/status"):
+            return self._reply(b"Connected as: 0\nCurrent time: 2025-01-01T00:00:00Z\nAnnounced endpoint: none\n"
+                               b"Rate limit: 0\n4 slots available now.\n", "text/plain")
+        if self.fixture is not None:
+            return self._reply(self.fixture)
+
+        if self.service == "graphhopper":
+            if body:
+                request = json.loads(body)
+                points = [(lat, lon) for lon, lat in request["points"]]
+                max_paths = int(request.get("alternative_route.max_paths", 1))
+            else:
+                points = [tuple(float(v) for v in p.split(',')) for p in params.get("point", [])]
+                max_paths = int(params.get("alternative_route.max_paths", [1])[0])
+            return self._reply(graphhopper_response(points, max_paths=max_paths))
+
+        if self.service == "nominatim":
+            return self._reply(nominatim_response(params.get("q", [""])[0]))
+
+        if self.service == "overpass":
+            query = parse_qs(body).get("data", [body])[0] if body else params.get("data", [""])[0]
+            return self._reply(overpass_response(query))
+
+    def do_GET(self):
+        self._handle("")
+
+    def do_POST(self):
+        self._handle(self._body())
+
+
+def serve(service, port, latency_ms=0, jitter_ms=0, fixtures=None, host="127.0.0.1"):
+    """
+    Start one stub server in a daemon thread. Returns the server.
+    """
+    fixture = None
+    if fixtures and os.path.exists(os.path.join(fixtures, f"{service}.json")):
+        with open(os.path.join(fixtures, f"{service}.json"), 'rb') as f:
+            fixture = f.read()
+
+    handler = type(f"{service.title()}Handler", (StubHandler,), {
+        "service": service, "latency_s": latency_ms / 1000, "jitter_s": jitter_ms / 1000, "fixture": fixture})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"{service} stub on http://{host}:{port} ({latency_ms} +- {jitter_ms} ms{', fixture' if fixture else ''})")
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="GraphHopper, Nominatim and Overpass stubs for load tests")
+    parser.add_argument('--graphhopper_port', type=int, default=8091)
+    parser.add_argument('--nominatim_port', type=int, default=8092)
+    parser.add_argument('--overpass_port', type=int, default=8093)
+    parser.add_argument('--graphhopper_latency_ms', type=float, default=300)
+    parser.add_argument('--nominatim_latency_ms', type=float, default=150)
+    parser.add_argument('--overpass_latency_ms', type=float, default=1500)
+    parser.add_argument('--jitter_ms', type=float, default=0, help="Standard deviation of every latency")
+    parser.add_argument('--fixtures', type=str, default=None, help="Directory of recorded <service>.json responses")
+    args = parser.parse_args()
+
+    serve("graphhopper", args.graphhopper_port, args.graphhopper_latency_ms, args.jitter_ms, args.fixtures)
+    serve("nominatim", args.nominatim_port, args.nominatim_latency_ms, args.jitter_ms, args.fixtures)
+    serve("overpass", args.overpass_port, args.overpass_latency_ms, args.jitter_ms, args.fixtures)
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
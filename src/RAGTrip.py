@@ -1,20 +1,12 @@
 from ir_module.utils import query_llm
 import re
-from spatial_module.main import spatialComponent
+import uuid
+from time import perf_counter
+from spatial_module.spatial import spatialModule
+from spatial_module.metrics import INTENTS, LLM_CLASSIFY
+from spatial_module.profiling import profiling_requested, profile_request
 
-class RAGTrip:
-    def __init__(self, rag, tokenizer, model):
-        self.rag = rag
-        self.tokenizer = tokenizer
-        self.model = model
-
-
-    def extract_class(text):
-        match = re.search(r'Class:\s*(Spatial Request|Information Request)', text)
-        return match.group(1) if match else None
-
-    def classify_intent(self, query):
-        instruction = """
+CLASSIFY_INSTRUCTION = """
             You are a classifier. Your task is to determine the type of user prompt based on its content. For each prompt, classify it into one of the following two categories and follow the corresponding output format:
             
             Categories:
@@ -38,47 +30,107 @@ class RAGTrip:
             Output format:
             Class: Information Request  
             Prompt: [original user prompt]"""
+
+class RAGTrip:
+    def __init__(self, rag, tokenizer, model, routes_dir=None):
+        self.rag = rag
+        # Optional debug copy of every route summary, see spatial_module.spatial.save_route_summary
+        self.routes_dir = routes_dir
+        self.tokenizer = tokenizer
+        self.model = model
+
+
+    def extract_class(text):
+        match = re.search(r'Class:\s*(Spatial Request|Information Request)', text)
+        return match.group(1) if match else None
+
+    def classify_intent(self, query):
+        start = perf_counter()
+        classification = query_llm(query, CLASSIFY_INSTRUCTION, self.tokenizer, self.model, temperature=0.7, max_new_tokens=1000)
+        LLM_CLASSIFY.observe(perf_counter() - start)
         
-        return query_llm(query, instruction, self.tokenizer, self.model, temperature=0.7, max_new_tokens=1000)
+        if "Spatial Request" in classification:
+            INTENTS.inc("spatial")
+        elif "Information Request" in classification:
+            INTENTS.inc("information")
+        else:
+            INTENTS.inc("unknown")
+        return classification
 
     
     def parse_field(a):
         return None if a.lower() == 'none' else [v for v in a.split(',')]
 
-    def handle_query(self, query, mode='RAG'):
+    def parse_spatial_request(self, classification):
+        """
+        Extract the spatialModule arguments from a Spatial Request classification.
+        Returns None if the classification does not follow the output format.
+        """
+        match = re.search(
+            r'From:\s*(.+?)\s*To:\s*(.+?)\s*Time:\s*(.+?)\s*Distance:\s*(.+?)\s*POI Categories:\s*(.+)',
+            classification,
+            re.DOTALL
+        )
+        
+        if not match:
+            return None
+        
+        from_location, to_location, time_constraint, space_constraint, poi_categories = [g.strip() for g in match.groups()]
+        
+        time_constraint = None if time_constraint.lower() == 'none' else time_constraint
+        space_constraint = None if space_constraint.lower() == 'none' else space_constraint
+        poi_categories = [] if poi_categories.lower().strip('[]') == 'none' else [v.strip(' []') for v in poi_categories.strip('[]').split(',')]
+        
+        return {
+            'start': from_location,
+            'end': to_location,
+            'time_constraint': time_constraint,
+            'space_constraint': space_constraint,
+            'pois_list': poi_categories
+        }
+    
+    def plan_route(self, spatial_request, request_id=None):
+        """
+        Run the spatial module. Returns its result tuple, or None if the places were not found.
+        """
+        print(spatial_request)
+        result = spatialModule(**spatial_request, save_dir=self.routes_dir, request_id=request_id)
+        
+        if isinstance(result, str):
+            return None
+        return result
+
+    def handle_query(self, query, mode='RAG', request_id=None, profile=False, session_id=None):
+        """
+        Answer a query. With RAGTRIP_PROFILING=all (or =request and profile=True) the call
+        runs under the sampling profiler and the profile is written as <request_id>.*
+        in RAGTRIP_PROFILE_DIR. With a session_id, the passages of the POIs of a planned
+        route are prefetched for the next questions of the session.
+        """
+        if profiling_requested(profile):
+            with profile_request(request_id or uuid.uuid4().hex):
+                return self._handle_query(query, mode, request_id, session_id)
+        return self._handle_query(query, mode, request_id, session_id)
+
+    def _handle_query(self, query, mode, request_id, session_id=None):
         classification = self.classify_intent(query)
         print(type(classification), classification)
         if "Spatial Request" in classification:
             
-            match = re.search(
-                r'From:\s*(.+?)\s*To:\s*(.+?)\s*Walkability Indicators:\s*(.+?)\s*POI Categories:\s*(.+)',
-                classification,
-                re.DOTALL
-            )
-
-            if match:
-                from_location = match.group(1).strip()
-                to_location = match.group(2).strip()
-                walkability_indicators = match.group(3).strip()
-                poi_categories = match.group(4).strip()
-                
-            walkability_indicators = None if walkability_indicators.lower() == 'none' else [v for v in walkability_indicators.split(', ')]
-            poi_categories = None if poi_categories.lower() == 'none' else [v for v in poi_categories.split(', ')]
-            
-            print(from_location, to_location, walkability_indicators, poi_categories)
+            spatial_request = self.parse_spatial_request(classification)
+            if spatial_request is None:
+                return "Intent could not be classified or required file missing."
             
-            json_path = spatialComponent(
-                place_A=from_location,
-                place_B=to_location,
-                indicators_preference=walkability_indicators,
-                pois_user=poi_categories
-            )
+            route = self.plan_route(spatial_request, request_id=request_id)
             
-            if not json_path:
+            if not route:
                 return "No valid route found or required file missing."
             
-            return self.rag.handle_spatial_request(query, json_path=json_path)
+            route_summary = route[0]
+            answer = self.rag.handle_spatial_request(query, route_summary)
+            self.rag.prefetch(session_id, route_summary)  # after the answer, on the same thread as the other model stages
+            return answer
         elif "Information Request" in classification:
-            return self.rag.handle_information_request(query, mode)
+            return self.rag.handle_information_request(query, mode=mode, session_id=session_id)
         else:
-            return "Intent could not be classified or required file missing."
\ No newline at end of file
+            return "Intent could not be classified or required file missing."
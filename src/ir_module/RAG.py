@@ -1,19 +1,137 @@
 import os
+import re
 import json
 from .utils import *
+from .sharded_index import ShardedIndex, RemoteShards
+from .live_index import LiveIndex, IdMap, UpdateLog, idmap_path, log_path
+from .dedup import collapse_near_duplicates
+from .geo_filter import GeoFilter
+from .prefetch import Prefetcher
+from .context import split_sentences, split_windows, pack_context
 import pandas as pd
-from transformers import AutoModel
+from time import perf_counter
+from spatial_module.metrics import (RETRIEVAL, RETRIEVAL_DEDUP, GEO_FILTER, PREFETCH, LLM_INFORMATION, LLM_SPATIAL,
+                                    PROMPT_TOKENS_INFORMATION, PROMPT_TOKENS_CONTEXT)
+from spatial_module.narration import narrate_route, route_overview, route_highlights
+
+# passages added by RAG.ingest, same columns as CAST2019collection.tsv (later lines win)
+INGESTED_PASSAGES = 'data/ingested.tsv'
+
+SPATIAL_INSTRUCTION = """
+            You are a smart route summarizer. Your task is to generate a concise, natural-language description of a walking route based on the provided JSON input.
+
+            The JSON contains:
+            - Total path length and time,
+            - A list of segments with navigation instructions (if any),
+            - POIs (Points of Interest) per segment, categorized (e.g., cafe, restaurant, park),
+            - Timing and distance information to and from origin/destination for each segment.
+
+            Your job is to:
+            1. Start with a short summary of the total route length and walking time.
+            2. Describe segments embedding the navigation instruction (if available) and mentioning any interesting POIs in a friendly, conversational tone.
+            3. Handle user constraints only if present in the user query. Constraints may involve:
+            - Time (e.g., "stop around 5 minutes before arrival"),
+            - Distance (e.g., "within 100 meters of the destination"),
+            - POI type (e.g., "find a place to drink coffee").
+
+            If a time-based constraint is mentioned, search for matching POIs in segments where `time_to_destination_min <= requested time`.
+            If a distance-based constraint is mentioned, search in segments where `distance_to_destination_m <= requested distance`.
+
+            Important:
+            - Only apply these filters if the user mentions them.
+            - Translate fuzzy POI goals like "drink a coffee" into relevant categories: [`cafe`, `bar`, `restaurant`, `bakery`].
+            - If no POIs matching the constraint are found, say so clearly.
+
+            The tone should be helpful and conversational. No Python or JSON output — only fluent text.
+        """
+
+NARRATION_INSTRUCTION = """
+            You write the first and the last sentence of the description of a walking route. The directions are written separately: do not give any direction, distance or time.
+            The intro greets the user and relates the walk to their request; the outro wishes a good walk, mentioning a point of interest if any.
+            Reply with exactly two lines:
+            Intro: [one sentence]
+            Outro: [one sentence]
+        """
+NARRATION_LINE = re.compile(r'^\s*(Intro|Outro)\s*:\s*(.+)$', re.IGNORECASE | re.MULTILINE)
 
 class RAG:
     
-    def __init__(self, data_path, cache_dir, encoder_id, llm_tokenizer, llm_model):
+    def __init__(self, data_path, cache_dir, encoder_id, llm_tokenizer, llm_model, retrieval='ivf', rerank_candidates=100,
+                 shard_workers=None, shard_authkey=None, dedup_threshold=None, overfetch=3,
+                 geo_radius_m=1000, geo_nprobe=None, prefetch=True, context_budget=None, context_threshold=None,
+                 narration='llm', narration_tokens=80, prefetch_executor=None):
+        """
+        retrieval='ivf' searches the IVF index of full vectors. retrieval='pq' searches a
+        product-quantized index for `rerank_candidates` passages and re-ranks them exactly
+        with the embeddings memory-mapped from data_path/embeddings/shards
+        (see resources/build_pq_index.py). retrieval='sharded' searches the index shards of
+        data_path/indexes/shards in parallel, in this process or, if `shard_workers`
+        ("host:port" list) is given, on the workers serving them (see resources/sharded_index.py),
+        which requires their `shard_authkey`.
+
+        If the IVF index has an id map next to it (resources/ingest.py migrate), it is a
+        LiveIndex updated in place by ingest()/remove(), and its id map replaces the
+        CAST2019_ID_Mapping.tsv dict in every retrieval mode.
+
+        With `dedup_threshold` (e.g. 0.8), retrieval fetches `overfetch` times the passages it
+        needs and keeps the best ones that are not near-duplicates of each other. None, the
+        default, keeps the passages as retrieved.
+
+        If data_path/geo holds geotagged passages (resources/geotag_passages.py), a question
+        naming a known place only searches the passages within `geo_radius_m` of it, scored
+        exactly from data_path/embeddings/shards when available (not with retrieval='sharded',
+        whose shards number passages locally).
+
+        With `prefetch`, prefetch(session_id, route_summary) retrieves the passages of the
+        POIs of a planned route on `prefetch_executor` (the model worker of the server, never
+        a thread of its own; in the calling thread if None), and an information request of
+        the same session naming one of them is answered from those passages without a search.
+
+        With `context_budget` (e.g. 512), the background of an information request is not the
+        passages in full but their sentences most similar to the question, up to that many
+        tokens; sentences scoring below `context_threshold` are dropped, and passages left
+        without any. None, the default, sends the passages in full.
+
+        narration='llm' (the default) has the LLM narrate the whole route. narration='template'
+        renders the directions and POIs of a route summary with templates
+        (spatial_module/narration.py) and only asks the LLM for an intro/outro of at most
+        `narration_tokens` tokens.
+        """
+        assert retrieval in ['ivf', 'pq', 'sharded'], "Invalid retrieval. Choose from ['ivf', 'pq', 'sharded']"
+        assert narration in ['template', 'llm'], "Invalid narration. Choose from ['template', 'llm']"
 
         self.encoder = self.load_encoder(cache_dir, encoder_id)
         self.tokenizer = self.load_tokenizer(cache_dir, encoder_id)
-        self.index = self.load_index(data_path)
+        self.rerank_candidates = rerank_candidates
+        self.dedup_threshold = dedup_threshold
+        self.overfetch = overfetch if dedup_threshold is not None else 1
+        self.live_index = None
+        if retrieval == 'pq':
+            self.index = self.load_pq_index(data_path)
+            self.shards = EmbeddingShards(data_path + '/embeddings/shards')
+        elif retrieval == 'sharded':
+            self.index = self.load_sharded_index(data_path, shard_workers, shard_authkey)
+            self.shards = None
+        else:
+            self.live_index = self.load_live_index(data_path)
+            self.index = self.live_index if self.live_index is not None else self.load_index(data_path)
+            self.shards = None
         self.llm_tokenizer = llm_tokenizer
         self.llm_model = llm_model
-        self.index_id, self.id_corpus = self.load_corpus(data_path)
+        self.data_path = data_path
+        self.geo_filter = self.load_geo_filter(data_path, geo_radius_m) if retrieval != 'sharded' else None
+        self.geo_nprobe = geo_nprobe
+        if self.geo_filter is not None and self.shards is None and os.path.exists(data_path + '/embeddings/shards'):
+            self.geo_shards = EmbeddingShards(data_path + '/embeddings/shards')
+        else:
+            self.geo_shards = self.shards
+        self.prefetcher = Prefetcher(self.retrieve_many, executor=prefetch_executor) if prefetch else None
+        self.context_budget = context_budget
+        self.context_threshold = context_threshold
+        self.narration = narration
+        self.narration_tokens = narration_tokens
+        self.index_id, self.id_corpus = self.load_corpus(
+            data_path, self.live_index.idmap if self.live_index is not None else None)
         
     @staticmethod
     def load_index(data_path):
@@ -21,29 +139,172 @@ class RAG:
         return index
     
     @staticmethod
-    def load_corpus(data_path):
+    def load_live_index(data_path):
+        index_path = data_path + '/indexes/ivf/snowflake_ivf_6216.faiss'
+        if not os.path.exists(idmap_path(index_path)):
+            return None
+        return LiveIndex(index_path)
+    
+    @staticmethod
+    def load_geo_filter(data_path, radius_m):
+        geo_dir = data_path + '/geo'
+        if not os.path.exists(os.path.join(geo_dir, 'passages.npz')):
+            return None
+        geo_filter = GeoFilter(geo_dir, radius_m=radius_m)
+        print(f"Geo filter: {len(geo_filter.gazetteer)} places, {len(geo_filter.grid)} passage locations")
+        return geo_filter
+    
+    @staticmethod
+    def load_pq_index(data_path):
+        index = load_faiss_index(data_path + '/indexes/pq/snowflake_ivfpq.faiss')
+        return index
+    
+    @staticmethod
+    def load_sharded_index(data_path, shard_workers=None, shard_authkey=None):
+        if shard_workers:
+            addresses = [(host, int(port)) for host, port in (worker.rsplit(':', 1) for worker in shard_workers)]
+            return RemoteShards(addresses, shard_authkey, timeout=60)
+        return ShardedIndex(data_path + '/indexes/shards')
+    
+    @staticmethod
+    def load_corpus(data_path, idmap=None):
         corpus = pd.read_csv(data_path + 'data/CAST2019collection.tsv', sep='\\t')
-        id_mapping = pd.read_csv(data_path + 'data/CAST2019_ID_Mapping.tsv', sep='\\t')
-        index_id = dict(zip(id_mapping.index, id_mapping.id))
+        index_path = data_path + '/indexes/ivf/snowflake_ivf_6216.faiss'
+        if idmap is None and os.path.exists(idmap_path(index_path)):
+            idmap = IdMap.load(idmap_path(index_path), UpdateLog(log_path(index_path)))
+        if idmap is not None:
+            index_id = idmap
+        else:
+            id_mapping = pd.read_csv(data_path + 'data/CAST2019_ID_Mapping.tsv', sep='\\t')
+            index_id = dict(zip(id_mapping.index, id_mapping.id))
         id_corpus = dict(zip(corpus.id, corpus.text))
+        if os.path.exists(data_path + INGESTED_PASSAGES):
+            ingested = pd.read_csv(data_path + INGESTED_PASSAGES, sep='\\t')
+            id_corpus.update(zip(ingested.id, ingested.text))
         
         return index_id, id_corpus
     
     @staticmethod
     def load_tokenizer(cache_dir, encoder_id):
+        from transformers import AutoTokenizer
         encoder_tokenizer = AutoTokenizer.from_pretrained(encoder_id, device_map='auto', cache_dir=cache_dir)
         return encoder_tokenizer
     
     @staticmethod
     def load_encoder(cache_dir, encoder_id):    
+        from transformers import AutoModel
         encoder = AutoModel.from_pretrained(encoder_id, device_map='auto', cache_dir=cache_dir, add_pooling_layer=False)
         return encoder
 
-    def handle_information_request(self, query, docs, mode = 'RAG'):
-        
-        indices = search_docs(query, self.encoder, self.tokenizer, self.index, top_k=5)
+    def ingest(self, doc_ids, texts):
+        """
+        Add new passages and replace changed ones in the live index; only those are embedded.
+        Returns the number of (added, replaced) passages.
+        """
+        assert self.live_index is not None, "No id map next to the IVF index, run resources/ingest.py migrate first"
+        def embed(batch, batch_size=64):
+            return np.vstack([embed_passages_snowflake(batch[i:i + batch_size], self.encoder, self.tokenizer, query=False)
+                              for i in range(0, len(batch), batch_size)])
+
+        doc_ids, texts = list(doc_ids), list(texts)
+        added, replaced, ingested = self.live_index.ingest(doc_ids, texts, embed)
+        if len(ingested):
+            path = self.data_path + INGESTED_PASSAGES
+            new_file = not os.path.exists(path)
+            delta = pd.DataFrame({'id': [doc_ids[i] for i in ingested], 'text': [texts[i] for i in ingested]})
+            delta.to_csv(path, sep='\t', index=False, header=new_file, mode='a')
+            self.id_corpus.update(zip(delta.id, delta.text))
+        return added, replaced
+
+    def remove(self, doc_ids):
+        """Tombstone passages of the live index. Returns how many were removed."""
+        assert self.live_index is not None, "No id map next to the IVF index, run resources/ingest.py migrate first"
+        return self.live_index.remove(doc_ids)
+
+    def collapse_duplicates(self, docs, top_k, record=True):
+        """
+        Best top_k passages without near-duplicates. The collapsed passages that would have
+        been in the prompt are counted in ragtrip_retrieval_dedup_total (if `record`).
+        """
+        if self.dedup_threshold is None:
+            return docs[:top_k]
+        kept, collapsed = collapse_near_duplicates(docs, top_k, threshold=self.dedup_threshold)
+        wasted = [docs[i] for i in collapsed if i < top_k]
+        if wasted and record:
+            RETRIEVAL_DEDUP.inc("passages", len(wasted))
+            RETRIEVAL_DEDUP.inc("prompt_tokens", sum(len(self.llm_tokenizer.encode(doc, add_special_tokens=False))
+                                                     for doc in wasted))
+        return kept
+
+    def retrieve(self, query, top_k=5):
+        start = perf_counter()
+        candidate_ids = None
+        if self.geo_filter is not None:
+            candidate_ids, outcome = self.geo_filter.candidates(query)
+            GEO_FILTER.inc(outcome)
+            if candidate_ids is not None and self.live_index is not None:
+                candidate_ids = candidate_ids[self.live_index.idmap.is_live(candidate_ids)]
+        indices = search_docs(query, self.encoder, self.tokenizer, self.index, top_k=top_k * self.overfetch,
+                              shards=self.shards, candidates=self.rerank_candidates,
+                              candidate_ids=candidate_ids if candidate_ids is None or len(candidate_ids) else None,
+                              exact_shards=self.geo_shards, nprobe=self.geo_nprobe)
         docs = get_corpus(indices, self.index_id, self.id_corpus)
+        docs = self.collapse_duplicates(docs, top_k=top_k)
+        RETRIEVAL.observe(perf_counter() - start)
+        return docs
+
+    def retrieve_many(self, queries, top_k=5):
+        """
+        Passages of several queries with one encoder batch and one index search (no geo filter).
+        """
+        query_embeddings = np.asarray(embed_passages_snowflake(queries, self.encoder, self.tokenizer), dtype='float32')
+        if self.shards is None:
+            _, indices = self.index.search(query_embeddings, top_k * self.overfetch)
+        else:
+            _, candidate_indices = self.index.search(query_embeddings, max(self.rerank_candidates, top_k * self.overfetch))
+            _, indices = rerank_exact(query_embeddings, candidate_indices, self.shards, top_k * self.overfetch)
+        return [self.collapse_duplicates(get_corpus(row[None, :], self.index_id, self.id_corpus), top_k, record=False)
+                for row in indices]
+
+    def prefetch(self, session_id, route_summary):
+        """Schedule the retrieval of the route POIs for the session (see Prefetcher)."""
+        if self.prefetcher is not None and self.prefetcher.submit(session_id, route_summary) is not None:
+            PREFETCH.inc("scheduled")
+
+    def pack_context(self, query, docs, batch_size=64, window=128):
+        """
+        Sentences of the passages most similar to the query within the context budget.
+        Sentences longer than `window` tokens are cut into windows first, and the query
+        and the sentences are embedded in the same encoder batches.
+        Returns the packed passages and the packing stats (see context.pack_context).
+        """
+        sentences = [(p, i, sentence) for p, doc in enumerate(docs) for i, sentence in enumerate(split_sentences(doc))]
+        if not sentences:
+            return docs, None
+        token_ids = [self.llm_tokenizer.encode(sentence, add_special_tokens=False) for _, _, sentence in sentences]
+        sentences, token_counts = split_windows(sentences, token_ids, min(window, self.context_budget),
+                                                self.llm_tokenizer.decode)
+        texts = ['query: ' + query] + [sentence for _, _, sentence in sentences]
+        embeddings = np.vstack([embed_passages_snowflake(texts[i:i + batch_size], self.encoder, self.tokenizer,
+                                                         max_length=window, query=False)
+                                for i in range(0, len(texts), batch_size)])
+        scores = embeddings[1:] @ embeddings[0]
+        packed, stats = pack_context(docs, sentences, scores, token_counts, self.context_budget, self.context_threshold)
+        PROMPT_TOKENS_CONTEXT.observe(stats["context_tokens"])
+        return packed, stats
+
+    def handle_information_request(self, query, docs=None, mode = 'RAG', session_id=None):
+        
+        if docs is None and session_id is not None and self.prefetcher is not None:
+            docs = self.prefetcher.cache.get(session_id, query)
+            PREFETCH.inc("hit" if docs is not None else "miss")
+        if docs is None:
+            docs = self.retrieve(query)
         
+        stats = None
+        if mode == 'RAG' and self.context_budget is not None:
+            docs, stats = self.pack_context(query, docs)
+
         if mode == 'RAG':
             prompt = "Provide a complete and accurate answer based on the background information above and your own knowledge. Do not mention the background source explicitly.\n\n"+f"Question: {query}\n\nBackground Information:\n" + "\n".join(docs)
             
@@ -52,44 +313,46 @@ class RAG:
             prompt = query
             
             instruction =  "You are a helpful assistant that answers users' questions clearly and accurately."
-        
+
+        prompt_tokens = len(self.llm_tokenizer.encode(instruction + prompt, add_special_tokens=False))
+        PROMPT_TOKENS_INFORMATION.observe(prompt_tokens)
+        if stats is not None:
+            print(f"Information prompt: {prompt_tokens} tokens, context {stats['context_tokens']} of "
+                  f"{stats['passage_tokens']} passage tokens ({stats['sentences']} sentences, "
+                  f"{stats['passages_dropped']} passages dropped)")
+
+        start = perf_counter()
         response = query_llm(prompt, instruction, self.llm_tokenizer, self.llm_model, temperature=0.7, max_new_tokens=1000)
+        LLM_INFORMATION.observe(perf_counter() - start)
         
         return response
 
-    def handle_spatial_request(self, query, json_path):
-        instruction = """
-            You are a smart route summarizer. Your task is to generate a concise, natural-language description of a walking route based on the provided JSON input.
-
-            The JSON contains:
-            - Total path length and time,
-            - A list of segments with navigation instructions (if any),
-            - POIs (Points of Interest) per segment, categorized (e.g., cafe, restaurant, park),
-            - Timing and distance information to and from origin/destination for each segment.
-
-            Your job is to:
-            1. Start with a short summary of the total route length and walking time.
-            2. Describe segments embedding the navigation instruction (if available) and mentioning any interesting POIs in a friendly, conversational tone.
-            3. Handle user constraints only if present in the user query. Constraints may involve:
-            - Time (e.g., "stop around 5 minutes before arrival"),
-            - Distance (e.g., "within 100 meters of the destination"),
-            - POI type (e.g., "find a place to drink coffee").
+    def narrate(self, query, route_summary):
+        """
+        Templated directions between an LLM intro and outro (template ones if the reply
+        does not follow the two-line format).
+        """
+        highlights = route_highlights(route_summary)
+        prompt = (f"User request: {query}\n{route_overview(route_summary)}\n"
+                  f"Points of interest on the way: {', '.join(highlights) if highlights else 'none'}")
+        start = perf_counter()
+        reply = query_llm(prompt, NARRATION_INSTRUCTION, self.llm_tokenizer, self.llm_model,
+                          max_new_tokens=self.narration_tokens, temperature=0.3)
+        LLM_SPATIAL.observe(perf_counter() - start)
 
-            If a time-based constraint is mentioned, search for matching POIs in segments where `time_to_destination_min <= requested time`.
-            If a distance-based constraint is mentioned, search in segments where `distance_to_destination_m <= requested distance`.
+        lines = {label.lower(): sentence.strip() for label, sentence in NARRATION_LINE.findall(reply)}
+        intro = lines.get('intro', f"Here is your walk from {route_summary.get('from')} to {route_summary.get('to')}.")
+        outro = lines.get('outro', "Enjoy your walk!")
+        return f"{intro}\n\n{narrate_route(route_summary)}\n\n{outro}"
 
-            Important:
-            - Only apply these filters if the user mentions them.
-            - Translate fuzzy POI goals like "drink a coffee" into relevant categories: [`cafe`, `bar`, `restaurant`, `bakery`].
-            - If no POIs matching the constraint are found, say so clearly.
+    def handle_spatial_request(self, query, route_summary):
+        if self.narration == 'template':
+            return self.narrate(query, route_summary)
 
-            The tone should be helpful and conversational. No Python or JSON output — only fluent text.
-        """
-        
-        with open(json_path, "rt") as f:
-            file_json = json.load(f)
-            
-        prompt = json.dumps(file_json)
-        response = query_llm(prompt, instruction, self.llm_tokenizer, self.llm_model, max_new_tokens=2000, temperature=0.3)
+        # route_summary is the summary dict returned by spatialModule, no file round trip
+        prompt = json.dumps(route_summary)
+        start = perf_counter()
+        response = query_llm(prompt, SPATIAL_INSTRUCTION, self.llm_tokenizer, self.llm_model, max_new_tokens=2000, temperature=0.3)
+        LLM_SPATIAL.observe(perf_counter() - start)
         
         return response
\ No newline at end of file
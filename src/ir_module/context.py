@@ -0,0 +1,90 @@
+"""
+Token-budgeted context packing: instead of the retrieved passages in full, the prompt
+gets their sentences most similar to the question, up to a token budget, so that the
+prefill cost of an information request is bounded whatever the passages' length.
+"""
+import re
+import numpy as np
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9"\'(])')
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_END.split(text) if sentence.strip()]
+
+def split_windows(sentences, token_ids, window, decode):
+    """
+    Cut the sentences longer than `window` tokens (e.g. a passage without punctuation)
+    into consecutive windows of at most `window` tokens, so that they can be scored and
+    packed like the others. Sentence indices are renumbered to stay consecutive.
+
+    Args:
+        sentences (list[tuple[int, int, str]]): (passage index, sentence index, text).
+        token_ids (list[list[int]]): tokens of every sentence.
+        window (int): maximum tokens of a sentence.
+        decode (callable): tokens -> text.
+
+    Returns:
+        list[tuple[int, int, str]]: the sentences and windows.
+        list[int]: tokens of every one of them.
+    """
+    windows, token_counts, previous, index = [], [], None, 0
+    for (p, _, sentence), ids in zip(sentences, token_ids):
+        index = index + 1 if p == previous else 0
+        previous = p
+        if len(ids) <= window:
+            windows.append((p, index, sentence))
+            token_counts.append(len(ids))
+            continue
+        for start in range(0, len(ids), window):
+            if start:
+                index += 1
+            windows.append((p, index, decode(ids[start:start + window]).strip()))
+            token_counts.append(len(ids[start:start + window]))
+    return windows, token_counts
+
+def pack_context(passages, sentences, scores, token_counts, budget, threshold=None):
+    """
+    Select the best-scoring sentences until `budget` tokens, and render them per passage
+    (in retrieval order) and in reading order, non-contiguous spans joined by " ... ".
+
+    Args:
+        passages (list[str]): retrieved passages, best first.
+        sentences (list[tuple[int, int, str]]): (passage index, sentence index, text).
+        scores (np.ndarray): similarity of every sentence to the query.
+        token_counts (list[int]): tokens of every sentence.
+        budget (int): token budget of the packed context.
+        threshold (float): sentences scoring below it are dropped, and with them the
+            passages that have none left. None keeps all.
+
+    Returns:
+        list[str]: packed passages.
+        dict: tokens of the passages in full and of the packed context, sentences kept,
+            passages dropped.
+    """
+    selected, used = set(), 0
+    for i in np.argsort(-np.asarray(scores), kind='stable'):
+        if threshold is not None and scores[i] < threshold:
+            break
+        if used + token_counts[i] > budget:
+            continue
+        selected.add(int(i))
+        used += token_counts[i]
+
+    packed = []
+    for p in range(len(passages)):
+        rows = [i for i in sorted(selected) if sentences[i][0] == p]
+        if not rows:
+            continue
+        text = sentences[rows[0]][2]
+        for previous, i in zip(rows, rows[1:]):
+            text += (" " if sentences[i][1] == sentences[previous][1] + 1 else " ... ") + sentences[i][2]
+        packed.append(text)
+
+    stats = {
+        "passage_tokens": int(sum(token_counts)),
+        "context_tokens": int(used),
+        "sentences": f"{len(selected)}/{len(sentences)}",
+        "passages_dropped": len(passages) - len(packed),
+    }
+    return packed, stats
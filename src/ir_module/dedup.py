@@ -0,0 +1,105 @@
+"""
+Near-duplicate passages (scraped boilerplate, the same paragraph on several pages).
+
+At corpus scale, MinHashLSH groups passages whose word-shingle Jaccard similarity is
+above a threshold without comparing all pairs: passages sharing a band of their MinHash
+signature are candidates, confirmed on the estimated similarity. At retrieval time the
+few over-fetched passages are compared exactly (collapse_near_duplicates).
+"""
+import re
+import zlib
+import numpy as np
+
+WORD = re.compile(r"\w+")
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+def shingles(text, size=3):
+    """Hashes (crc32) of the word n-grams of the lowercased text."""
+    words = WORD.findall(text.lower())
+    if len(words) < size:
+        return {zlib.crc32(" ".join(words).encode())}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class MinHashLSH:
+    """
+    num_perm hash functions split in `bands` bands of num_perm / bands rows. Two passages
+    become candidates with probability 1 - (1 - s^rows)^bands for a Jaccard similarity s
+    (about 0.7 at the 50% point with 128/16), and are duplicates if their estimated
+    similarity is at least `threshold`.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=16, shingle_size=3, seed=1):
+        assert num_perm % bands == 0, "num_perm must be a multiple of bands"
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)[:, None]
+
+    def signature(self, text):
+        hashes = np.fromiter(shingles(text, self.shingle_size), dtype=np.uint64)
+        return (((self.a * hashes + self.b) % MERSENNE_PRIME) & np.uint64(0xFFFFFFFF)).min(axis=1).astype(np.uint32)
+
+    def clusters(self, texts):
+        """
+        Index of the representative (first occurrence) of every text's near-duplicate group.
+        Each bucket is joined to its first member only, so huge boilerplate buckets stay linear.
+        """
+        signatures = np.vstack([self.signature(text) for text in texts]) if len(texts) else np.zeros((0, 1))
+        parent = np.arange(len(texts))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(self.bands):
+            buckets = {}
+            rows = signatures[:, band * self.rows:(band + 1) * self.rows]
+            for i, key in enumerate(map(bytes, rows)):
+                first = buckets.setdefault(key, i)
+                if first == i:
+                    continue
+                root_first, root_i = find(first), find(i)
+                if root_first == root_i:
+                    continue
+                if np.mean(signatures[first] == signatures[i]) >= self.threshold:
+                    parent[max(root_first, root_i)] = min(root_first, root_i)
+        return np.array([find(i) for i in range(len(texts))], dtype=np.int64)
+
+
+def dedup_passages(texts, threshold=0.8, **lsh_params):
+    """
+    Positions of the passages to keep: exact duplicates (after whitespace and case
+    normalization) and near-duplicates of an earlier passage are dropped.
+    """
+    first_seen = {}
+    unique = [first_seen.setdefault(" ".join(text.lower().split()), i) == i for i, text in enumerate(texts)]
+    positions = np.flatnonzero(unique)
+    roots = MinHashLSH(threshold=threshold, **lsh_params).clusters([texts[i] for i in positions])
+    return positions[roots == np.arange(len(positions))]
+
+def collapse_near_duplicates(docs, k, threshold=0.8, shingle_size=3):
+    """
+    The first k passages of a ranked list that are not near-duplicates of a better-ranked
+    one, and the positions of the collapsed passages.
+    """
+    kept, kept_shingles, collapsed = [], [], []
+    for i, doc in enumerate(docs):
+        if len(kept) == k:
+            break
+        doc_shingles = shingles(doc, shingle_size)
+        if any(jaccard(doc_shingles, other) >= threshold for other in kept_shingles):
+            collapsed.append(i)
+            continue
+        kept.append(doc)
+        kept_shingles.append(doc_shingles)
+    return kept, collapsed
@@ -0,0 +1,199 @@
+"""
+Geo-partitioned retrieval: passages are linked to the coordinates of the places they
+name (OSM names of the city snapshot, geocoded landmarks), and a question naming a
+place only searches the passages located around it.
+
+Offline, geotag() matches a Gazetteer against the passages (resources/geotag_passages.py);
+the locations go to a GeoGrid. At query time GeoFilter matches the gazetteer against the
+question and returns the ids of the passages within `radius_m`, the only ones searched
+(scored exactly from the embedding shards, or through a FAISS IDSelector).
+"""
+import os
+import re
+import json
+import unicodedata
+import numpy as np
+
+WORD = re.compile(r"\w+")
+EARTH_RADIUS_M = 6371000.0
+# Leading words of a place name that users usually leave out ("Musée du Louvre" -> "Louvre")
+GENERIC_WORDS = {'cathedrale', 'basilique', 'eglise', 'chapelle', 'musee', 'palais', 'chateau', 'jardin',
+                 'jardins', 'parc', 'place', 'square', 'tour', 'cathedral', 'basilica', 'church', 'chapel',
+                 'museum', 'palace', 'garden', 'gardens', 'park', 'tower'}
+ARTICLES = {'de', 'du', 'des', 'la', 'le', 'les', 'l', 'd', 'of', 'the'}
+
+
+def normalize(text):
+    """Lowercase words without accents ("Notre-Dame" and "notre dame" match)."""
+    text = unicodedata.normalize('NFKD', text)
+    return WORD.findall(''.join(c for c in text if not unicodedata.combining(c)).lower())
+
+def aliases(words, city=None):
+    """
+    Shorter forms of a normalized name: without its generic leading word, and without its
+    trailing city ("cathedrale notre dame de paris" -> "notre dame de paris",
+    "cathedrale notre dame", "notre dame").
+    """
+    city = normalize(city.split(',')[0]) if city else []
+    short = list(words)
+    if city and len(short) > len(city) and short[-len(city):] == city:
+        short = short[:-len(city)]
+        while short and short[-1] in ARTICLES:
+            short.pop()
+    forms = {tuple(short)}
+    for form in (words, short):
+        if form and form[0] in GENERIC_WORDS:
+            form = form[1:]
+            while form and form[0] in ARTICLES:
+                form = form[1:]
+            forms.add(tuple(form))
+    return {' '.join(form) for form in forms if form and list(form) != list(words)}
+
+def haversine_m(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class Gazetteer:
+    """
+    Place names (as word tuples) -> (lat, lon), matched longest-first in a text.
+    """
+
+    def __init__(self, places):
+        self.places = {tuple(name.split()): tuple(location) for name, location in places.items()}
+        self.max_words = max((len(name) for name in self.places), default=0)
+
+    @classmethod
+    def from_places(cls, names, lats, lons, min_chars=5, max_spread_m=500, city=None):
+        """
+        Every name is also matched by its aliases (see aliases(), `city` being the city of
+        the places), unless an alias is the full name of another place. Names shorter than
+        min_chars are dropped, and so are names shared by places more than max_spread_m
+        apart (chains, generic names): they would tag the wrong place.
+        """
+        grouped, grouped_aliases = {}, {}
+        for name, lat, lon in zip(names, lats, lons):
+            words = normalize(name)
+            grouped.setdefault(' '.join(words), []).append((lat, lon))
+            for alias in aliases(words, city):
+                grouped_aliases.setdefault(alias, set()).add((lat, lon))
+        for alias, locations in grouped_aliases.items():
+            if alias not in grouped:
+                grouped[alias] = list(locations)
+        places = {}
+        for name, locations in grouped.items():
+            if len(name) < min_chars:
+                continue
+            locations = np.array(locations)
+            center = locations.mean(axis=0)
+            if haversine_m(center[0], center[1], locations[:, 0], locations[:, 1]).max() <= max_spread_m:
+                places[name] = (float(center[0]), float(center[1]))
+        return cls(places)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({' '.join(name): location for name, location in self.places.items()}, f)
+
+    def __len__(self):
+        return len(self.places)
+
+    def match(self, text):
+        """(name, lat, lon) of the places named in the text, longest non-overlapping matches."""
+        words = normalize(text)
+        matches, i = [], 0
+        while i < len(words):
+            for n in range(min(self.max_words, len(words) - i), 0, -1):
+                location = self.places.get(tuple(words[i:i + n]))
+                if location is not None:
+                    matches.append((' '.join(words[i:i + n]), *location))
+                    i += n
+                    break
+            else:
+                i += 1
+        return matches
+
+
+def geotag(passages, gazetteer):
+    """
+    (ids, lats, lons) of the places named by each (faiss id, text) passage, one row per place.
+    """
+    ids, lats, lons = [], [], []
+    for faiss_id, text in passages:
+        for _, lat, lon in {m for m in gazetteer.match(text)}:
+            ids.append(faiss_id)
+            lats.append(lat)
+            lons.append(lon)
+    return np.array(ids, dtype=np.int64), np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64)
+
+
+class GeoGrid:
+    """
+    Passage locations bucketed in cells of cell_deg degrees, stored sorted by cell so that
+    the passages of a cell are one contiguous slice (np.searchsorted, no Python dict).
+    """
+
+    def __init__(self, ids, lats, lons, cell_deg=0.005):
+        self.cell_deg = cell_deg
+        cells = self._cells(lats, lons)
+        order = np.argsort(cells, kind='stable')
+        self.cells, self.ids = cells[order], ids[order]
+        self.lats, self.lons = lats[order], lons[order]
+
+    def _cells(self, lats, lons):
+        return (np.floor(np.asarray(lats) / self.cell_deg).astype(np.int64) << 32) \
+            + np.floor(np.asarray(lons) / self.cell_deg).astype(np.int64) + (1 << 31)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'], data['lats'], data['lons'], float(data['cell_deg']))
+
+    def save(self, path):
+        np.savez(path, ids=self.ids, lats=self.lats, lons=self.lons, cell_deg=self.cell_deg)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def near(self, lat, lon, radius_m):
+        """Sorted unique ids of the passages located within radius_m of (lat, lon)."""
+        dlat = np.degrees(radius_m / EARTH_RADIUS_M)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        lat_cells = np.arange(np.floor((lat - dlat) / self.cell_deg), np.floor((lat + dlat) / self.cell_deg) + 1)
+        lon_cells = np.arange(np.floor((lon - dlon) / self.cell_deg), np.floor((lon + dlon) / self.cell_deg) + 1)
+        rows = []
+        for lat_cell in lat_cells.astype(np.int64):
+            first = (lat_cell << 32) + lon_cells[0].astype(np.int64) + (1 << 31)
+            last = (lat_cell << 32) + lon_cells[-1].astype(np.int64) + (1 << 31)
+            rows.append(np.arange(np.searchsorted(self.cells, first), np.searchsorted(self.cells, last, side='right')))
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        rows = rows[haversine_m(lat, lon, self.lats[rows], self.lons[rows]) <= radius_m]
+        return np.unique(self.ids[rows])
+
+
+class GeoFilter:
+    """
+    Question -> sorted ids of the passages around the places it names, or None when it
+    names no known place or fewer than min_candidates passages are located there.
+    """
+
+    def __init__(self, geo_dir, radius_m=1000, min_candidates=20):
+        self.gazetteer = Gazetteer.load(os.path.join(geo_dir, 'gazetteer.json'))
+        self.grid = GeoGrid.load(os.path.join(geo_dir, 'passages.npz'))
+        self.radius_m = radius_m
+        self.min_candidates = min_candidates
+
+    def candidates(self, query):
+        """(ids or None, outcome: 'local', 'too_few' or 'no_place')."""
+        places = self.gazetteer.match(query)
+        if not places:
+            return None, 'no_place'
+        ids = np.unique(np.concatenate([self.grid.near(lat, lon, self.radius_m) for _, lat, lon in places]))
+        if len(ids) < self.min_candidates:
+            return None, 'too_few'
+        return ids, 'local'
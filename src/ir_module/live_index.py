@@ -0,0 +1,390 @@
+"""
+Corpus index updated in place: passages carry explicit 64-bit FAISS ids, removed or
+replaced passages are tombstoned (excluded from search until compact()), and the
+id -> doc id map is persisted as numpy arrays next to the index (<index>.idmap.npz)
+instead of the pandas dict built from CAST2019_ID_Mapping.tsv.
+
+Ingesting a batch only embeds the passages whose doc id is new or whose text changed
+(compared through a 64-bit fingerprint of the text). Updates cost the size of the delta:
+they go to the in-memory delta of the id map and to an append-only log (<index>.delta.log)
+replayed at load; the full index and id map are only written by a checkpoint (save()),
+e.g. after compact().
+"""
+import os
+import threading
+import numpy as np
+import faiss
+from hashlib import blake2b
+
+OP_ADD, OP_TOMBSTONE = 1, 2
+
+
+def hash64(strings):
+    """Stable 64-bit hashes (blake2b) of a list of strings."""
+    return np.array([int.from_bytes(blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in strings],
+                    dtype=np.uint64)
+
+def encode_strings(strings):
+    """(utf-8 blob, offsets) of a list of strings."""
+    encoded = [string.encode('utf-8') for string in strings]
+    return (np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)]))
+
+def decode_strings(blob, offsets):
+    return [blob[start:end].tobytes().decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+def idmap_path(index_path):
+    return os.path.splitext(index_path)[0] + '.idmap.npz'
+
+def log_path(index_path):
+    return os.path.splitext(index_path)[0] + '.delta.log'
+
+
+class UpdateLog:
+    """
+    Append-only log of the updates since the last checkpoint, as consecutive np.save
+    arrays: [OP_ADD, n], ids, doc keys, fingerprints, doc ids blob and offsets, embeddings;
+    or [OP_TOMBSTONE, n], ids. A torn record at the end (crash while appending) is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _append(self, arrays):
+        with open(self.path, 'ab') as f:
+            for array in arrays:
+                np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, ids, doc_keys, fingerprints, doc_ids, embeddings):
+        self._append([np.array([OP_ADD, len(ids)], dtype=np.int64), ids, doc_keys, fingerprints,
+                      *encode_strings(doc_ids), embeddings])
+
+    def tombstone(self, ids):
+        self._append([np.array([OP_TOMBSTONE, len(ids)], dtype=np.int64), np.asarray(ids, dtype=np.int64)])
+
+    def replay(self, truncate=False):
+        """
+        [(op, arrays)] of the complete records. With `truncate` (the writer, at load), a torn
+        record at the end is cut off so that the next appends follow the last complete one.
+        """
+        if not os.path.exists(self.path):
+            return []
+        records, valid = [], 0
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    op, _ = np.load(f)
+                    records.append((int(op), [np.load(f) for _ in range(6 if op == OP_ADD else 1)]))
+                except (EOFError, ValueError, OSError):
+                    break
+                valid = f.tell()
+        if truncate and valid < os.path.getsize(self.path):
+            os.truncate(self.path, valid)
+        return records
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class IdMap:
+    """
+    FAISS id -> doc id, as parallel arrays sorted by id (ids are allocated increasingly):
+    ids, doc_keys (hash of the doc id), fingerprints (hash of the text), alive, and the
+    doc ids as one utf-8 blob with offsets. About 45 bytes per passage.
+
+    The arrays grow by doubling their capacity, and the doc key index is a sorted base
+    (built at load and compact()) plus a small sorted delta of the entries appended since,
+    so appends and tombstones cost the size of the update, not of the corpus.
+    """
+
+    def __init__(self, ids, doc_keys, fingerprints, alive, blob, offsets, next_id=None):
+        self._size, self._blob_size = len(ids), len(blob)
+        self._ids = np.array(ids, dtype=np.int64)
+        self._doc_keys = np.array(doc_keys, dtype=np.uint64)
+        self._fingerprints = np.array(fingerprints, dtype=np.uint64)
+        self._alive = np.array(alive, dtype=bool)
+        self._blob = np.array(blob, dtype=np.uint8)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._next_id = int(next_id) if next_id is not None else (int(ids[-1]) + 1 if len(ids) else 0)
+        self._reindex()
+
+    ids = property(lambda self: self._ids[:self._size])
+    doc_keys = property(lambda self: self._doc_keys[:self._size])
+    fingerprints = property(lambda self: self._fingerprints[:self._size])
+    alive = property(lambda self: self._alive[:self._size])
+    blob = property(lambda self: self._blob[:self._blob_size])
+    offsets = property(lambda self: self._offsets[:self._size + 1])
+
+    def _reindex(self):
+        live = np.flatnonzero(self.alive)
+        self._by_key = live[np.argsort(self.doc_keys[live], kind='stable')]
+        self._sorted_keys = self.doc_keys[self._by_key]
+        self._delta_keys = np.zeros(0, dtype=np.uint64)
+        self._delta_positions = np.zeros(0, dtype=np.int64)
+        self._tombstones = [self.ids[~self.alive]]
+
+    def _grow(self, n, nbytes):
+        def grown(array, size):
+            if size <= len(array):
+                return array
+            bigger = np.zeros(max(2 * len(array), size), dtype=array.dtype)
+            bigger[:len(array)] = array
+            return bigger
+        self._ids, self._doc_keys = grown(self._ids, self._size + n), grown(self._doc_keys, self._size + n)
+        self._fingerprints, self._alive = grown(self._fingerprints, self._size + n), grown(self._alive, self._size + n)
+        self._offsets = grown(self._offsets, self._size + n + 1)
+        self._blob = grown(self._blob, self._blob_size + nbytes)
+
+    @classmethod
+    def build(cls, doc_ids, texts, ids=None):
+        """Id map of an existing index; row i (or ids[i]) holds doc_ids[i] with texts[i]."""
+        return cls(np.arange(len(doc_ids), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64),
+                   hash64(doc_ids), hash64(texts), np.ones(len(doc_ids), dtype=bool), *encode_strings(doc_ids))
+
+    @classmethod
+    def load(cls, path, log=None):
+        """Id map of the last checkpoint, plus the updates of `log` (UpdateLog) if given."""
+        with np.load(path) as data:
+            idmap = cls(*(data[name] for name in ('ids', 'doc_keys', 'fingerprints', 'alive', 'blob', 'offsets')),
+                        next_id=data['next_id'] if 'next_id' in data else None)
+        if log is not None:
+            for op, arrays in log.replay():
+                idmap.apply(op, arrays)
+        return idmap
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, ids=self.ids, doc_keys=self.doc_keys, fingerprints=self.fingerprints,
+                 alive=self.alive, blob=self.blob, offsets=self.offsets, next_id=self._next_id)
+        os.replace(tmp_path, path)
+
+    def apply(self, op, arrays):
+        """
+        Apply an UpdateLog record. Returns the ids of the added entries, None for records
+        already in the checkpoint and for tombstones.
+        """
+        if op == OP_ADD:
+            ids, doc_keys, fingerprints, blob, offsets, _ = arrays
+            if len(ids) == 0 or ids[0] < self._next_id:
+                return None
+            self._next_id = int(ids[0])
+            return self.append(decode_strings(blob, offsets), doc_keys, fingerprints)
+        ids = arrays[0]
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < self._size
+        positions, ids = positions[found], ids[found]
+        self.tombstone(positions[(self.ids[positions] == ids) & self.alive[positions]])
+        return None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def next_id(self):
+        return self._next_id
+
+    def doc_id(self, position):
+        return self.blob[self.offsets[position]:self.offsets[position + 1]].tobytes().decode('utf-8')
+
+    def get(self, faiss_id, default=None):
+        """Doc id of a live FAISS id (same use as the former index_id dict)."""
+        position = int(np.searchsorted(self.ids, faiss_id))
+        if position == len(self.ids) or self.ids[position] != faiss_id or not self.alive[position]:
+            return default
+        return self.doc_id(position)
+
+    def is_live(self, faiss_ids):
+        """Boolean mask of the FAISS ids that exist and are not tombstoned."""
+        positions = np.minimum(np.searchsorted(self.ids, faiss_ids), max(len(self.ids) - 1, 0))
+        return (self.ids[positions] == faiss_ids) & self.alive[positions] if len(self.ids) else np.zeros(len(faiss_ids), bool)
+
+    def lookup(self, doc_keys):
+        """Positions of the live entries with these doc keys, -1 where absent."""
+        doc_keys = np.asarray(doc_keys, dtype=np.uint64)
+        positions = np.full(len(doc_keys), -1, dtype=np.int64)
+        for keys, by_key in ((self._sorted_keys, self._by_key), (self._delta_keys, self._delta_positions)):
+            if len(keys) == 0:
+                continue
+            found = np.minimum(np.searchsorted(keys, doc_keys), len(keys) - 1)
+            hit = (keys[found] == doc_keys) & self.alive[by_key[found]]
+            positions[hit] = by_key[found[hit]]
+        return positions
+
+    def append(self, doc_ids, doc_keys, fingerprints):
+        blob, offsets = encode_strings(doc_ids)
+        self._grow(len(doc_ids), len(blob))
+        start, end = self._size, self._size + len(doc_ids)
+        ids = np.arange(self._next_id, self._next_id + len(doc_ids), dtype=np.int64)
+        self._ids[start:end], self._doc_keys[start:end] = ids, doc_keys
+        self._fingerprints[start:end], self._alive[start:end] = fingerprints, True
+        self._blob[self._blob_size:self._blob_size + len(blob)] = blob
+        self._offsets[start + 1:end + 1] = self._blob_size + offsets[1:]
+        self._size, self._blob_size, self._next_id = end, self._blob_size + len(blob), self._next_id + len(doc_ids)
+
+        order = np.argsort(doc_keys, kind='stable')
+        insert_at = np.searchsorted(self._delta_keys, np.asarray(doc_keys)[order])
+        self._delta_keys = np.insert(self._delta_keys, insert_at, np.asarray(doc_keys)[order])
+        self._delta_positions = np.insert(self._delta_positions, insert_at, np.arange(start, end)[order])
+        return ids
+
+    def tombstone(self, positions):
+        if len(positions) == 0:
+            return
+        self._alive[positions] = False
+        self._tombstones.append(self.ids[positions])
+        keep = ~np.isin(self._delta_positions, positions)
+        self._delta_keys, self._delta_positions = self._delta_keys[keep], self._delta_positions[keep]
+
+    def tombstones(self):
+        return np.concatenate(self._tombstones)
+
+    def compact(self):
+        """Drop the tombstoned entries, and merge the delta into the sorted doc key index."""
+        keep = np.flatnonzero(self.alive)
+        lengths = np.diff(self.offsets)[keep]
+        starts = self.offsets[keep]
+        blob = self.blob
+        self._blob = (np.concatenate([blob[s:s + n] for s, n in zip(starts, lengths)])
+                      if len(keep) else np.zeros(0, dtype=np.uint8))
+        self._offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        self._ids, self._doc_keys, self._fingerprints = self.ids[keep], self.doc_keys[keep], self.fingerprints[keep]
+        self._alive = np.ones(len(keep), dtype=bool)
+        self._size, self._blob_size = len(keep), len(self._blob)
+        self._reindex()
+
+
+class LiveIndex:
+    """
+    FAISS index with an IdMap, searched with the tombstones excluded. Exposes the faiss
+    `search(x, k)` interface and the id map as `idmap` (for get_corpus).
+
+    Loaded from disk, the updates logged since the last checkpoint are replayed.
+    """
+
+    def __init__(self, index_path, index=None, idmap=None):
+        self.index_path = index_path
+        self.log = UpdateLog(log_path(index_path))
+        self.index = index if index is not None else faiss.read_index(index_path)
+        if idmap is None:
+            idmap = IdMap.load(idmap_path(index_path))
+            for op, arrays in self.log.replay(truncate=True):
+                ids = idmap.apply(op, arrays)
+                if ids is not None:
+                    self.index.add_with_ids(np.ascontiguousarray(arrays[5], dtype=np.float32), ids)
+        self.idmap = idmap
+        self.lock = threading.Lock()
+        self._update_selector()
+
+    @classmethod
+    def migrate(cls, index_path, doc_ids, texts):
+        """
+        Write the id map of an index whose row i is doc_ids[i] (the CAST2019_ID_Mapping.tsv
+        order). Flat indexes are wrapped in IndexIDMap2 to accept explicit ids.
+        """
+        index = faiss.read_index(index_path)
+        assert index.ntotal == len(doc_ids), f"Index has {index.ntotal} vectors, mapping has {len(doc_ids)}"
+        if not isinstance(index, faiss.IndexIVF) and not isinstance(index, faiss.IndexIDMap):
+            wrapped = faiss.IndexIDMap2(faiss.IndexFlat(index.d, index.metric_type))
+            wrapped.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype=np.int64))
+            index = wrapped
+        live = cls(index_path, index=index, idmap=IdMap.build(doc_ids, texts))
+        live.save()
+        return live
+
+    @property
+    def ntotal(self):
+        return len(self.idmap)
+
+    def _update_selector(self):
+        tombstones = self.idmap.tombstones()
+        self._params = None
+        self._selectors = []
+        if len(tombstones):
+            # selectors and search parameters only hold pointers: keep the Python objects alive
+            self._selectors = [faiss.IDSelectorBatch(tombstones)]
+            self._selectors.append(faiss.IDSelectorNot(self._selectors[0]))
+            if isinstance(self.index, faiss.IndexIVF):
+                self._params = faiss.SearchParametersIVF(sel=self._selectors[1], nprobe=self.index.nprobe)
+            else:
+                self._params = faiss.SearchParameters(sel=self._selectors[1])
+
+    def search(self, x, k):
+        with self.lock:
+            return self.index.search(np.ascontiguousarray(x, dtype=np.float32), k, params=self._params)
+
+    def search_selected(self, x, k, selector, nprobe=None):
+        """Search among the ids accepted by `selector` (and not tombstoned)."""
+        with self.lock:
+            if len(self._selectors):
+                selector = faiss.IDSelectorAnd(selector, self._selectors[1])
+            if isinstance(self.index, faiss.IndexIVF):
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or self.index.nprobe)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+            return self.index.search(np.ascontiguousarray(x, dtype=np.float32), k, params=params)
+
+    def ingest(self, doc_ids, texts, embed):
+        """
+        Add new passages and replace changed ones, and log the update. `embed(texts)` returns
+        their normalized embeddings and is only called on the new or changed passages.
+        A doc id repeated in the batch is ingested once, with its last text.
+        Returns the number of added and replaced passages, and their positions in doc_ids.
+        """
+        doc_ids, texts = list(doc_ids), list(texts)
+        last = np.array(sorted({doc_id: i for i, doc_id in enumerate(doc_ids)}.values()), dtype=np.int64)
+        doc_keys, fingerprints = hash64([doc_ids[i] for i in last]), hash64([texts[i] for i in last])
+        positions = self.idmap.lookup(doc_keys)
+        existing = positions >= 0
+        changed = existing & (self.idmap.fingerprints[np.maximum(positions, 0)] != fingerprints)
+        todo = np.flatnonzero(~existing | changed)
+        if len(todo) == 0:
+            return 0, 0, last[todo]
+
+        embeddings = np.ascontiguousarray(embed([texts[i] for i in last[todo]]), dtype=np.float32)
+        with self.lock:
+            if changed.any():
+                replaced_ids = self.idmap.ids[positions[changed]]
+                self.idmap.tombstone(positions[changed])
+                self.log.tombstone(replaced_ids)
+                self._update_selector()
+            ids = self.idmap.append([doc_ids[i] for i in last[todo]], doc_keys[todo], fingerprints[todo])
+            self.index.add_with_ids(embeddings, ids)
+            self.log.add(ids, doc_keys[todo], fingerprints[todo], [doc_ids[i] for i in last[todo]], embeddings)
+        return int((~existing[todo]).sum()), int(changed.sum()), last[todo]
+
+    def remove(self, doc_ids):
+        """
+        Tombstone passages and log it; they stop being returned immediately. Returns how many
+        were live.
+        """
+        positions = self.idmap.lookup(hash64(list(doc_ids)))
+        positions = np.unique(positions[positions >= 0])
+        if len(positions) == 0:
+            return 0
+        with self.lock:
+            ids = self.idmap.ids[positions]
+            self.idmap.tombstone(positions)
+            self.log.tombstone(ids)
+            self._update_selector()
+        return len(positions)
+
+    def compact(self):
+        """Physically remove the tombstoned vectors from the index and the id map."""
+        with self.lock:
+            tombstones = self.idmap.tombstones()
+            if len(tombstones):
+                self.index.remove_ids(faiss.IDSelectorBatch(tombstones))
+                self.idmap.compact()
+                self._update_selector()
+            return len(tombstones)
+
+    def save(self):
+        """Checkpoint: write the full index and id map, and truncate the update log."""
+        with self.lock:
+            tmp_path = self.index_path + '.tmp'
+            faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+            self.idmap.save(idmap_path(self.index_path))
+            self.log.clear()
@@ -0,0 +1,103 @@
+"""
+Prefetch of the passages about the POIs of a planned route.
+
+After a route is planned, the next question is often about one of its POIs ("tell me
+more about <POI>"). The Prefetcher retrieves the passages of every named POI of the
+route summary in one batch, queued on the model executor after the answer of the route,
+and stores them in a short-lived per-session PrefetchCache; an information request of the same session naming one of
+these POIs then skips the query encoding and the index search.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from .geo_filter import normalize
+
+
+def route_poi_names(route_summary, max_pois=20):
+    """Unique POI names of a route summary, in route order."""
+    names = []
+    for segment in route_summary.get('segments', []):
+        for types in segment.get('POIs', {}).values():
+            for value in types.values():
+                if isinstance(value, list):  # names; an int only counts unnamed POIs
+                    names += [name for name in value if name not in names]
+    return names[:max_pois]
+
+
+class PrefetchCache:
+    """
+    session id -> {normalized POI name: passages}, LRU over sessions with a TTL.
+    """
+
+    def __init__(self, max_sessions=1024, ttl_seconds=900):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()  # session id -> (expires, {name: passages})
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def put(self, session_id, passages_by_name):
+        entries = {' '.join(normalize(name)): passages for name, passages in passages_by_name.items()}
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic() + self.ttl_seconds, entries)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id, query):
+        """Passages of the longest prefetched POI name found in the query, or None."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._sessions[session_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(session_id)
+        text = f" {' '.join(normalize(query))} "
+        names = [name for name in entry[1] if name and f" {name} " in text]
+        with self._lock:
+            if not names:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry[1][max(names, key=len)]
+
+
+class Prefetcher:
+    """
+    Runs `retrieve(names) -> list of passage lists` on `executor`, the single worker that
+    runs every model stage: the encoder, its tokenizer and the index are never used by two
+    threads at once. Without an executor the retrieval runs in the calling thread.
+    """
+
+    def __init__(self, retrieve, cache=None, max_pois=20, executor=None):
+        self.retrieve = retrieve
+        self.cache = cache if cache is not None else PrefetchCache()
+        self.max_pois = max_pois
+        self.executor = executor
+
+    def _prefetch(self, session_id, names):
+        try:
+            self.cache.put(session_id, dict(zip(names, self.retrieve(names))))
+        except Exception as e:
+            print(f"Prefetch for session {session_id} failed: {e}")
+
+    def submit(self, session_id, route_summary):
+        """Schedule the prefetch of the route POIs; returns the future, or None if there is none."""
+        names = route_poi_names(route_summary, self.max_pois)
+        if session_id is None or not names:
+            return None
+        if self.executor is not None:
+            return self.executor.submit(self._prefetch, session_id, names)
+        future = Future()
+        self._prefetch(session_id, names)
+        future.set_result(None)
+        return future
@@ -0,0 +1,202 @@
+"""
+Corpus index split in N FAISS shards (see resources/sharded_index.py build), described by
+index_shards.json: shard files, global id offset of each shard and metric.
+
+ShardedIndex searches the shards of this process in a thread pool (FAISS releases the
+GIL while searching); RemoteShards sends the query to shard workers started with
+serve_shards, in local processes or on other machines. The workers exchange pickled
+messages, so they only accept clients holding their authkey, which has no default.
+Both merge the per-shard results
+in a global top-k and expose the faiss `search(x, k)` interface, so they can be passed
+to search_docs in place of a single index.
+"""
+import os
+import json
+import threading
+import time
+import numpy as np
+import faiss
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+
+def load_manifest(index_dir):
+    with open(os.path.join(index_dir, 'index_shards.json')) as f:
+        return json.load(f)
+
+def merge_topk(distances, indices, k, largest=True):
+    """
+    Global top-k from per-shard results, lists of (n_queries, k) arrays with global ids.
+    """
+    distances = np.hstack(distances)
+    indices = np.hstack(indices)
+    order = np.argsort(-distances if largest else distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+def _search_shard(index, offset, x, k):
+    distances, indices = index.search(x, k)
+    return distances, np.where(indices >= 0, indices + offset, -1)
+
+
+class ShardedIndex:
+
+    def __init__(self, index_dir, shard_ids=None, max_workers=None, nprobe=None):
+        manifest = load_manifest(index_dir)
+        shard_ids = range(len(manifest['shards'])) if shard_ids is None else shard_ids
+        self.largest = manifest['metric'] == 'IP'
+        self.shards = []
+        for shard_id in shard_ids:
+            index = faiss.read_index(os.path.join(index_dir, manifest['shards'][shard_id]))
+            if nprobe is not None and hasattr(index, 'nprobe'):
+                index.nprobe = nprobe
+            self.shards.append((index, manifest['offsets'][shard_id]))
+        self.ntotal = sum(index.ntotal for index, _ in self.shards)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or len(self.shards), thread_name_prefix="faiss-shard")
+
+    def search_shards(self, x, k):
+        """
+        Per-shard (distances, global ids), one pair per shard of this process.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        futures = [self.executor.submit(_search_shard, index, offset, x, k) for index, offset in self.shards]
+        return [future.result() for future in futures]
+
+    def search(self, x, k):
+        results = self.search_shards(x, k)
+        return merge_topk([d for d, _ in results], [i for _, i in results], k, largest=self.largest)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def check_authkey(authkey):
+    """
+    Shard workers unpickle what their clients send: anyone who can connect with the authkey
+    can run code in them. There is no default key, it must be given (RAGTRIP_SHARD_AUTHKEY).
+    """
+    if not authkey:
+        raise ValueError("Shard workers need an explicit authkey (RAGTRIP_SHARD_AUTHKEY), there is no default")
+    return authkey
+
+def _connect(address, authkey, timeout):
+    """
+    Connect to a shard worker, retrying for `timeout` seconds while it is still loading.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return Client(tuple(address), authkey=authkey)
+        except ConnectionRefusedError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.5)
+
+
+class RemoteShards:
+    """
+    Client of shard workers (serve_shards). The query is sent to every worker before
+    waiting for any answer, so the workers search in parallel.
+
+    A worker that does not answer within `search_timeout` seconds, or whose connection
+    broke, fails the search (ConnectionError) instead of blocking the caller; its
+    connection is dropped, so that no late answer is read by the next search, and
+    reopened on the next search.
+    """
+
+    def __init__(self, addresses, authkey, largest=True, timeout=0, search_timeout=30):
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey = check_authkey(authkey)
+        self.search_timeout = search_timeout
+        self.connections = [_connect(address, authkey, timeout) for address in self.addresses]
+        self.locks = [threading.Lock() for _ in self.connections]
+        self.largest = largest
+
+    def _drop(self, i):
+        connection, self.connections[i] = self.connections[i], None
+        if connection is not None:
+            connection.close()
+
+    def search(self, x, k):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            sent, failed = [], []
+            for i, address in enumerate(self.addresses):
+                try:
+                    if self.connections[i] is None:
+                        self.connections[i] = _connect(address, self.authkey, 0)
+                    self.connections[i].send((x, k))
+                    sent.append(i)
+                except (OSError, EOFError, AuthenticationError) as e:
+                    self._drop(i)
+                    failed.append(f"{address[0]}:{address[1]} {type(e).__name__}")
+            deadline = time.monotonic() + self.search_timeout
+            results = []
+            for i in sent:
+                address = self.addresses[i]
+                try:
+                    if self.connections[i].poll(max(0.0, deadline - time.monotonic())):
+                        results.append(self.connections[i].recv())
+                        continue
+                    failed.append(f"{address[0]}:{address[1]} timed out")
+                except (OSError, EOFError) as e:
+                    failed.append(f"{address[0]}:{address[1]} {type(e).__name__}")
+                self._drop(i)
+        finally:
+            for lock in self.locks:
+                lock.release()
+        if failed:
+            raise ConnectionError(f"Shard workers unavailable: {', '.join(failed)}")
+        distances, indices = [], []
+        for result in results:
+            for d, i in result:
+                distances.append(d)
+                indices.append(i)
+        return merge_topk(distances, indices, k, largest=self.largest)
+
+    def close(self):
+        for i in range(len(self.connections)):
+            self._drop(i)
+
+
+def _serve_connection(index, connection):
+    try:
+        while True:
+            x, k = connection.recv()
+            connection.send(index.search_shards(x, k))
+    except (EOFError, OSError):
+        pass
+    finally:
+        connection.close()
+
+def serve_shards(index_dir, shard_ids, address, authkey, max_workers=None):
+    """
+    Load the given shards and answer search requests on `address` (host, port) until killed.
+    Only clients holding `authkey` are served (see check_authkey).
+    """
+    check_authkey(authkey)
+    index = ShardedIndex(index_dir, shard_ids=shard_ids, max_workers=max_workers)
+    print(f"Serving shards {list(shard_ids)} ({index.ntotal} vectors) on {address[0]}:{address[1]}")
+    with Listener(tuple(address), authkey=authkey) as listener:
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_serve_connection, args=(index, connection), daemon=True).start()
+
+def spawn_local_workers(index_dir, n_workers, authkey, host='127.0.0.1', base_port=9100):
+    """
+    Start n_workers local processes, each serving a contiguous group of shards.
+    Returns (processes, addresses) for RemoteShards. A random authkey (os.urandom) is
+    enough for workers that only live as long as their parent.
+    """
+    n_shards = len(load_manifest(index_dir)['shards'])
+    groups = [list(group) for group in np.array_split(np.arange(n_shards), n_workers) if len(group)]
+    processes, addresses = [], []
+    for i, group in enumerate(groups):
+        address = (host, base_port + i)
+        process = Process(target=serve_shards, args=(index_dir, [int(s) for s in group], address, authkey), daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+    return processes, addresses
@@ -1,25 +1,114 @@
 
-import torch
+import os
+import json
+import time
 import numpy as np
-import faiss
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from contextvars import ContextVar
+# torch, transformers and faiss are imported by the functions that need them: RAGTrip and the
+# resources CLIs import this module for query_llm or the shard helpers, without loading them
 
-def embed_passages_snowflake(queries, model,tokenizer, max_length=512):
-    query_prefix = 'query: '    
+LLM_ID = os.environ.get("RAGTRIP_LLM_ID", "meta-llama/Llama-3.1-8B-Instruct")  # model of load_llm(None, ...)
+# time.monotonic() deadline of the request served by this thread (set by the ASGI server):
+# query_llm stops generating there instead of holding the model worker for a request already gone
+GENERATION_DEADLINE = ContextVar("ragtrip_generation_deadline", default=None)
+
+def embed_passages_snowflake(queries, model,tokenizer, max_length=512, query=True):
+    import torch
+    query_prefix = 'query: ' if query else ''
     tokenizer.pad_token = tokenizer.eos_token
     queries_with_prefix = ["{}{}".format(query_prefix, i) for i in queries]
     query_tokens = tokenizer(queries_with_prefix, padding=True, truncation=True, return_tensors='pt', max_length=max_length)
-    query_tokens = {k: v.to('cuda') for k, v in query_tokens.items()}
+    query_tokens = {k: v.to(model.device) for k, v in query_tokens.items()}
     with torch.no_grad():
         query_embeddings = model(**query_tokens)[0][:, 0]
     query_embeddings = torch.nn.functional.normalize(query_embeddings, p=2, dim=1)
     return query_embeddings.cpu().numpy()
 
-def search_docs(query, query_encoder, tokenizer, index, top_k):
-    
+class EmbeddingShards:
+    """
+    Passage embeddings as .npy shards (rows in index order, listed in shards.json),
+    memory-mapped: only the rows read for re-ranking are paged in.
+    """
+
+    def __init__(self, shards_dir):
+        with open(os.path.join(shards_dir, 'shards.json')) as f:
+            manifest = json.load(f)
+        self.shards = [np.load(os.path.join(shards_dir, name), mmap_mode='r') for name in manifest['shards']]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.dim = self.shards[0].shape[1]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get(self, ids):
+        """
+        float32 (len(ids), dim) embeddings of the given index positions.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, ids, side='right') - 1
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            positions = np.flatnonzero(shard_ids == shard_id)
+            rows = ids[positions] - self.offsets[shard_id]
+            order = np.argsort(rows)  # read each shard front to back
+            vectors[positions[order]] = self.shards[shard_id][rows[order]]
+        return vectors
+
+def rerank_exact(query_embeddings, candidate_indices, shards, top_k):
+    """
+    Re-rank first-stage candidates by exact inner product with their original embeddings.
+    Returns (scores, indices) of shape (n_queries, top_k), padded with -inf / -1.
+    """
+    scores = np.full((len(query_embeddings), top_k), -np.inf, dtype=np.float32)
+    indices = np.full((len(query_embeddings), top_k), -1, dtype=np.int64)
+    for i, (query, candidates) in enumerate(zip(query_embeddings, candidate_indices)):
+        candidates = candidates[candidates >= 0]
+        exact = shards.get(candidates) @ query
+        best = np.argsort(-exact)[:top_k]
+        scores[i, :len(best)] = exact[best]
+        indices[i, :len(best)] = candidates[best]
+    return scores, indices
+
+def search_with_selector(index, x, k, selector, nprobe=None):
+    """
+    Search only the ids accepted by a FAISS IDSelector. IVF indexes probe `nprobe` lists
+    (default: their own nprobe); distances are only computed for the selected ids.
+    """
+    import faiss
+    if hasattr(index, 'search_selected'):  # LiveIndex, combines it with its tombstones
+        return index.search_selected(x, k, selector, nprobe)
+    if isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe or index.nprobe)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(x, k, params=params)
+
+def search_docs(query, query_encoder, tokenizer, index, top_k, shards=None, candidates=100,
+                candidate_ids=None, exact_shards=None, nprobe=None):
+    """
+    Top-k passage positions for the query.
+    With `shards` (EmbeddingShards), `index` is a compressed first stage (e.g. IVF-PQ):
+    it returns `candidates` passages that are re-ranked exactly from the memory-mapped embeddings.
+    With `candidate_ids` (sorted ids), only those passages are searched: scored exactly from
+    `exact_shards` when they all have an embedding there, else through a FAISS IDSelector.
+    """
     query_embeddings = embed_passages_snowflake([query], query_encoder, tokenizer, max_length=512)
     query_embeddings = np.asarray(query_embeddings, dtype='float32').reshape(1, -1)
-    distances, indices = index.search(query_embeddings, top_k)
+    
+    search = index.search
+    if candidate_ids is not None:
+        if exact_shards is not None and candidate_ids[-1] < len(exact_shards):
+            distances, indices = rerank_exact(query_embeddings, candidate_ids[None, :], exact_shards, top_k)
+            return indices
+        import faiss
+        selector = faiss.IDSelectorBatch(candidate_ids)
+        search = lambda x, k: search_with_selector(index, x, k, selector, nprobe)
+    
+    if shards is None:
+        distances, indices = search(query_embeddings, top_k)
+    else:
+        _, candidate_indices = search(query_embeddings, max(candidates, top_k))
+        distances, indices = rerank_exact(query_embeddings, candidate_indices, shards, top_k)
 
     return indices
 
@@ -28,10 +117,11 @@ def get_corpus(indices, index_id, id_corpus):
     for idx in indices[0]:
         id_ = index_id.get(idx)
         doc = id_corpus.get(id_)
-        docs.append(doc)
+        if doc is not None:  # -1 padding when fewer than k live passages
+            docs.append(doc)
     return docs
 
-def query_llm(prompt, instruction, tokenizer, model, max_new_tokens=100, temperature=0.7, do_sample=True):
+def query_llm(prompt, instruction, tokenizer, model, max_new_tokens=100, temperature=0.7, do_sample=True, streamer=None):
         
     messages = [
     {"role": "system", "content": instruction},
@@ -46,6 +136,7 @@ def query_llm(prompt, instruction, tokenizer, model, max_new_tokens=100, tempera
 
     terminators = [tokenizer.eos_token_id]
     terminators.append(tokenizer.convert_tokens_to_ids("<|eot_id|>"))
+    deadline = GENERATION_DEADLINE.get()
 
     outputs = model.generate(
         input_ids,
@@ -53,7 +144,9 @@ def query_llm(prompt, instruction, tokenizer, model, max_new_tokens=100, tempera
         eos_token_id=terminators,
         do_sample=do_sample,
         temperature=temperature,
-        pad_token_id=tokenizer.eos_token_id
+        pad_token_id=tokenizer.eos_token_id,
+        streamer=streamer,
+        max_time=max(deadline - time.monotonic(), 0.01) if deadline is not None else None,
         #top_p=0.1,
     )
 
@@ -64,16 +157,68 @@ def query_llm(prompt, instruction, tokenizer, model, max_new_tokens=100, tempera
 
 def load_faiss_index(index_path):
     """Load a FAISS index from a file."""
+    import faiss
     print(f"Loading FAISS index from: {index_path}")
     index = faiss.read_index(index_path)
     print(f"Index loaded successfully with {index.ntotal} vectors.")
     return index
 
-def load_llm(model_name, cache_dir):
-    model_name = "meta-llama/Llama-3.1-8B-Instruct"
+def pin_cpu_threads(num_threads=None, cpu_cores=None):
+    """
+    Restrict the process to `cpu_cores` (list of core ids) and run torch's intra-op
+    parallelism on `num_threads` threads (default: one per allowed core). Decoding is
+    memory-bound, threads beyond the physical cores only contend for bandwidth.
+    """
+    import torch
+    if cpu_cores:
+        os.sched_setaffinity(0, cpu_cores)
+    torch.set_num_threads(num_threads or len(os.sched_getaffinity(0)))
+
+def quantization_config(quantization, device):
+    """
+    torchao weight-only quantization: int8 per-channel, or int4 in groups of 128 (packed
+    for the CPU kernels on device='cpu'). Activations stay in bf16.
+    """
+    if quantization is None:
+        return None
+    try:
+        import torchao  # noqa: F401
+        from transformers import TorchAoConfig
+    except ImportError as e:
+        raise ImportError("Quantized loading needs torchao: pip install torchao") from e
+    if quantization == 'int8':
+        return TorchAoConfig("int8_weight_only")
+    if device == 'cpu':
+        try:
+            from torchao.dtypes import Int4CPULayout
+        except ImportError as e:
+            raise ImportError("int4 on CPU needs a torchao build with Int4CPULayout (torchao>=0.8)") from e
+        return TorchAoConfig("int4_weight_only", group_size=128, layout=Int4CPULayout())
+    return TorchAoConfig("int4_weight_only", group_size=128)
+
+def load_llm(model_name, cache_dir, device='auto', quantization=None, num_threads=None, cpu_cores=None):
+    """
+    Tokenizer and model of `model_name` (None: LLM_ID, RAGTRIP_LLM_ID or Llama-3.1-8B-Instruct).
+
+    Args:
+        device: 'auto' spreads the bf16 weights over the available GPUs, 'cpu' loads them
+            in this process, memory-mapped from the safetensors files and placed layer by
+            layer (no full copy of the checkpoint in RAM).
+        quantization: None (bf16), 'int8' or 'int4' weight-only (see quantization_config).
+            About 16, 9 and 5.5 GB of weights.
+        num_threads, cpu_cores: CPU threads and cores of the model on device='cpu'
+            (see pin_cpu_threads).
+    """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    assert device in ['auto', 'cpu'], "Invalid device. Choose from ['auto', 'cpu']"
+    assert quantization in [None, 'int8', 'int4'], "Invalid quantization. Choose from [None, 'int8', 'int4']"
+    model_name = model_name or LLM_ID
 
     #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     #n_gpus = torch.cuda.device_count()
+    if device == 'cpu':
+        pin_cpu_threads(num_threads, cpu_cores)
 
     tokenizer = AutoTokenizer.from_pretrained(
         model_name,
@@ -85,8 +230,12 @@ def load_llm(model_name, cache_dir):
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
         torch_dtype=torch.bfloat16,
-        device_map="auto",
+        device_map=device,
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
+        quantization_config=quantization_config(quantization, device),
         cache_dir=cache_dir
     )
+    model.eval()
     model.generation_config.pad_token_id = tokenizer.pad_token_id
     return tokenizer, model
@@ -0,0 +1,125 @@
+#%%
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+from time import perf_counter
+from transformers.generation.streamers import BaseStreamer
+from ir_module.utils import LLM_ID, load_llm, query_llm
+from ir_module.RAG import SPATIAL_INSTRUCTION
+from RAGTrip import CLASSIFY_INSTRUCTION
+#%%
+CLASSIFY_QUERIES = [
+    "How do I walk from Notre-Dame to the Louvre, stopping for a coffee 10 minutes before arrival?",
+    "When was the Eiffel Tower built?",
+]
+
+class TokenTimer(BaseStreamer):
+    """
+    Streamer recording when generate() emits each new token (its first put() is the prompt).
+    """
+
+    def __init__(self):
+        self.times = []
+        self.prompt_seen = False
+
+    def put(self, value):
+        if self.prompt_seen:
+            self.times.append(perf_counter())
+        self.prompt_seen = True
+
+    def end(self):
+        pass
+
+def memory_mb():
+    """Current and peak resident set size of this process, in MB."""
+    with open('/proc/self/status') as f:
+        status = dict(line.split(':', 1) for line in f)
+    return int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+
+def time_generation(tokenizer, model, prompt, instruction, max_new_tokens):
+    """(time to first token in s, decode tokens/s, new tokens) of one greedy generation."""
+    timer = TokenTimer()
+    start = perf_counter()
+    query_llm(prompt, instruction, tokenizer, model, max_new_tokens=max_new_tokens, do_sample=False,
+              temperature=None, streamer=timer)
+    ttft = timer.times[0] - start
+    decode = timer.times[-1] - timer.times[0]
+    return ttft, (len(timer.times) - 1) / decode if decode > 0 else float('nan'), len(timer.times)
+
+def run(route_summary, model_name, device, quantization, num_threads, cpu_cores, max_new_tokens, repeats, cache_dir):
+    """
+    Load the LLM with one configuration and time the classification and route summarization prompts.
+    """
+    start = perf_counter()
+    tokenizer, model = load_llm(model_name, cache_dir, device=device, quantization=quantization,
+                                num_threads=num_threads, cpu_cores=cpu_cores)
+    load_s = perf_counter() - start
+    rss_loaded, _ = memory_mb()
+
+    with open(route_summary) as f:
+        prompts = {'classification': [(query, CLASSIFY_INSTRUCTION) for query in CLASSIFY_QUERIES],
+                   'summarization': [(json.dumps(json.load(f)), SPATIAL_INSTRUCTION)]}
+    time_generation(tokenizer, model, CLASSIFY_QUERIES[1], CLASSIFY_INSTRUCTION, 8)  # warm-up
+
+    report = {'model': model_name, 'config': quantization or 'bf16', 'device': device, 'load_s': round(load_s, 1),
+              'rss_loaded_mb': round(rss_loaded)}
+    for task, task_prompts in prompts.items():
+        runs = np.array([time_generation(tokenizer, model, prompt, instruction, max_new_tokens)
+                         for prompt, instruction in task_prompts for _ in range(repeats)])
+        report[f'{task}_ttft_s'] = round(float(np.median(runs[:, 0])), 3)
+        report[f'{task}_tokens_per_s'] = round(float(np.median(runs[:, 1])), 2)
+        report[f'{task}_new_tokens'] = int(np.median(runs[:, 2]))
+    report['rss_peak_mb'] = round(memory_mb()[1])
+    return report
+
+def compare(configs, args):
+    """
+    Run every configuration in its own process, so that RSS is not shared between them.
+    """
+    reports = []
+    for config in configs:
+        command = [sys.executable, '-m', 'resources.benchmark_llm', 'run', '--route_summary', args.route_summary,
+                   '--model', args.model, '--device', args.device, '--max_new_tokens', str(args.max_new_tokens), '--repeats', str(args.repeats)]
+        if config != 'bf16':
+            command += ['--quantization', config]
+        if args.num_threads:
+            command += ['--num_threads', str(args.num_threads)]
+        if args.cpu_cores:
+            command += ['--cpu_cores', args.cpu_cores]
+        if args.cache_dir:
+            command += ['--cache_dir', args.cache_dir]
+        src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run(command, check=True, capture_output=True, text=True, cwd=src_dir).stdout
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+        print(json.dumps(reports[-1]), flush=True)
+    return reports
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tokens/s, time to first token and RSS of the LLM loading configurations")
+    parser.add_argument('command', choices=['run', 'compare'])
+    parser.add_argument('--route_summary', type=str, required=True, help="Route summary JSON of the summarization prompt")
+    parser.add_argument('--model', type=str, default=LLM_ID, help="Default: RAGTRIP_LLM_ID, as the server")
+    parser.add_argument('--device', type=str, default='cpu', choices=['auto', 'cpu'])
+    parser.add_argument('--quantization', type=str, default=None, choices=['int8', 'int4'], help="run: quantization (default bf16)")
+    parser.add_argument('--configs', type=str, default='bf16,int8,int4', help="compare: configurations to run")
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--cpu_cores', type=str, default=None, help="Comma-separated core ids")
+    parser.add_argument('--max_new_tokens', type=int, default=128)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--cache_dir', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        cpu_cores = [int(c) for c in args.cpu_cores.split(',')] if args.cpu_cores else None
+        print(json.dumps(run(args.route_summary, args.model, args.device, args.quantization, args.num_threads, cpu_cores,
+                             args.max_new_tokens, args.repeats, args.cache_dir)))
+    else:
+        reports = compare(args.configs.split(','), args)
+        columns = list(reports[0])
+        print('\n' + ' | '.join(columns))
+        for report in reports:
+            print(' | '.join(str(report[column]) for column in columns))
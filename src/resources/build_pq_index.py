@@ -0,0 +1,79 @@
+#%%
+import os
+import argparse
+import json
+import faiss
+import numpy as np
+from time import time
+from resources.tools import (load_embeddings_from_folder, create_faiss_index_ivfpq, write_embedding_shards,
+                             index_size_bytes, recall_at_k)
+from ir_module.utils import EmbeddingShards, rerank_exact
+#%%
+def build(embeddings_folder, data_path, nlist, m, nbits, nprobe, shard_size):
+    """
+    Build the two-stage retrieval files under data_path: indexes/pq/snowflake_ivfpq.faiss
+    and embeddings/shards/ (same passage order as the IVF index).
+    """
+    embeddings = load_embeddings_from_folder(embeddings_folder)
+    os.makedirs(os.path.join(data_path, 'indexes', 'pq'), exist_ok=True)
+    create_faiss_index_ivfpq(embeddings, nlist=nlist, m=m, nbits=nbits, nprobe=nprobe,
+                             save_folder=os.path.join(data_path, 'indexes', 'pq', 'snowflake_ivfpq.faiss'))
+    write_embedding_shards(embeddings, os.path.join(data_path, 'embeddings', 'shards'), shard_size=shard_size)
+
+def evaluate(data_path, query_embeddings, top_k=5, candidates=(50, 100, 200)):
+    """
+    Recall@k of the two-stage search against the current IVF index, and RAM of both.
+    """
+    ivf_index = faiss.read_index(os.path.join(data_path, 'indexes', 'ivf', 'snowflake_ivf_6216.faiss'))
+    pq_index = faiss.read_index(os.path.join(data_path, 'indexes', 'pq', 'snowflake_ivfpq.faiss'))
+    shards = EmbeddingShards(os.path.join(data_path, 'embeddings', 'shards'))
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+
+    start = time()
+    _, reference = ivf_index.search(query_embeddings, top_k)
+    ivf_ms = (time() - start) * 1000 / len(query_embeddings)
+
+    report = {
+        'queries': len(query_embeddings),
+        'ivf_index_mb': index_size_bytes(ivf_index) / 2**20,
+        'pq_index_mb': index_size_bytes(pq_index) / 2**20,
+        'ivf_ms_per_query': ivf_ms,
+        'two_stage': [],
+    }
+    for n_candidates in candidates:
+        start = time()
+        _, candidate_indices = pq_index.search(query_embeddings, n_candidates)
+        _, indices = rerank_exact(query_embeddings, candidate_indices, shards, top_k)
+        report['two_stage'].append({
+            'candidates': n_candidates,
+            f'recall@{top_k}_vs_ivf': recall_at_k(reference, indices, k=top_k),
+            'ms_per_query': (time() - start) * 1000 / len(query_embeddings),
+        })
+    return report
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and evaluate the PQ + exact re-ranking retrieval")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--embeddings_folder', type=str, required=True, help="Folder of passage embedding .npy files")
+    build_parser.add_argument('--data_path', type=str, required=True)
+    build_parser.add_argument('--nlist', type=int, default=4096)
+    build_parser.add_argument('--m', type=int, default=64, help="PQ sub-quantizers (bytes per vector with nbits=8)")
+    build_parser.add_argument('--nbits', type=int, default=8)
+    build_parser.add_argument('--nprobe', type=int, default=32)
+    build_parser.add_argument('--shard_size', type=int, default=500000)
+
+    eval_parser = subparsers.add_parser('evaluate')
+    eval_parser.add_argument('--data_path', type=str, required=True)
+    eval_parser.add_argument('--query_embeddings', type=str, required=True, help=".npy of normalized query embeddings")
+    eval_parser.add_argument('--top_k', type=int, default=5)
+    eval_parser.add_argument('--candidates', type=int, nargs='+', default=[50, 100, 200])
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build(args.embeddings_folder, args.data_path, args.nlist, args.m, args.nbits, args.nprobe, args.shard_size)
+    else:
+        report = evaluate(args.data_path, np.load(args.query_embeddings), args.top_k, args.candidates)
+        print(json.dumps(report, indent=4))
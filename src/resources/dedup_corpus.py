@@ -0,0 +1,29 @@
+#%%
+import argparse
+import json
+import pandas as pd
+from resources.tools import get_texts_dedup
+#%%
+def write_passages(texts, ids, output_file):
+    """
+    id<TAB>text file (CAST2019collection.tsv columns, input of resources/ingest.py ingest).
+    Passage ids are the page id followed by the position of the passage in the page.
+    """
+    counts = {}
+    passage_ids = []
+    for page_id in ids:
+        counts[page_id] = counts.get(page_id, -1) + 1
+        passage_ids.append(f'{page_id}_{counts[page_id]}')
+    pd.DataFrame({'id': passage_ids, 'text': texts}).to_csv(output_file, sep='\t', index=False)
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Drop exact and near-duplicate passages of the parsed pages before embedding")
+    parser.add_argument('--parsed_folder', type=str, required=True, help="Folder of parsed JSON pages (get_texts)")
+    parser.add_argument('--output_file', type=str, required=True, help="TSV of the kept passages")
+    parser.add_argument('--threshold', type=float, default=0.8, help="Word 3-gram Jaccard similarity of near-duplicates")
+    args = parser.parse_args()
+
+    texts, ids, report = get_texts_dedup(args.parsed_folder, threshold=args.threshold)
+    write_passages(texts, ids, args.output_file)
+    print(json.dumps(report, indent=4))
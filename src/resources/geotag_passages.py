@@ -0,0 +1,77 @@
+#%%
+import os
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from time import time
+from ir_module.geo_filter import Gazetteer, GeoGrid, geotag
+from ir_module.live_index import IdMap, UpdateLog, idmap_path, log_path
+#%%
+INDEX_PATH = 'indexes/ivf/snowflake_ivf_6216.faiss'
+
+def index_passages(data_path):
+    """
+    (faiss id, text) of the indexed passages, through the id map of the live index if
+    there is one (resources/ingest.py migrate), else CAST2019_ID_Mapping.tsv.
+    """
+    corpus = pd.read_csv(os.path.join(data_path, 'data/CAST2019collection.tsv'), sep='\t')
+    id_corpus = dict(zip(corpus.id.astype(str), corpus.text.astype(str)))
+    ingested = os.path.join(data_path, 'data/ingested.tsv')
+    if os.path.exists(ingested):
+        ingested = pd.read_csv(ingested, sep='\t')
+        id_corpus.update(zip(ingested.id.astype(str), ingested.text.astype(str)))
+
+    if os.path.exists(idmap_path(os.path.join(data_path, INDEX_PATH))):
+        index_path = os.path.join(data_path, INDEX_PATH)
+        idmap = IdMap.load(idmap_path(index_path), UpdateLog(log_path(index_path)))
+        for position in np.flatnonzero(idmap.alive):
+            text = id_corpus.get(idmap.doc_id(position))
+            if text is not None:
+                yield int(idmap.ids[position]), text
+    else:
+        id_mapping = pd.read_csv(os.path.join(data_path, 'data/CAST2019_ID_Mapping.tsv'), sep='\t')
+        for faiss_id, doc_id in zip(id_mapping.index, id_mapping.id.astype(str)):
+            text = id_corpus.get(doc_id)
+            if text is not None:
+                yield int(faiss_id), text
+
+def build_gazetteer(snapshot_dir, places_file=None, min_chars=5, max_spread_m=500):
+    """
+    Place names of the city warm-up snapshot (named OSM POIs, geocoded landmarks), plus an
+    optional JSON {name: [lat, lon]} of extra places.
+    """
+    from spatial_module.warmup import CitySnapshot
+
+    snapshot = CitySnapshot(snapshot_dir)
+    names, lats, lons = snapshot.named_places()
+    if places_file is not None:
+        with open(places_file) as f:
+            extra = json.load(f)
+        names = list(names) + list(extra)
+        lats = np.concatenate([lats, [lat for lat, _ in extra.values()]])
+        lons = np.concatenate([lons, [lon for _, lon in extra.values()]])
+    return Gazetteer.from_places(names, lats, lons, min_chars=min_chars, max_spread_m=max_spread_m,
+                                 city=snapshot.manifest['city'])
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Link the indexed passages to the places they name (geo-partitioned retrieval)")
+    parser.add_argument('--data_path', type=str, required=True)
+    parser.add_argument('--snapshot_dir', type=str, required=True, help="City warm-up snapshot (spatial_module/warmup.py)")
+    parser.add_argument('--places', type=str, default=None, help="Optional JSON {name: [lat, lon]} of extra places")
+    parser.add_argument('--min_chars', type=int, default=5, help="Shorter place names are ignored")
+    parser.add_argument('--cell_deg', type=float, default=0.005, help="Grid cell size in degrees")
+    args = parser.parse_args()
+
+    geo_dir = os.path.join(args.data_path, 'geo')
+    os.makedirs(geo_dir, exist_ok=True)
+    gazetteer = build_gazetteer(args.snapshot_dir, args.places, min_chars=args.min_chars)
+    gazetteer.save(os.path.join(geo_dir, 'gazetteer.json'))
+    print(f'Gazetteer of {len(gazetteer)} places')
+
+    start = time()
+    passages = list(index_passages(args.data_path))
+    ids, lats, lons = geotag(passages, gazetteer)
+    GeoGrid(ids, lats, lons, cell_deg=args.cell_deg).save(os.path.join(geo_dir, 'passages.npz'))
+    print(f'{len(np.unique(ids))}/{len(passages)} passages geotagged ({len(ids)} locations) in {time() - start:.1f} s')
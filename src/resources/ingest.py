@@ -0,0 +1,70 @@
+#%%
+import os
+import argparse
+import pandas as pd
+from time import time
+from ir_module.live_index import LiveIndex
+from ir_module.RAG import RAG
+#%%
+INDEX_PATH = 'indexes/ivf/snowflake_ivf_6216.faiss'
+
+def migrate(data_path):
+    """
+    One-off: write the id map of the current IVF index from CAST2019_ID_Mapping.tsv
+    (row order of the index) and the collection texts (fingerprints for change detection).
+    """
+    id_mapping = pd.read_csv(os.path.join(data_path, 'data/CAST2019_ID_Mapping.tsv'), sep='\t')
+    corpus = pd.read_csv(os.path.join(data_path, 'data/CAST2019collection.tsv'), sep='\t')
+    texts = corpus.drop_duplicates('id', keep='last').set_index('id').text.reindex(id_mapping.id).fillna('')
+    live = LiveIndex.migrate(os.path.join(data_path, INDEX_PATH), list(id_mapping.id.astype(str)), list(texts.astype(str)))
+    print(f'Id map of {live.ntotal} passages written next to {INDEX_PATH}')
+
+def read_passages(path):
+    """id<TAB>text file, same columns as CAST2019collection.tsv."""
+    passages = pd.read_csv(path, sep='\t')
+    return list(passages.id.astype(str)), list(passages.text.astype(str))
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental updates of the IVF index with explicit ids")
+    parser.add_argument('--data_path', type=str, required=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('migrate', help="Write the id map of the current index (once)")
+
+    ingest_parser = subparsers.add_parser('ingest', help="Add new and changed passages")
+    ingest_parser.add_argument('--passages', type=str, required=True, help="TSV with id and text columns")
+    ingest_parser.add_argument('--encoder_id', type=str, default="Snowflake/snowflake-arctic-embed-l-v2.0")
+    ingest_parser.add_argument('--cache_dir', type=str, default=None)
+
+    remove_parser = subparsers.add_parser('remove', help="Tombstone passages")
+    remove_parser.add_argument('--ids', type=str, required=True, help="File with one doc id per line")
+
+    subparsers.add_parser('checkpoint', help="Write the full index and id map, clearing the update log")
+    subparsers.add_parser('compact', help="Drop the tombstoned vectors from the index (and checkpoint)")
+
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        migrate(args.data_path)
+    elif args.command == 'ingest':
+        doc_ids, texts = read_passages(args.passages)
+        rag = RAG(args.data_path, args.cache_dir, args.encoder_id, None, None)
+        start = time()
+        added, replaced = rag.ingest(doc_ids, texts)
+        print(f'{len(doc_ids)} passages: {added} added, {replaced} replaced, '
+              f'{len(doc_ids) - added - replaced} unchanged in {time() - start:.1f} s')
+    elif args.command == 'remove':
+        with open(args.ids) as f:
+            doc_ids = [line.strip() for line in f if line.strip()]
+        live = LiveIndex(os.path.join(args.data_path, INDEX_PATH))
+        removed = live.remove(doc_ids)
+        print(f'{removed} passages tombstoned')
+    elif args.command == 'checkpoint':
+        live = LiveIndex(os.path.join(args.data_path, INDEX_PATH))
+        live.save()
+        print(f'Index and id map of {live.ntotal} passages written, update log cleared')
+    else:
+        live = LiveIndex(os.path.join(args.data_path, INDEX_PATH))
+        removed = live.compact()
+        live.save()
+        print(f'{removed} vectors removed, {live.ntotal} left')
@@ -0,0 +1,87 @@
+#%%
+import os
+import argparse
+import json
+import numpy as np
+from time import time
+from resources.tools import create_faiss_index_shards, recall_at_k
+from ir_module.utils import load_faiss_index
+from ir_module.sharded_index import ShardedIndex, RemoteShards, serve_shards, spawn_local_workers
+#%%
+def build(data_path, factory, nprobe):
+    """
+    Build data_path/indexes/shards/ from the embedding shards in data_path/embeddings/shards
+    (resources/build_pq_index.py build, or tools.write_embedding_shards).
+    """
+    create_faiss_index_shards(os.path.join(data_path, 'embeddings', 'shards'),
+                              os.path.join(data_path, 'indexes', 'shards'), factory=factory, nprobe=nprobe)
+
+def evaluate(data_path, query_embeddings, top_k=5, workers=0):
+    """
+    Recall@k and latency of the sharded search against the monolithic IVF index,
+    in this process (thread pool) and, with workers > 0, over local worker processes.
+    """
+    index_dir = os.path.join(data_path, 'indexes', 'shards')
+    query_embeddings = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+    monolithic = load_faiss_index(os.path.join(data_path, 'indexes', 'ivf', 'snowflake_ivf_6216.faiss'))
+
+    def timed_search(index):
+        start = time()
+        indices = np.vstack([index.search(q[None, :], top_k)[1] for q in query_embeddings])
+        return indices, (time() - start) * 1000 / len(query_embeddings)
+
+    reference, monolithic_ms = timed_search(monolithic)
+    report = {'queries': len(query_embeddings), 'monolithic_ms_per_query': monolithic_ms}
+
+    sharded = ShardedIndex(index_dir)
+    indices, ms = timed_search(sharded)
+    report['threads'] = {'shards': len(sharded.shards), f'recall@{top_k}_vs_ivf': recall_at_k(reference, indices, k=top_k),
+                         'ms_per_query': ms}
+    sharded.close()
+
+    if workers:
+        authkey = os.urandom(16)  # the workers only serve this run
+        processes, addresses = spawn_local_workers(index_dir, workers, authkey)
+        remote = RemoteShards(addresses, authkey, timeout=300)  # workers load their shards before listening
+        indices, ms = timed_search(remote)
+        report['processes'] = {'workers': len(processes), f'recall@{top_k}_vs_ivf': recall_at_k(reference, indices, k=top_k),
+                               'ms_per_query': ms}
+        remote.close()
+        for process in processes:
+            process.terminate()
+    return report
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build, serve and evaluate the sharded corpus index")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('--data_path', type=str, required=True)
+    build_parser.add_argument('--factory', type=str, default="IVF1024,Flat", help="FAISS index_factory string of every shard")
+    build_parser.add_argument('--nprobe', type=int, default=32)
+
+    serve_parser = subparsers.add_parser('serve', help="Serve some shards from this process (RAGTRIP_SHARD_WORKERS on the client)")
+    serve_parser.add_argument('--data_path', type=str, required=True)
+    serve_parser.add_argument('--shards', type=int, nargs='+', required=True)
+    serve_parser.add_argument('--host', type=str, default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=9100)
+    serve_parser.add_argument('--authkey', type=str, default=os.environ.get("RAGTRIP_SHARD_AUTHKEY"),
+                              help="Shared secret of the clients (default RAGTRIP_SHARD_AUTHKEY, required)")
+
+    eval_parser = subparsers.add_parser('evaluate')
+    eval_parser.add_argument('--data_path', type=str, required=True)
+    eval_parser.add_argument('--query_embeddings', type=str, required=True, help=".npy of normalized query embeddings")
+    eval_parser.add_argument('--top_k', type=int, default=5)
+    eval_parser.add_argument('--workers', type=int, default=0, help="Also evaluate over this many local worker processes")
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build(args.data_path, args.factory, args.nprobe)
+    elif args.command == 'serve':
+        if not args.authkey:
+            parser.error("serve needs --authkey or RAGTRIP_SHARD_AUTHKEY: clients send pickles, anyone with the key can run code")
+        serve_shards(os.path.join(args.data_path, 'indexes', 'shards'), args.shards, (args.host, args.port), args.authkey.encode())
+    else:
+        report = evaluate(args.data_path, np.load(args.query_embeddings), args.top_k, args.workers)
+        print(json.dumps(report, indent=4))
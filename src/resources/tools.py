@@ -80,11 +80,30 @@ def get_texts(files_path):
                 ids += ([key]*len(html[key]['texts']))
     return texts, ids
 
+'''
+### Define function to get the texts without exact and near-duplicate passages (MinHash/LSH) ###
+### Run before embedding: duplicates cost embedding compute, index memory and retrieval slots ###
+### The report counts passages and whitespace tokens before and after ###
+'''
+
+def get_texts_dedup(files_path, threshold=0.8):
+    from ir_module.dedup import dedup_passages
+    texts, ids = get_texts(files_path)
+    keep = dedup_passages(texts, threshold=threshold)
+    tokens_before = sum(len(text.split()) for text in texts)
+    kept_texts, kept_ids = [texts[i] for i in keep], [ids[i] for i in keep]
+    tokens_after = sum(len(text.split()) for text in kept_texts)
+    report = {
+        'passages': len(texts), 'kept': len(kept_texts),
+        'reduction': 1 - len(kept_texts) / len(texts) if texts else 0.0,
+        'tokens': tokens_before, 'tokens_kept': tokens_after,
+        'token_reduction': 1 - tokens_after / tokens_before if tokens_before else 0.0,
+    }
+    return kept_texts, kept_ids, report
 
 
 
 
-  
 '''
 ### Define function to embed a list of passages using a model and a tokenizer ###
 '''
@@ -153,6 +172,85 @@ def create_faiss_index_flat(embeddings, save_folder = None,type_index = 'IP'):
     return faiss_index
 
 
+'''
+### Define function to create a compressed IVF-PQ index (first stage of the two-stage retrieval) ###
+### m sub-quantizers of nbits each: m * nbits / 8 bytes per vector instead of 4 * dim ###
+### The index is trained on a random sample of train_size embeddings ###
+'''
+
+def create_faiss_index_ivfpq(embeddings, nlist=4096, m=64, nbits=8, nprobe=32, train_size=200000, save_folder=None, batch_size=100000):
+    dim = embeddings.shape[1]
+    faiss_index = faiss.index_factory(dim, f"IVF{nlist},PQ{m}x{nbits}", faiss.METRIC_INNER_PRODUCT)
+    
+    sample = np.random.default_rng(0).choice(len(embeddings), size=min(train_size, len(embeddings)), replace=False)
+    print(f'Training IVF{nlist},PQ{m}x{nbits} on {len(sample)} vectors')
+    faiss_index.train(np.ascontiguousarray(embeddings[np.sort(sample)], dtype=np.float32))
+    
+    for start in tqdm(range(0, len(embeddings), batch_size)):
+        faiss_index.add(np.ascontiguousarray(embeddings[start:start + batch_size], dtype=np.float32))
+    faiss_index.nprobe = nprobe
+    print(f'Index created with {faiss_index.ntotal} vectors, {m * nbits // 8} bytes per code')
+    
+    if save_folder is not None:
+        print(f'Saving index to {save_folder}')
+        faiss.write_index(faiss_index, save_folder)
+    return faiss_index
+
+'''
+### Define function to write the embeddings as float32 .npy shards for memory-mapped re-ranking ###
+### Row i of the concatenated shards is the vector i of the index ###
+'''
+
+def write_embedding_shards(embeddings, shards_dir, shard_size=500000):
+    os.makedirs(shards_dir, exist_ok=True)
+    names = []
+    for i, start in enumerate(tqdm(range(0, len(embeddings), shard_size))):
+        name = f'shard_{i:03d}.npy'
+        np.save(os.path.join(shards_dir, name), np.asarray(embeddings[start:start + shard_size], dtype=np.float32))
+        names.append(name)
+    with open(os.path.join(shards_dir, 'shards.json'), 'w') as f:
+        json.dump({'shards': names, 'count': len(embeddings), 'dim': int(embeddings.shape[1])}, f, indent=4)
+    return names
+
+'''
+### Define function to build one FAISS index per embedding shard (see write_embedding_shards) ###
+### Vector j of index shard i is the passage offsets[i] + j of the corpus ###
+### The layout is described in index_shards.json, read by ir_module/sharded_index.py ###
+'''
+
+def create_faiss_index_shards(shards_dir, index_dir, factory="Flat", nprobe=None, train_size=200000):
+    with open(os.path.join(shards_dir, 'shards.json')) as f:
+        layout = json.load(f)
+    os.makedirs(index_dir, exist_ok=True)
+    names, offsets, offset = [], [], 0
+    for i, shard in enumerate(tqdm(layout['shards'])):
+        embeddings = np.load(os.path.join(shards_dir, shard), mmap_mode='r')
+        faiss_index = faiss.index_factory(layout['dim'], factory, faiss.METRIC_INNER_PRODUCT)
+        if not faiss_index.is_trained:
+            sample = np.random.default_rng(i).choice(len(embeddings), size=min(train_size, len(embeddings)), replace=False)
+            faiss_index.train(np.ascontiguousarray(embeddings[np.sort(sample)], dtype=np.float32))
+        faiss_index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+        if nprobe is not None:
+            faiss.ParameterSpace().set_index_parameter(faiss_index, 'nprobe', nprobe)
+        name = f'index_{i:03d}.faiss'
+        faiss.write_index(faiss_index, os.path.join(index_dir, name))
+        names.append(name)
+        offsets.append(offset)
+        offset += faiss_index.ntotal
+    with open(os.path.join(index_dir, 'index_shards.json'), 'w') as f:
+        json.dump({'shards': names, 'offsets': offsets, 'count': offset, 'metric': 'IP', 'factory': factory}, f, indent=4)
+    print(f'{len(names)} index shards with {offset} vectors written to {index_dir}')
+    return names
+
+def index_size_bytes(index):
+    """Serialized size of a FAISS index, i.e. the RAM it takes once loaded."""
+    return faiss.serialize_index(index).nbytes
+
+def recall_at_k(reference_indices, indices, k=5):
+    """Mean overlap between the top-k of a reference search and another search."""
+    overlap = [len(set(ref[:k]) & set(res[:k])) / k for ref, res in zip(reference_indices, indices)]
+    return float(np.mean(overlap))
+
 
 """
 Receives a list of strings for a 'bad' line.
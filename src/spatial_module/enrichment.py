@@ -1,46 +1,63 @@
 
 import geopandas as gpd
 import pandas as pd
-import osmnx as ox
+import numpy as np
+import os
+from .metrics import POI_FETCH, SJOIN, timed
+
+
+def load_osmnx():
+    """
+    osmnx, imported on the first Overpass query or graph download rather than with the
+    module (it takes seconds, and is not needed when the warm-up snapshot covers the area).
+    """
+    import osmnx as ox
+    # Overridable to point the POI queries at a local server, e.g. the load-test stubs
+    if os.environ.get("RAGTRIP_OVERPASS_URL"):
+        ox.settings.overpass_endpoint = os.environ["RAGTRIP_OVERPASS_URL"]
+        ox.settings.overpass_rate_limit = False
+    return ox
+
+POI_CATEGORY_MAPPING = {
+    "art_centre": "tourism",
+    "bakery": "amenity",
+    "bar": "amenity",
+    "biergarten": "amenity",
+    "bench": "amenity",
+    "books": "shop",
+    "cafe": "amenity",
+    "castle": "tourism",
+    "cinema": "amenity",
+    "church": "place_of_worship",
+    "clothes": "shop",
+    "convenience": "shop",
+    "dance": "leisure",
+    "drinking_water": "amenity",
+    "fast_food": "amenity",
+    "fountain": "amenity",
+    "gallery": "tourism",
+    "garden": "leisure",
+    "ice_cream": "amenity",
+    "information": "tourism",
+    "monument": "tourism",
+    "museum": "tourism",
+    "nature_reserve": "leisure",
+    "nightclub": "amenity",
+    "park": "leisure",
+    "pitch": "leisure",
+    "place_of_worship": "place_of_worship",
+    "pub": "amenity",
+    "restaurant": "amenity",
+    "shop": "shop",
+    "sports_centre": "leisure",
+    "stadium": "leisure",
+    "supermarket": "shop",
+    "temple": "place_of_worship",
+    "toilets": "amenity"
+}
 
 def categorize_pois(poi_list):
-    mapping = {
-        "art_centre": "tourism",
-        "bakery": "amenity",
-        "bar": "amenity",
-        "biergarten": "amenity",
-        "bench": "amenity",
-        "books": "shop",
-        "cafe": "amenity",
-        "castle": "tourism",
-        "cinema": "amenity",
-        "church": "place_of_worship",
-        "clothes": "shop",
-        "convenience": "shop",
-        "dance": "leisure",
-        "drinking_water": "amenity",
-        "fast_food": "amenity",
-        "fountain": "amenity",
-        "gallery": "tourism",
-        "garden": "leisure",
-        "ice_cream": "amenity",
-        "information": "tourism",
-        "monument": "tourism",
-        "museum": "tourism",
-        "nature_reserve": "leisure",
-        "nightclub": "amenity",
-        "park": "leisure",
-        "pitch": "leisure",
-        "place_of_worship": "place_of_worship",
-        "pub": "amenity",
-        "restaurant": "amenity",
-        "shop": "shop",
-        "sports_centre": "leisure",
-        "stadium": "leisure",
-        "supermarket": "shop",
-        "temple": "place_of_worship",
-        "toilets": "amenity"
-    }
+    mapping = POI_CATEGORY_MAPPING
 
     categorized = {}
     for poi in poi_list:
@@ -51,14 +68,23 @@ def categorize_pois(poi_list):
             categorized.setdefault("unknown", []).append(poi)
     return categorized
 
-def pois(polygon, tags):
+@timed(POI_FETCH)
+def pois(polygon, tags, extra_columns=()):
     """
     Get the green areas within a polygon using OSMnx.
+    Served from the warm-up snapshot when it covers the polygon.
+    `extra_columns` are other OSM tags to keep when the POIs have them (e.g. alias names).
     """
+    from .warmup import active_snapshot
+    snapshot = active_snapshot()
+    if snapshot is not None and snapshot.covers(polygon):
+        return snapshot.pois(polygon, tags, extra_columns)
+
     # Get the green areas within the polygon
-    gdf = ox.geometries_from_polygon(polygon, tags=tags)
+    gdf = load_osmnx().geometries_from_polygon(polygon, tags=tags)
 
     cols = [col for col in gdf.columns if col in tags.keys()]
+    cols += [col for col in extra_columns if col in gdf.columns and col not in cols]
     cols.append('name')
     cols.append('geometry')
     
@@ -70,10 +96,22 @@ def pois(polygon, tags):
     
     return gdf  
 
-def add_pois_areas_to_gdf(gdf, pois_gdf, distance=100):
+@timed(SJOIN)
+def add_pois_areas_to_gdf(gdf, pois_gdf, distance=100, method='buffer', metric_crs=None, keep_buffer=True):
     """
     Add green areas to a GeoDataFrame.
+
+    method='buffer' buffers every segment in EPSG:3857 and joins the POIs intersecting
+    the buffer. method='dwithin' skips the buffer polygons and queries the POI spatial
+    index for geometries within `distance` meters of each segment line, in a local
+    metric CRS (UTM zone of the data unless `metric_crs` is given; use "EPSG:3857" to
+    reproduce the 'buffer' results), and adds the POI distance in 'distance_m'.
+    With keep_buffer=False the 'buffer' column is not built on the 'dwithin' path.
     """
+    assert method in ['buffer', 'dwithin'], "Invalid method. Choose from ['buffer', 'dwithin']"
+
+    if method == 'dwithin':
+        return add_pois_within_distance(gdf, pois_gdf, distance=distance, metric_crs=metric_crs, keep_buffer=keep_buffer)
 
     gdf = gdf.to_crs("EPSG:3857")
     pois_gdf = pois_gdf.to_crs("EPSG:3857")
@@ -83,6 +121,37 @@ def add_pois_areas_to_gdf(gdf, pois_gdf, distance=100):
     
     return routes_gdf
 
+def add_pois_within_distance(gdf, pois_gdf, distance=100, metric_crs=None, keep_buffer=False):
+    """
+    Left join of segments and POIs closer than `distance` meters, via a dwithin
+    query on the POI spatial index. Same rows and columns as the buffer sjoin
+    (segment index preserved, 'index_right'), plus 'distance_m'.
+    """
+    if metric_crs is None:
+        metric_crs = gdf.estimate_utm_crs()
+
+    gdf = gdf.to_crs("EPSG:4326")
+    segments_m = gdf.geometry.to_crs(metric_crs)
+    pois_m = pois_gdf.geometry.to_crs(metric_crs)
+
+    seg_idx, poi_idx = pois_m.sindex.query(segments_m, predicate='dwithin', distance=distance)
+    distances = segments_m.iloc[seg_idx].distance(pois_m.iloc[poi_idx], align=False)
+
+    pairs = pd.DataFrame(pois_gdf.drop(columns=pois_gdf.geometry.name)).iloc[poi_idx].reset_index(drop=True)
+    pairs.insert(0, 'index_right', pois_gdf.index[poi_idx])
+    pairs['distance_m'] = distances.to_numpy()
+    pairs['_segment_pos'] = seg_idx
+
+    left = gdf.copy()
+    if keep_buffer:
+        left['buffer'] = gpd.GeoSeries(segments_m.buffer(distance), crs=metric_crs).to_crs("EPSG:4326")
+    left['_segment_pos'] = np.arange(len(left))
+
+    routes_gdf = left.join(pairs.set_index('_segment_pos'), on='_segment_pos', how='left', lsuffix='_left', rsuffix='_right')
+    routes_gdf = routes_gdf.drop(columns='_segment_pos')
+    
+    return gpd.GeoDataFrame(routes_gdf, geometry=gdf.geometry.name, crs="EPSG:4326")
+
 def aggregate_segment_pois_by_type(seg_df, detailed_categories=["tourism"]):
     # Simple categories: we ignore name and record the type directly.
     # simple_categories = ["highway", "footway", "wheelchair"]
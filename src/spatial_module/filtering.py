@@ -1,4 +1,5 @@
 import re
+from bisect import bisect_right
 
 def extract_number(s):
     match = re.search(r'\d+(\.\d+)?', s)
@@ -50,3 +51,25 @@ def filter_segments(route_json, time_constraint_str, distance_constraint_str, or
         "time_to_walk_tot_min": route_json.get("time_to_walk_tot_min"),
         "segments": updated_segments
     }
+
+def constraint_cutoff(cumulative, limit):
+    """
+    Index of the first segment beyond `limit` in a non-decreasing cumulative array.
+    """
+    return len(cumulative) if limit is None else bisect_right(cumulative, limit)
+
+def filter_segments_sorted(route_json, time_limit, distance_limit, cumulative_time, cumulative_distance):
+    """
+    Same result as filter_segments for already parsed limits, using a binary search
+    over the cumulative time/distance arrays of the route. The input route is not
+    modified, so it can be filtered again with other limits.
+    """
+    cutoff = min(constraint_cutoff(cumulative_time, time_limit), constraint_cutoff(cumulative_distance, distance_limit))
+    
+    segments = route_json.get("segments", [])
+    updated_segments = [dict(segment) for segment in segments[:cutoff]]
+    updated_segments += [dict(segment, POIs={}) for segment in segments[cutoff:]]
+
+    print(f"Processed {len(updated_segments)} segments. Time limit={time_limit}, Distance limit={distance_limit}")
+
+    return dict(route_json, segments=updated_segments)
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from .metrics import GEOCODE, STAGE_ERRORS
+
+# Overridable to point the geocoding at a local server, e.g. the load-test stubs
+NOMINATIM_URL = os.environ.get("RAGTRIP_NOMINATIM_URL", "https://nominatim.openstreetmap.org")
+NOMINATIM_MIN_DELAY_S = float(os.environ.get("RAGTRIP_NOMINATIM_MIN_DELAY_S", 1.0))
+GEOCODE_CACHE_SIZE = int(os.environ.get("RAGTRIP_GEOCODE_CACHE_SIZE", 4096))
+
+
+class RateLimitedGeocoder:
+    """
+    Nominatim client shared by the whole process.
+
+    Requests can be submitted from many threads: their start times are spaced by
+    `min_delay_seconds` (Nominatim usage policy is one request per second) while
+    the network latency of different requests overlaps. Results, including misses,
+    are cached by query in an LRU of `max_entries` queries.
+    """
+
+    def __init__(self, user_agent="my_app", min_delay_seconds=NOMINATIM_MIN_DELAY_S, timeout=10, url=NOMINATIM_URL,
+                 max_entries=GEOCODE_CACHE_SIZE):
+        from geopy.geocoders import Nominatim
+        url = urlsplit(url)
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout, domain=url.netloc, scheme=url.scheme)
+        self.min_delay_seconds = min_delay_seconds
+        self._next_slot = 0.0
+        self._slot_lock = threading.Lock()
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _wait_for_slot(self):
+        with self._slot_lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_delay_seconds
+        if slot > now:
+            time.sleep(slot - now)
+
+    def geocode(self, query):
+        with self._cache_lock:
+            if query in self._cache:
+                self._cache.move_to_end(query)
+                return self._cache[query]
+
+        start = time.perf_counter()
+        self._wait_for_slot()
+        try:
+            location = self.geolocator.geocode(query)
+        except Exception:
+            STAGE_ERRORS.inc("geocode")
+            raise
+        finally:
+            GEOCODE.observe(time.perf_counter() - start)
+
+        with self._cache_lock:
+            self._store({query: location})
+        return location
+
+    def _store(self, locations):
+        for query, location in locations.items():
+            self._cache[query] = location
+            self._cache.move_to_end(query)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def seed(self, locations):
+        """
+        Pre-fill the cache with {query: location or None}, e.g. from a warm-up snapshot.
+        """
+        with self._cache_lock:
+            self._store(locations)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def geocode_many(self, queries, max_workers=4):
+        """
+        Geocode several queries concurrently. Returns {query: location or None};
+        failed requests are reported as None.
+        """
+        queries = list(dict.fromkeys(queries))
+
+        def safe_geocode(query):
+            try:
+                return self.geocode(query)
+            except Exception as e:
+                print(f"Geocoding failed for {query}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            locations = list(executor.map(safe_geocode, queries))
+        return dict(zip(queries, locations))
+
+
+_GEOCODER = None
+_GEOCODER_LOCK = threading.Lock()
+
+def get_geocoder():
+    """
+    Lazily created process-wide RateLimitedGeocoder.
+    """
+    global _GEOCODER
+    if _GEOCODER is None:
+        with _GEOCODER_LOCK:
+            if _GEOCODER is None:
+                _GEOCODER = RateLimitedGeocoder()
+    return _GEOCODER
@@ -0,0 +1,287 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from shapely.geometry import Point, box
+from .enrichment import categorize_pois, pois, load_osmnx
+from .geocoding import get_geocoder
+from .warmup import active_snapshot
+
+WALKING_SPEED_M_MIN = 83  # same walking speed as the route summaries (~1.39 m/s)
+
+
+def candidate_pois(pois_gdf, requested_types, start_point, end_point, max_per_type=10):
+    """
+    Keep, for every requested POI type, the `max_per_type` POIs with the smallest
+    straight-line detour between start and end. Returns one row per (POI, type)
+    with a 'poi_type' column and a Point geometry.
+    """
+    pois_gdf = pois_gdf.to_crs("EPSG:4326")
+    points = pois_gdf.geometry.representative_point()
+
+    # Straight-line detour in degrees is enough to rank the candidates
+    detour = points.distance(start_point) + points.distance(end_point)
+
+    candidates = []
+    for poi_type in requested_types:
+        category = categorize_pois([poi_type])
+        category = next(iter(category))
+        if category not in pois_gdf.columns:
+            continue
+        if category == "shop" and poi_type == "shop":
+            mask = pois_gdf[category].notnull()
+        else:
+            mask = pois_gdf[category] == poi_type
+
+        best = detour[mask].sort_values().index[:max_per_type]
+        selected = pois_gdf.loc[best].copy()
+        selected["poi_category"] = category
+        selected["poi_type"] = poi_type
+        selected["geometry"] = points.loc[best]
+        candidates.append(selected)
+
+    if not candidates:
+        return pois_gdf.iloc[0:0].assign(poi_category=None, poi_type=None)
+    return pd.concat(candidates).reset_index(drop=True)
+
+def length_adjacency(graph, node_list):
+    """
+    CSR matrix of the edge lengths between the nodes of `node_list`. Parallel edges of a
+    MultiDiGraph (two ways joining the same nodes) keep their shortest length, instead of
+    the sum nx.to_scipy_sparse_array would give.
+    """
+    node_position = {node: i for i, node in enumerate(node_list)}
+    edges = list(graph.edges(data="length", default=1))
+    rows = np.array([node_position[u] for u, _, _ in edges], dtype=np.int64)
+    cols = np.array([node_position[v] for _, v, _ in edges], dtype=np.int64)
+    lengths = np.array([length for _, _, length in edges], dtype=np.float64)
+
+    order = np.lexsort((lengths, cols, rows))
+    rows, cols, lengths = rows[order], cols[order], lengths[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return csr_matrix((lengths[first], (rows[first], cols[first])), shape=(len(node_list), len(node_list)))
+
+def walking_distance_matrix(graph, lons, lats):
+    """
+    Walking distances in meters between all the given points, computed with a single
+    batched many-to-many Dijkstra run over the walking graph.
+    Unreachable pairs are np.inf.
+    """
+    nodes = load_osmnx().distance.nearest_nodes(graph, lons, lats)
+    node_list = list(graph.nodes)
+    node_position = {node: i for i, node in enumerate(node_list)}
+
+    adjacency = length_adjacency(graph, node_list)
+    sources = np.array([node_position[node] for node in nodes])
+
+    unique_sources, inverse = np.unique(sources, return_inverse=True)
+    distances = dijkstra(adjacency, directed=True, indices=unique_sources)
+
+    return distances[inverse][:, sources]
+
+def _route_length(route, dist):
+    return float(sum(dist[a, b] for a, b in zip(route[:-1], route[1:])))
+
+def _best_insertion(route, candidates, dist):
+    """
+    Cheapest (extra length, candidate, position) to insert one of the candidates in the route.
+    """
+    candidates = np.asarray(candidates)
+    prev_nodes = np.asarray(route[:-1])
+    next_nodes = np.asarray(route[1:])
+
+    delta = dist[np.ix_(prev_nodes, candidates)] + dist[np.ix_(candidates, next_nodes)].T - dist[prev_nodes, next_nodes][:, None]
+    position, candidate = np.unravel_index(np.argmin(delta), delta.shape)
+
+    return delta[position, candidate], int(candidates[candidate]), int(position) + 1
+
+def _two_opt(route, dist):
+    """
+    Reverse sub-paths of the route while it gets shorter. Origin and destination stay fixed.
+    """
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(route) - 2):
+            for j in range(i + 1, len(route) - 1):
+                delta = (dist[route[i - 1], route[j]] + dist[route[i], route[j + 1]]
+                         - dist[route[i - 1], route[i]] - dist[route[j], route[j + 1]])
+                if delta < -1e-6:
+                    route[i:j + 1] = route[i:j + 1][::-1]
+                    improved = True
+    return route
+
+def _swap_stops(route, stop_types, type_candidates, dist):
+    """
+    Replace each stop with the same-type candidate that can be re-inserted most cheaply.
+    """
+    improved = True
+    while improved:
+        improved = False
+        for stop in route[1:-1]:
+            without = [node for node in route if node != stop]
+            alternatives = [c for c in type_candidates[stop_types[stop]] if c not in without]
+            if not alternatives:
+                continue
+            extra, candidate, position = _best_insertion(without, alternatives, dist)
+            if _route_length(without, dist) + extra < _route_length(route, dist) - 1e-6:
+                route = without[:position] + [candidate] + without[position:]
+                improved = True
+                break
+    return route
+
+def solve_itinerary(dist, candidate_types, required_types, budget_m=None, stop_cost_m=0, origin=0, destination=1):
+    """
+    Category-constrained orienteering heuristic on a distance matrix.
+
+    Starting from origin -> destination, repeatedly inserts the cheapest candidate of a
+    still missing type (cheapest insertion) while the walk stays within `budget_m`, then
+    improves the order with 2-opt and same-type stop swaps.
+    Args:
+        dist (ndarray): (n, n) walking distances, rows/columns origin, destination and candidates.
+        candidate_types (dict): candidate index -> POI type.
+        required_types (list): POI types to visit, one stop each.
+        budget_m (float, optional): Maximum walk length in meters, stop costs included.
+        stop_cost_m (float, optional): Length equivalent of the time spent at every stop.
+    Returns:
+        list: ordered node indices from origin to destination.
+    """
+    type_candidates = {}
+    for candidate, poi_type in candidate_types.items():
+        type_candidates.setdefault(poi_type, []).append(candidate)
+
+    route = [origin, destination]
+    missing = [t for t in dict.fromkeys(required_types) if t in type_candidates]
+
+    while missing:
+        candidates = [c for t in missing for c in type_candidates[t]]
+        extra, candidate, position = _best_insertion(route, candidates, dist)
+        if not np.isfinite(extra):
+            break
+        if budget_m is not None and _route_length(route, dist) + extra + stop_cost_m * (len(route) - 1) > budget_m:
+            break
+        route.insert(position, candidate)
+        missing.remove(candidate_types[candidate])
+
+        route = _two_opt(route, dist)
+        route = _swap_stops(route, candidate_types, type_candidates, dist)
+
+    return route
+
+def itinerary_summary(route, dist, stops, start, end, stop_time_min=0):
+    """
+    Describe an ordered itinerary in the routes_summary format, one segment per leg.
+    """
+    n_legs = len(route) - 1
+    leg_lengths = [float(dist[a, b]) for a, b in zip(route[:-1], route[1:])]
+    route_length = round(sum(leg_lengths), 2)
+    time_to_walk_tot = round(route_length / WALKING_SPEED_M_MIN + stop_time_min * (n_legs - 1), 2)
+
+    segments_info = []
+    tot_length = 0
+
+    for i, (node, leg_length) in enumerate(zip(route[1:], leg_lengths)):
+        tot_length += leg_length
+        time_to_walk = round(tot_length / WALKING_SPEED_M_MIN + stop_time_min * i, 2)
+
+        if i < n_legs - 1:
+            stop = stops.loc[node]
+            name = stop["name"] if pd.notna(stop["name"]) else None
+            target = f"{name} ({stop['poi_type'].replace('_', ' ')})" if name else f"a {stop['poi_type'].replace('_', ' ')}"
+            poi_details = {stop["poi_category"]: {stop["poi_type"]: [name] if name else 1}}
+        else:
+            target = end
+            poi_details = {}
+
+        segments_info.append({
+            "segment_id": i,
+            "instruction": f"Walk to {target} for {round(leg_length)} meters",
+            "POIs": poi_details,
+            "time_from_origin_min": time_to_walk,
+            "time_to_destination_min": round(time_to_walk_tot - time_to_walk, 2) if (time_to_walk_tot - time_to_walk)>0 else 0,
+            "distance_from_origin_m": round(tot_length, 2),
+            "distance_to_destination_m": round(route_length - tot_length, 2) if (route_length - tot_length)>0 else 0,
+        })
+
+    return {
+        "route_id": 0,
+        "from": start,
+        "to": end,
+        "length_tot_m": route_length,
+        "time_to_walk_tot_min": time_to_walk_tot,
+        "segments": segments_info
+    }
+
+def plan_itinerary(start, end, pois_list, time_budget_min=None, stop_time_min=0, max_per_type=10, graph=None):
+    """
+    Plan a walk from start to end visiting one POI of each requested type,
+    e.g. a museum, a cafe and a park, within an optional time budget.
+    Args:
+        start (str): Starting location as a string.
+        end (str): Ending location as a string.
+        pois_list (list): POI types to visit, same names as spatialModule.
+        time_budget_min (float, optional): Maximum itinerary time in minutes. Types that do
+            not fit in the budget are left out. Defaults to None.
+        stop_time_min (float, optional): Minutes spent at every stop. Defaults to 0.
+        max_per_type (int, optional): Candidates kept per type. Defaults to 10.
+        graph (MultiDiGraph, optional): Walking graph covering both places; taken from the warm-up
+            snapshot or downloaded with OSMnx if None.
+    Returns:
+        tuple: itinerary summary (routes_summary format), ordered stops GeoDataFrame,
+        start and end locations.
+    """
+    geolocator = get_geocoder()
+    locA = geolocator.geocode(start)
+    locB = geolocator.geocode(end)
+
+    if not locA or not locB:
+        return "Try again, the locations could not be found."
+
+    latA, lonA = locA.latitude, locA.longitude
+    latB, lonB = locB.latitude, locB.longitude
+
+    bbox = box(min(lonA, lonB), min(latA, latB), max(lonA, lonB), max(latA, latB))
+    bbox = bbox.buffer(0.01)
+    bbox = bbox.simplify(0)
+
+    # ----- CANDIDATE POIS -----
+    requested_pois = categorize_pois(pois_list)
+    if 'shop' in requested_pois:
+        requested_pois['shop'] = True
+    requested_pois_gdf = pois(bbox, requested_pois)
+
+    stops = candidate_pois(requested_pois_gdf, pois_list, Point(lonA, latA), Point(lonB, latB), max_per_type=max_per_type)
+    print(f"Itinerary candidates: {stops['poi_type'].value_counts().to_dict()}")
+
+    # ----- WALKING DISTANCE MATRIX -----
+    if graph is None:
+        snapshot = active_snapshot()
+        if snapshot is not None and snapshot.covers(bbox):
+            graph = snapshot.graph
+        else:
+            graph = load_osmnx().graph_from_polygon(bbox, network_type='walk')
+
+    lons = [lonA, lonB] + stops.geometry.x.tolist()
+    lats = [latA, latB] + stops.geometry.y.tolist()
+    dist = walking_distance_matrix(graph, lons, lats)
+
+    # ----- SOLVE -----
+    # Matrix rows 0 and 1 are start and end, the candidates follow
+    stops.index = stops.index + 2
+    candidate_types = stops['poi_type'].to_dict()
+    budget_m = time_budget_min * WALKING_SPEED_M_MIN if time_budget_min is not None else None
+
+    route = solve_itinerary(dist, candidate_types, pois_list, budget_m=budget_m,
+                            stop_cost_m=stop_time_min * WALKING_SPEED_M_MIN)
+
+    summary = itinerary_summary(route, dist, stops, start, end, stop_time_min=stop_time_min)
+
+    ordered_stops = stops.loc[route[1:-1]].copy()
+    ordered_stops['stop_order'] = range(1, len(ordered_stops) + 1)
+
+    missing = [t for t in pois_list if t not in set(ordered_stops['poi_type'])]
+    if missing:
+        print(f"Itinerary could not include: {missing}")
+
+    return summary, ordered_stops, locA, locB
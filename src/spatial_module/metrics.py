@@ -0,0 +1,190 @@
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+# Stage latency buckets in seconds, from cached geocodes to long LLM generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Prompt sizes in tokens
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096, 8192)
+
+
+class _HistogramChild:
+    __slots__ = ('label', '_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, label, bounds):
+        self.label = label
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram:
+    """
+    Prometheus histogram with one label. Children are created once per label value,
+    an observation is a bisect and two increments in preallocated slots.
+    """
+
+    def __init__(self, name, documentation, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, value):
+        child = self._children.get(value)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(value, _HistogramChild(value, self.buckets))
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for value, child in sorted(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{value}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{value}"}} {cumulative}')
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with one label.
+    """
+
+    def __init__(self, name, documentation, label):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value, amount=1):
+        with self._lock:
+            self._values[value] = self._values.get(value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines += [f'{self.name}{{{self.label}="{value}"}} {count}' for value, count in values]
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus gauge. Either set/inc/dec directly, or read from callbacks at scrape
+    time (e.g. cache sizes), which costs nothing on the request path.
+    """
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._value = 0
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, fn, value=None):
+        self._functions[value] = fn
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if not self._functions:
+            lines.append(f"{self.name} {self._value}")
+        for value, fn in sorted(self._functions.items(), key=lambda item: str(item[0])):
+            try:
+                sample = fn()
+            except Exception:
+                continue
+            labels = f'{{{self.label}="{value}"}}' if value is not None else ""
+            lines.append(f"{self.name}{labels} {sample}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("ragtrip_stage_seconds", "Latency of the pipeline stages in seconds.", "stage")
+LLM_SECONDS = Histogram("ragtrip_llm_seconds", "Latency of the LLM calls in seconds.", "call")
+PROMPT_TOKENS = Histogram("ragtrip_prompt_tokens", "Tokens of the information prompts and of their packed context.",
+                          "part", buckets=TOKEN_BUCKETS)
+STAGE_ERRORS = Counter("ragtrip_stage_errors_total", "Pipeline stages that raised an exception.", "stage")
+INTENTS = Counter("ragtrip_intents_total", "Classified user queries by intent.", "intent")
+RETRIEVAL_DEDUP = Counter("ragtrip_retrieval_dedup_total",
+                          "Near-duplicate retrieved passages collapsed, and the prompt tokens they would have taken.", "item")
+GEO_FILTER = Counter("ragtrip_geo_filter_total",
+                     "Information requests by geo pre-filter outcome (local, too_few, no_place).", "outcome")
+PREFETCH = Counter("ragtrip_prefetch_total",
+                   "Route POI prefetches scheduled, and information requests served from them (hit) or not (miss).", "outcome")
+IN_FLIGHT = Gauge("ragtrip_in_flight_requests", "Requests being served.")
+CACHE_ENTRIES = Gauge("ragtrip_cache_entries", "Entries held by the in-process caches.", "cache")
+
+REGISTRY = [STAGE_SECONDS, LLM_SECONDS, PROMPT_TOKENS, STAGE_ERRORS, INTENTS, RETRIEVAL_DEDUP, GEO_FILTER, PREFETCH, IN_FLIGHT, CACHE_ENTRIES]
+
+# Children bound once, the hot paths only call observe()
+GEOCODE = STAGE_SECONDS.labels("geocode")
+ROUTING = STAGE_SECONDS.labels("routing")
+POI_FETCH = STAGE_SECONDS.labels("poi_fetch")
+SJOIN = STAGE_SECONDS.labels("sjoin")
+SUMMARIZATION = STAGE_SECONDS.labels("summarization")
+RETRIEVAL = STAGE_SECONDS.labels("retrieval")
+LLM_CLASSIFY = LLM_SECONDS.labels("classify")
+LLM_SPATIAL = LLM_SECONDS.labels("spatial")
+LLM_INFORMATION = LLM_SECONDS.labels("information")
+PROMPT_TOKENS_INFORMATION = PROMPT_TOKENS.labels("information")
+PROMPT_TOKENS_CONTEXT = PROMPT_TOKENS.labels("context")
+
+
+def timed(child):
+    """
+    Decorator observing the duration of every call of the function in a histogram child,
+    and counting the calls that raise in STAGE_ERRORS.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                STAGE_ERRORS.inc(child.label)
+                raise
+            finally:
+                child.observe(perf_counter() - start)
+        return wrapper
+    return decorator
+
+def render_metrics():
+    """
+    All the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,77 @@
+"""
+Deterministic narration of a route summary: the turn-by-turn instructions of its segments
+and the POIs met along the way, rendered with templates. Only a short intro/outro is left
+to the LLM (see RAG.handle_spatial_request).
+"""
+import re
+
+CONTINUE = re.compile(r'^Continue for (\d+) meters$')
+MAX_NAMES_PER_STEP = 5
+
+
+def poi_mentions(pois):
+    """'Name (type)' for every named POI of a segment, '<n> unnamed <type>' for the counts."""
+    mentions = []
+    for types in pois.values():
+        for poi_type, value in types.items():
+            label = poi_type.replace('_', ' ')
+            if isinstance(value, list):
+                mentions += [f"{name} ({label})" for name in value]
+            elif value:
+                mentions.append(f"{value} unnamed {label}")
+    return mentions
+
+def route_steps(route_summary):
+    """
+    (instruction, minutes from the origin, new POI mentions) of the route. Consecutive
+    "Continue for N meters" segments are merged, repeated arrivals dropped, and every POI
+    is only mentioned on the first segment it is near.
+    """
+    steps, seen = [], set()
+    for segment in route_summary.get('segments', []):
+        instruction = segment.get('instruction') or "Continue"
+        mentions = [mention for mention in poi_mentions(segment.get('POIs', {})) if mention not in seen]
+        seen.update(mentions)
+        minutes = segment.get('time_from_origin_min', 0)
+        if steps:
+            previous, _, previous_mentions = steps[-1]
+            merged = CONTINUE.match(previous), CONTINUE.match(instruction)
+            if all(merged):
+                instruction = f"Continue for {int(merged[0].group(1)) + int(merged[1].group(1))} meters"
+                steps[-1] = (instruction, minutes, previous_mentions + mentions)
+                continue
+            if instruction == previous and instruction.startswith("Arrive"):
+                continue
+        steps.append((instruction, minutes, mentions))
+    return steps
+
+def route_overview(route_summary):
+    return (f"The walk from {route_summary.get('from')} to {route_summary.get('to')} is "
+            f"{route_summary.get('length_tot_m', 0) / 1000:.1f} km long and takes about "
+            f"{round(route_summary.get('time_to_walk_tot_min', 0))} minutes.")
+
+def narrate_route(route_summary):
+    """
+    Overview, numbered directions with the POIs met at each step, and a note when no POI
+    (matching the request constraints, already applied to the summary) is on the route.
+    """
+    lines = [route_overview(route_summary), ""]
+    any_poi = False
+    for i, (instruction, minutes, mentions) in enumerate(route_steps(route_summary), 1):
+        line = f"{i}. {instruction}."
+        if mentions:
+            any_poi = True
+            shown = ", ".join(mentions[:MAX_NAMES_PER_STEP])
+            more = f" and {len(mentions) - MAX_NAMES_PER_STEP} more" if len(mentions) > MAX_NAMES_PER_STEP else ""
+            line += f" Around minute {round(minutes)} you pass {shown}{more}."
+        lines.append(line)
+    if not any_poi:
+        lines += ["", "No points of interest matching your request were found along this route."]
+    return "\n".join(lines)
+
+def route_highlights(route_summary, max_names=8):
+    """Names of the first POIs of the route, for the LLM intro/outro prompt."""
+    names = []
+    for _, _, mentions in route_steps(route_summary):
+        names += mentions
+    return names[:max_names]
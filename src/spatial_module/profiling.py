@@ -0,0 +1,178 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# off: never profile; request: only requests that ask for it (X-Profile header, ?profile=1,
+# RAGTrip.handle_query(profile=True)); all: every request
+PROFILING = os.environ.get("RAGTRIP_PROFILING", "off")
+PROFILE_DIR = os.environ.get("RAGTRIP_PROFILE_DIR", "profiles")
+PROFILE_HZ = float(os.environ.get("RAGTRIP_PROFILE_HZ", 200))
+PROFILE_KEEP = int(os.environ.get("RAGTRIP_PROFILE_KEEP", 50))  # newest profile files kept
+PROFILE_FORMAT = os.environ.get("RAGTRIP_PROFILE_FORMAT", "speedscope")  # or 'collapsed' (flamegraph.pl)
+PROFILE_SUFFIXES = (".speedscope.json", ".collapsed.txt")  # the only files pruned from PROFILE_DIR
+
+# Profiler of the request being served, for stages run on executor threads (see follow)
+CURRENT_PROFILER = ContextVar("ragtrip_profiler", default=None)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread from a background thread every 1/hz seconds.
+
+    Nothing is hooked into the interpreter (no sys.setprofile), so the profiled code
+    runs unchanged; the cost is the sampler thread taking the GIL `hz` times a second.
+    A detached profiler samples nothing until a thread enters following(), so that a
+    request served by several executor threads is followed from stage to stage.
+    """
+
+    def __init__(self, thread_id=None, hz=PROFILE_HZ, detached=False):
+        self.thread_id = None if detached else thread_id if thread_id is not None else threading.get_ident()
+        self.interval = 1.0 / hz
+        self.frames = {}   # (name, file, line) -> frame index
+        self.samples = []  # (timestamp, tuple of frame indices, root first, weight in seconds)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame_index(self, code):
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        index = self.frames.get(key)
+        if index is None:
+            index = self.frames[key] = len(self.frames)
+        return index
+
+    def _run(self):
+        last = self.started
+        while not self._stop.wait(self.interval):
+            now, thread_id = time.perf_counter(), self.thread_id
+            frame = sys._current_frames().get(thread_id) if thread_id is not None else None
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_index(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                # after a gap (no thread followed) a sample only stands for one interval
+                self.samples.append((now, tuple(reversed(stack)), now - last if last is not None else self.interval))
+            last = now if stack else None
+
+    @contextmanager
+    def following(self):
+        """Sample the calling thread for the duration of the block."""
+        self.thread_id = threading.get_ident()
+        try:
+            yield self
+        finally:
+            self.thread_id = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="ragtrip-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.stopped = time.perf_counter()
+        return self
+
+    def speedscope(self, name):
+        """
+        Sampled profile in the speedscope file format (https://www.speedscope.app).
+        """
+        frames = [{"name": n, "file": f, "line": l} for (n, f, l), _ in sorted(self.frames.items(), key=lambda kv: kv[1])]
+        weights = [weight for _, _, weight in self.samples]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "ragtrip",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": name, "unit": "seconds",
+                "startValue": 0, "endValue": self.stopped - self.started,
+                "samples": [list(stack) for _, stack, _ in self.samples],
+                "weights": weights,
+            }],
+        }
+
+    def collapsed(self):
+        """
+        Folded stacks ("a;b;c count" lines), the input of flamegraph.pl and inferno.
+        """
+        names = {index: f"{n} ({os.path.basename(f)}:{l})" for (n, f, l), index in self.frames.items()}
+        counts = {}
+        for _, stack, _ in self.samples:
+            counts[stack] = counts.get(stack, 0) + 1
+        return "".join(";".join(names[i] for i in stack) + f" {count}\n" for stack, count in counts.items())
+
+
+def _prune(directory, keep):
+    """Remove all but the `keep` newest profiles; other files of the directory are left alone."""
+    profiles = sorted((entry for entry in os.scandir(directory)
+                       if entry.is_file() and entry.name.endswith(PROFILE_SUFFIXES)),
+                      key=lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:max(0, len(profiles) - keep)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+def write_profile(profiler, request_id, directory=PROFILE_DIR, fmt=PROFILE_FORMAT, keep=PROFILE_KEEP):
+    """
+    Write the profile as <directory>/<request_id>.speedscope.json or .collapsed.txt,
+    keeping only the `keep` newest files. Returns the path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    request_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(request_id))
+    if fmt == "collapsed":
+        path = os.path.join(directory, f"{request_id}.collapsed.txt")
+        with open(path, "w") as f:
+            f.write(profiler.collapsed())
+    else:
+        path = os.path.join(directory, f"{request_id}.speedscope.json")
+        with open(path, "w") as f:
+            json.dump(profiler.speedscope(request_id), f)
+    _prune(directory, keep)
+    return path
+
+def profiling_requested(flag=False):
+    """
+    Whether to profile a request that did (flag=True) or did not ask for it.
+    """
+    return PROFILING == "all" or (PROFILING == "request" and flag)
+
+def follow(fn):
+    """
+    `fn`, sampled by the profiler of the current request (if any) in whichever thread it
+    runs. Used to submit request stages to executors from within profile_request(detached=True).
+    """
+    profiler = CURRENT_PROFILER.get()
+    if profiler is None:
+        return fn
+    def run(*args, **kwargs):
+        with profiler.following():
+            return fn(*args, **kwargs)
+    return run
+
+@contextmanager
+def profile_request(request_id, detached=False):
+    """
+    Profile the calling thread (detached: the threads running the stages wrapped with
+    follow()) for the duration of the block and write the result.
+    Callers check profiling_requested() first, so requests not profiled pay nothing.
+    Yields a dict whose 'path' is set once the profile is written.
+    """
+    result = {"path": None}
+    profiler = SamplingProfiler(detached=detached).start()
+    token = CURRENT_PROFILER.set(profiler)
+    try:
+        yield result
+    finally:
+        CURRENT_PROFILER.reset(token)
+        profiler.stop()
+        result["path"] = write_profile(profiler, request_id)
+        print(f"[{request_id}] profile: {len(profiler.samples)} samples in "
+              f"{profiler.stopped - profiler.started:.2f} s -> {result['path']}")
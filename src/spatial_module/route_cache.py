@@ -0,0 +1,76 @@
+import copy
+import threading
+from collections import OrderedDict
+from .filtering import parse_constraints, filter_segments_sorted
+
+
+class RouteState:
+    """
+    Enriched state of a route, everything spatialModule computes before the
+    time/distance constraints are applied.
+    """
+    
+    def __init__(self, route_summary, routes_gdf, pois_near_segments, locA, locB):
+        # Unfiltered summary, never handed out directly
+        self.route_summary = copy.deepcopy(route_summary)
+        self.routes_gdf = routes_gdf
+        self.pois_near_segments = pois_near_segments
+        self.locA = locA
+        self.locB = locB
+        
+        segments = self.route_summary["segments"]
+        self.cumulative_time = [seg["time_from_origin_min"] for seg in segments]
+        self.cumulative_distance = [seg["distance_from_origin_m"] for seg in segments]
+    
+    def constrain(self, time_constraint=None, space_constraint=None):
+        """
+        Route summary with a new time/distance constraint applied.
+        """
+        time_limit, distance_limit = parse_constraints(time_constraint, space_constraint,
+                                                       self.route_summary["from"], self.route_summary["to"])
+        return filter_segments_sorted(self.route_summary, time_limit, distance_limit,
+                                      self.cumulative_time, self.cumulative_distance)
+
+
+class RouteStateCache:
+    """
+    LRU cache of RouteState keyed by (origin, destination, POI categories), so that
+    a follow-up changing only the constraints skips geocoding, routing, POI fetch
+    and the spatial join.
+    """
+    
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def make_key(start, end, pois_list=None, **options):
+        """
+        Normalized key: case and whitespace insensitive places, unordered POI categories.
+        Extra options (e.g. segmentation) that change the enriched table are part of the key.
+        """
+        pois_key = tuple(sorted({poi.strip().lower() for poi in pois_list or []}))
+        return (start.strip().lower(), end.strip().lower(), pois_key, tuple(sorted(options.items())))
+    
+    def get(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                self.misses += 1
+                return None
+            self._states.move_to_end(key)
+            self.hits += 1
+            return state
+    
+    def put(self, key, state):
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._states)
@@ -1,21 +1,83 @@
 # %%
+import os
 import requests
-import osmnx as ox
 import geopandas as gpd
 import pandas as pd
 from shapely.geometry import shape
-from geopy.geocoders import Nominatim
-from routingpy import Valhalla, Graphhopper, ORS
 from shapely.geometry import LineString
 import polyline
+import numpy as np
+from .metrics import ROUTING, timed
+
+# Overridable to point the routing at a local server, e.g. the load-test stubs
+GRAPHHOPPER_URL = os.environ.get("RAGTRIP_GRAPHHOPPER_URL", "https://graphhopper.com/api/1")
 
 
 # %%
-def routing_graphhopper(lonStart, latStart, lonEnd, latEnd, mode='foot', graphhopper_api_key=None, number_of_routes=1):
+def _haversine_m(coords):
+    """
+    Length in meters of each step of a (lat, lon) vertex list.
+    """
+    coords = np.radians(np.asarray(coords, dtype=float))
+    dlat = np.diff(coords[:, 0])
+    dlon = np.diff(coords[:, 1])
+    a = np.sin(dlat / 2) ** 2 + np.cos(coords[:-1, 0]) * np.cos(coords[1:, 0]) * np.sin(dlon / 2) ** 2
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+def _coalesce_intervals(instructions, n_vertices, step_lengths=None, min_segment_length=None):
+    """
+    Split the vertex range of a path into (start, end, instruction) intervals.
+
+    Every GraphHopper instruction gives one interval. If min_segment_length is set,
+    long instructions are further cut into chunks of at least that many meters,
+    so the summary keeps a usable resolution for time/distance constraints.
+    Zero-length instructions (e.g. "Arrive at destination") are skipped.
+    """
+    intervals = []
+    for inst in instructions:
+        start, end = inst['interval']
+        if end <= start:
+            continue
+        if min_segment_length is None or step_lengths is None:
+            intervals.append((start, end, inst['text']))
+            continue
+
+        chunk_start, acc, text = start, 0.0, inst['text']
+        remaining = float(np.sum(step_lengths[start:end]))
+        for i in range(start, end):
+            acc += step_lengths[i]
+            remaining -= step_lengths[i]
+            # Cut only if the rest of the instruction can still fill a chunk
+            if acc >= min_segment_length and remaining >= min_segment_length:
+                intervals.append((chunk_start, i + 1, text))
+                chunk_start, acc, text = i + 1, 0.0, None
+        intervals.append((chunk_start, end, text))
+
+    if not intervals and n_vertices > 1:
+        intervals.append((0, n_vertices - 1, None))
+    return intervals
+
+@timed(ROUTING)
+def routing_graphhopper(lonStart, latStart, lonEnd, latEnd, mode='foot', graphhopper_api_key=None, number_of_routes=1,
+                        segmentation='vertex', min_segment_length=50):
     """
     Get the alternative routes between two points using Graphhopper.
+
+    Args:
+        segmentation (str): How the polyline is cut into segments.
+            - 'vertex': one LineString per pair of consecutive vertices (default).
+            - 'instruction': one LineString per GraphHopper instruction interval.
+            - 'length': instruction intervals, cut into chunks of at least
+              `min_segment_length` meters.
+        min_segment_length (float): Minimum chunk length in meters for 'length'.
+    Returns:
+        GeoDataFrame: one row per segment with route_id, instruction and interval
+        (first and last polyline vertex index of the segment).
     """
-    client = Graphhopper(base_url='https://graphhopper.com/api/1', api_key=graphhopper_api_key)
+    assert segmentation in ['vertex', 'instruction', 'length'], "Invalid segmentation. Choose from ['vertex', 'instruction', 'length']"
+
+    from routingpy import Graphhopper
+    client = Graphhopper(base_url=GRAPHHOPPER_URL, api_key=graphhopper_api_key)
     routes = client.directions(
         locations=[[lonStart, latStart], [lonEnd, latEnd]],
         profile=mode,
@@ -32,13 +94,26 @@ def routing_graphhopper(lonStart, latStart, lonEnd, latEnd, mode='foot', graphho
     for l, route_option in enumerate(routes.raw['paths']):
         # decoding geometry
         geometry = polyline.decode(route_option['points'], precision=5)
-        
+        instructions = route_option.get('instructions') or []
+
+        if segmentation != 'vertex':
+            step_lengths = _haversine_m(geometry) if segmentation == 'length' else None
+            min_length = min_segment_length if segmentation == 'length' else None
+
+            for start, end, inst_text in _coalesce_intervals(instructions, len(geometry), step_lengths, min_length):
+                segments.append({
+                    'route_id': l,
+                    'geometry': LineString([(lat_lon[1], lat_lon[0]) for lat_lon in geometry[start:end + 1]]),
+                    'instruction': inst_text,
+                    'interval': (start, end)
+                })
+            continue
+
         instructions_mapping = {}
-        if 'instructions' in route_option:
-            for inst in route_option['instructions']:
-                start, end = inst['interval']
-                # for idx in range(start, end):
-                instructions_mapping[start] = inst['text']
+        for inst in instructions:
+            start, end = inst['interval']
+            # for idx in range(start, end):
+            instructions_mapping[start] = inst['text']
         
         for i in range(len(geometry) - 1):
             segment = LineString([
@@ -47,29 +122,15 @@ def routing_graphhopper(lonStart, latStart, lonEnd, latEnd, mode='foot', graphho
             ])
 
             inst_text = instructions_mapping.get(i, None)
+            # The arrival instruction starts on the last vertex, attach it to the last segment
+            if i == len(geometry) - 2 and inst_text is None and instructions:
+                inst_text = instructions[-1]['text']
             segments.append({
                 'route_id': l,
                 'geometry': segment,
-                'instruction': inst_text
-            })
-        if len(geometry) > 2:
-            # Add the last segment
-            segments.append({
-                'route_id': l,
-                'geometry': LineString([
-                    (geometry[-2][1], geometry[-2][0]),  
-                    (geometry[-1][1], geometry[-1][0])
-                ]),
-                'instruction': route_option['instructions'][-1]['text'] if route_option['instructions'] else None
+                'instruction': inst_text,
+                'interval': (i, i + 1)
             })
-        segments.append({
-            'route_id': l,
-            'geometry': LineString([
-                (geometry[-2][1], geometry[-2][0]),  
-                (geometry[-1][1], geometry[-1][0])
-            ]),
-            'instruction': route_option['instructions'][-1]['text'] if route_option['instructions'] else None
-        })
     
     gdf = gpd.GeoDataFrame(segments, geometry='geometry', crs="EPSG:4326")
     
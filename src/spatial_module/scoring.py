@@ -0,0 +1,41 @@
+
+def route_poi_types(route_summary):
+    """
+    POI types (e.g. cafe, museum) found on the segments of a route summary.
+    """
+    types = set()
+    for segment in route_summary.get("segments", []):
+        for cat_info in segment.get("POIs", {}).values():
+            types.update(cat_info.keys())
+    return types
+
+def score_route(route_summary, osmids, shortest_length, length_weight=1.0):
+    """
+    Score an alternative route by its matching POIs against its extra length.
+
+    The number of distinct matching POIs is divided by the detour factor
+    1 + length_weight * (extra length / shortest length), so a route twice as
+    long as the shortest one needs twice as many POIs to win with length_weight=1.
+    """
+    length = route_summary["length_tot_m"]
+    extra_length = max(length - shortest_length, 0)
+    detour = extra_length / shortest_length if shortest_length else 0
+    
+    n_pois = len(osmids)
+    poi_types = route_poi_types(route_summary)
+    
+    return {
+        "route_id": route_summary["route_id"],
+        "length_tot_m": length,
+        "time_to_walk_tot_min": route_summary["time_to_walk_tot_min"],
+        "extra_length_m": round(extra_length, 2),
+        "matching_pois": n_pois,
+        "poi_types": sorted(poi_types),
+        "score": round(n_pois / (1 + length_weight * detour), 4)
+    }
+
+def rank_routes(scores):
+    """
+    Sort the route scores: most POI types covered first, then best score, then shortest.
+    """
+    return sorted(scores, key=lambda s: (-len(s["poi_types"]), -s["score"], s["length_tot_m"]))
@@ -2,12 +2,19 @@
 import geopandas as gpd
 import pandas as pd
 import json
+import hashlib
+import os
 import re
-from geopy.geocoders import Nominatim
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import box
 from .routing import routing_graphhopper
+from .geocoding import get_geocoder
 from .enrichment import categorize_pois, add_pois_areas_to_gdf, pois, aggregate_segment_pois_by_type
 from .filtering import filter_segments
+from .scoring import score_route, rank_routes
+from .route_cache import RouteState
+from .metrics import SUMMARIZATION, timed
 from .visualization import visualize_rag, visualize_no_rag
 
 
@@ -17,18 +24,205 @@ ORS_API_KEY = "XXXX"
 GRAPHHOPPER_API = "XXXX"
 
 # %%
-def spatialModule(start, end, pois_list=[], time_constraint=None, space_constraint=None):
+def requested_pois_from_list(pois_list):
+    """
+    Map the user POI categories to the OSM tags to fetch.
+    Returns the tags dict and the tag keys used to deduplicate segments.
+    """
+    if pois_list != []:
+        
+        requested_pois = categorize_pois(pois_list)
+        if 'shop' in requested_pois:
+            requested_pois['shop'] = True
+        print(f"Requested POIs: {requested_pois}")
+        poi_keys_for_segments = list(requested_pois.keys())
+        
+    else:
+        requested_pois = {
+            "tourism": ["museum", "gallery", "monument", "information"]
+        }
+        poi_keys_for_segments = list(requested_pois.keys())
+    
+    return requested_pois, poi_keys_for_segments
+
+def enrich_routes(routes, requested_pois_gdf, poi_keys_for_segments, join_method='buffer'):
+    """
+    Join the POIs to the route segments and drop the duplicated segment/POI pairs.
+    """
+    routes_gdf= add_pois_areas_to_gdf(routes, requested_pois_gdf, distance=100, method=join_method, keep_buffer=False)
+    
+    routes_gdf['segment_id'] = routes_gdf.index
+    routes_gdf = routes_gdf.to_crs("EPSG:4326")
+    routes_gdf = routes_gdf.set_geometry('geometry')
+    
+    cols_to_drop_duplicates = ['route_id','segment_id']
+        
+    if 'name' in routes_gdf.columns:
+         cols_to_drop_duplicates.append('name')
+    
+    # Add the columns that are relevant for deduplication
+    cols_to_drop_duplicates += [col for col in routes_gdf.columns if col in poi_keys_for_segments]
+        
+    routes_gdf = routes_gdf.drop_duplicates(subset=cols_to_drop_duplicates)
+    
+    return routes_gdf
+
+@timed(SUMMARIZATION)
+def summarize_route(route_id, group, start, end, requested_pois):
+    """
+    Build the summary dict of a single route (length, time and per-segment
+    instructions and POIs) from its enriched segments.
+    """
+    aggregated_geom = group.unary_union
+    agg_gdf = gpd.GeoDataFrame(geometry=[aggregated_geom], crs=group.crs)
+    centroid = agg_gdf.geometry.centroid.iloc[0]
+    centroid_latlon = gpd.GeoSeries([centroid], crs=group.crs).to_crs("EPSG:4326").iloc[0]
+    centroid_lat, centroid_lon = centroid_latlon.y, centroid_latlon.x
+    # Calculate the route length in meters.
+    route_length = agg_gdf.to_crs("EPSG:3857").geometry.length.iloc[0]
+    route_length = round(route_length, 2)  # round to 2 decimal places
+            
+    # Calculate the total time to walk the route (assuming average walking speed of 1.39 m/s)
+    time_to_walk_tot = route_length / 83 # 1.39 / 60  # in minutes
+    time_to_walk_tot = round(time_to_walk_tot, 2)  # round to 2 decimal places    
+    
+    print(f"Processing route {route_id} with length {route_length} m and total time to walk {time_to_walk_tot} min")
+    
+    n_segments = 0
+    tot_length = 0
+    
+    # Process each segment
+    segments_info = []
+    
+    for seg_id, seg_group in group.groupby('segment_id'):
+            
+        n_segments += 1
+
+        # Compute the segment geometry and its length
+        segment_length = seg_group.to_crs("EPSG:3857").geometry.length.iloc[0]
+        segment_length = round(segment_length, 2)  # round to 2 decimal places
+        tot_length += segment_length
+        
+        # Compute time to walk the segment (assuming average walking speed of 1.39 m/s)
+        # time_to_walk = segment_length / 1.39  # in seconds
+        time_to_walk = tot_length / 83 #1.39 / 60  # in minutes
+        time_to_walk = round(time_to_walk, 2)  # round to 2 decimal places
+            
+        categories_list = list(requested_pois.keys())
+        poi_details = aggregate_segment_pois_by_type(seg_group, detailed_categories=categories_list)
+        
+        instruction = seg_group["instruction"].iloc[0] if "instruction" in seg_group.columns and pd.notna(seg_group["instruction"].iloc[0]) else "Continue"
+    
+        if "Turn" in instruction:
+            instruction = instruction + f" after {round(segment_length)} meters"
+        elif "Continue" in instruction:
+            instruction = instruction + f" for {round(segment_length)} meters"
+        elif "Walk" in instruction:
+            instruction = instruction + f" for {round(segment_length)} meters"
+        elif "Head" in instruction:
+            instruction = instruction + f" for {round(segment_length)} meters"
+        
+        segments_info.append({
+            "segment_id": seg_id,
+            "instruction": instruction,
+            "POIs": poi_details,
+            "time_from_origin_min": time_to_walk,  # time to walk this segment in minutes
+            "time_to_destination_min": round(time_to_walk_tot - time_to_walk, 2) if (time_to_walk_tot - time_to_walk)>0 else 0,  # time to walk this segment in minutes
+            "distance_from_origin_m": round(tot_length, 2),  # distance of this segment in meters
+            "distance_to_destination_m": round(route_length - tot_length, 2) if (route_length - tot_length)>0 else 0,  # distance to the end of the route in meters
+        })
+        
+    route_dict = {
+        "route_id": route_id,
+        "from": start,
+        "to": end,
+        "length_tot_m": route_length,
+        "time_to_walk_tot_min": time_to_walk_tot,  # total time in minutes
+        "segments": segments_info
+    }
+    
+    return route_dict
+
+def route_osmids(routes_gdf, route_summary):
+    """
+    Unique OSM ids of the POIs joined to the segments kept in a route summary.
+    """
+    filtered_segment_ids = [seg['segment_id'] for seg in route_summary['segments']]
+    filtered_route_id = route_summary['route_id']
+    
+    # Filtra i segmenti dalla routes_gdf
+    filtered_segments_gdf = routes_gdf[
+        (routes_gdf['route_id'] == filtered_route_id) &
+        (routes_gdf['segment_id'].isin(filtered_segment_ids))
+    ]
+
+    # Estrai tutti gli OSMID unici dai segmenti filtrati
+    osmids = set()
+    if 'osmid' in filtered_segments_gdf.columns:
+        for val in filtered_segments_gdf['osmid']:
+            # Può essere singolo ID o lista
+            if isinstance(val, list):
+                osmids.update(val)
+            else:
+                osmids.add(val)
+    
+    return osmids
+
+def save_route_summary(route_summary, save_dir, request_id=None):
+    """
+    Persist a route summary for debugging, as <save_dir>/<request_id>.json or, without a
+    request id, content-addressed as <save_dir>/<sha256 of the summary>.json.
+    The file is written to a temporary name and renamed, so concurrent requests never
+    see a partial file. Returns the path.
+    """
+    data = json.dumps(route_summary, indent=4, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    # Request ids may come from a client header: keep them a plain file name
+    name = re.sub(r'[^A-Za-z0-9_-]', '_', str(request_id)) if request_id else hashlib.sha256(data).hexdigest()
+    
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, f"{name}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+def spatialModule(start, end, pois_list=[], time_constraint=None, space_constraint=None, segmentation='vertex', min_segment_length=50,
+                  join_method='buffer', route_cache=None, save_dir=None, request_id=None):
     """
     Main function to handle spatial queries and routing.
     Args:
         start (str): Starting location as a string.
         end (str): Ending location as a string.
         pois_list (list, optional): List of points of interest. Defaults to None.
+        segmentation (str, optional): Route segmentation passed to routing_graphhopper
+            ('vertex', 'instruction' or 'length'). Coarser segments mean far fewer rows
+            to buffer, join and summarize. Defaults to 'vertex'.
+        min_segment_length (float, optional): Minimum segment length in meters for 'length'.
+        join_method (str, optional): Segment/POI join used by add_pois_areas_to_gdf, 'buffer'
+            or 'dwithin' (spatial index distance query, no buffer polygons). Defaults to 'buffer'.
+        route_cache (RouteStateCache, optional): If given, the enriched route is cached by
+            (start, end, pois_list) and a later call changing only the constraints is
+            answered from the cache. Defaults to None.
+        save_dir (str, optional): If given, the route summary is also written there for
+            debugging (see save_route_summary). Defaults to None, nothing is written.
+        request_id (str, optional): File name used with save_dir. Defaults to content-addressed.
     Returns:
-        dict: A dictionary containing the routing results and POIs.
+        dict: A dictionary containing the routing results and POIs. The route summary is
+        returned in memory, to be passed to RAG.handle_spatial_request.
     """
     
-    geolocator = Nominatim(user_agent="my_app")
+    if route_cache is not None:
+        cache_key = route_cache.make_key(start, end, pois_list, segmentation=segmentation,
+                                         min_segment_length=min_segment_length, join_method=join_method)
+        state = route_cache.get(cache_key)
+        if state is not None:
+            route_summary = state.constrain(time_constraint, space_constraint)
+            if save_dir is not None:
+                save_route_summary(route_summary, save_dir, request_id)
+            return route_summary, state.routes_gdf, state.pois_near_segments, state.locA, state.locB
+    
+    geolocator = get_geocoder()  # shared cache, seeded by the warm-up snapshot
     locA = geolocator.geocode(start)
     locB = geolocator.geocode(end)
     
@@ -48,115 +242,26 @@ def spatialModule(start, end, pois_list=[], time_constraint=None, space_constrai
     bbox = bbox.simplify(0)
     
     # ----- GET THE ROUTES -----
-    routes = routing_graphhopper(lonA, latA, lonB, latB, mode='foot', graphhopper_api_key=GRAPHHOPPER_API, number_of_routes=1)
+    routes = routing_graphhopper(lonA, latA, lonB, latB, mode='foot', graphhopper_api_key=GRAPHHOPPER_API, number_of_routes=1,
+                                 segmentation=segmentation, min_segment_length=min_segment_length)
     
     # ----- POINTS OF INTEREST -----
-    
-    if pois_list != []:
-        
-        requested_pois = categorize_pois(pois_list)
-        if 'shop' in requested_pois:
-            requested_pois['shop'] = True
-        print(f"Requested POIs: {requested_pois}")
-        poi_keys_for_segments = list(requested_pois.keys())
-        
-    else:
-        requested_pois = {
-            "tourism": ["museum", "gallery", "monument", "information"]
-        }
-        poi_keys_for_segments = list(requested_pois.keys())
+    requested_pois, poi_keys_for_segments = requested_pois_from_list(pois_list)
         
     requested_pois_gdf = pois(bbox, requested_pois)
-    routes_gdf= add_pois_areas_to_gdf(routes, requested_pois_gdf, distance=100)
-    
-    routes_gdf['segment_id'] = routes_gdf.index
-    routes_gdf = routes_gdf.to_crs("EPSG:4326")
-    routes_gdf = routes_gdf.set_geometry('geometry')
-    
-    cols_to_drop_duplicates = ['route_id','segment_id']
-        
-    if 'name' in routes_gdf.columns:
-         cols_to_drop_duplicates.append('name')
-    
-    # Add the columns that are relevant for deduplication
-    cols_to_drop_duplicates += [col for col in routes_gdf.columns if col in poi_keys_for_segments]
-        
-    routes_gdf = routes_gdf.drop_duplicates(subset=cols_to_drop_duplicates)
+    routes_gdf = enrich_routes(routes, requested_pois_gdf, poi_keys_for_segments, join_method=join_method)
     
     # ----- ROUTE SUMMARY ----- 
     routes_grouped = routes_gdf.groupby("route_id")
     routes_summary = []
 
     for route_id, group in routes_grouped:
-        
-        aggregated_geom = group.unary_union
-        agg_gdf = gpd.GeoDataFrame(geometry=[aggregated_geom], crs=group.crs)
-        centroid = agg_gdf.geometry.centroid.iloc[0]
-        centroid_latlon = gpd.GeoSeries([centroid], crs=group.crs).to_crs("EPSG:4326").iloc[0]
-        centroid_lat, centroid_lon = centroid_latlon.y, centroid_latlon.x
-        # Calculate the route length in meters.
-        route_length = agg_gdf.to_crs("EPSG:3857").geometry.length.iloc[0]
-        route_length = round(route_length, 2)  # round to 2 decimal places
-                
-        # Calculate the total time to walk the route (assuming average walking speed of 1.39 m/s)
-        time_to_walk_tot = route_length / 83 # 1.39 / 60  # in minutes
-        time_to_walk_tot = round(time_to_walk_tot, 2)  # round to 2 decimal places    
-        
-        print(f"Processing route {route_id} with length {route_length} m and total time to walk {time_to_walk_tot} min")
-        
-        n_segments = 0
-        tot_length = 0
-        
-        # Process each segment
-        segments_info = []
-        
-        for seg_id, seg_group in group.groupby('segment_id'):
-                
-            n_segments += 1
-
-            # Compute the segment geometry and its length
-            segment_length = seg_group.to_crs("EPSG:3857").geometry.length.iloc[0]
-            segment_length = round(segment_length, 2)  # round to 2 decimal places
-            tot_length += segment_length
-            
-            # Compute time to walk the segment (assuming average walking speed of 1.39 m/s)
-            # time_to_walk = segment_length / 1.39  # in seconds
-            time_to_walk = tot_length / 83 #1.39 / 60  # in minutes
-            time_to_walk = round(time_to_walk, 2)  # round to 2 decimal places
-                
-            categories_list = list(requested_pois.keys())
-            poi_details = aggregate_segment_pois_by_type(seg_group, detailed_categories=categories_list)
-            
-            instruction = seg_group["instruction"].iloc[0] if "instruction" in seg_group.columns and pd.notna(seg_group["instruction"].iloc[0]) else "Continue"
-        
-            if "Turn" in instruction:
-                instruction = instruction + f" after {round(segment_length)} meters"
-            elif "Continue" in instruction:
-                instruction = instruction + f" for {round(segment_length)} meters"
-            elif "Walk" in instruction:
-                instruction = instruction + f" for {round(segment_length)} meters"
-            elif "Head" in instruction:
-                instruction = instruction + f" for {round(segment_length)} meters"
-            
-            segments_info.append({
-                "segment_id": seg_id,
-                "instruction": instruction,
-                "POIs": poi_details,
-                "time_from_origin_min": time_to_walk,  # time to walk this segment in minutes
-                "time_to_destination_min": round(time_to_walk_tot - time_to_walk, 2) if (time_to_walk_tot - time_to_walk)>0 else 0,  # time to walk this segment in minutes
-                "distance_from_origin_m": round(tot_length, 2),  # distance of this segment in meters
-                "distance_to_destination_m": round(route_length - tot_length, 2) if (route_length - tot_length)>0 else 0,  # distance to the end of the route in meters
-            })
-            
-        route_dict = {
-            "route_id": route_id,
-            "from": start,
-            "to": end,
-            "length_tot_m": route_length,
-            "time_to_walk_tot_min": time_to_walk_tot,  # total time in minutes
-            "segments": segments_info
-        }
-        routes_summary.append(route_dict)
+        routes_summary.append(summarize_route(route_id, group, start, end, requested_pois))
+    
+    if route_cache is not None and len(routes_summary) > 0:
+        osmids = route_osmids(routes_gdf, routes_summary[0])
+        pois_near_segments = requested_pois_gdf[requested_pois_gdf['osmid'].isin(osmids)].copy()
+        route_cache.put(cache_key, RouteState(routes_summary[0], routes_gdf, pois_near_segments, locA, locB))
         
     # ---- FILTER THE RESULTS -----
     filtered_routes = []
@@ -170,35 +275,105 @@ def spatialModule(start, end, pois_list=[], time_constraint=None, space_constrai
     # ----- SAVE THE RESULTS -----
         
     if len(routes_summary) == 0:
-        raise "No routes found. Please try again with different locations."
-    else:
-        with open('routes_summary.json', 'w') as f:
-            json.dump(routes_summary[0], f, indent=4)
-            
-            filtered_segment_ids = [seg['segment_id'] for seg in routes_summary[0]['segments']]
-            filtered_route_id = routes_summary[0]['route_id']
-            
-            # Filtra i segmenti dalla routes_gdf
-            filtered_segments_gdf = routes_gdf[
-                (routes_gdf['route_id'] == filtered_route_id) &
-                (routes_gdf['segment_id'].isin(filtered_segment_ids))
-            ]
+        raise ValueError("No routes found. Please try again with different locations.")
+    
+    if save_dir is not None:
+        save_route_summary(routes_summary[0], save_dir, request_id)
+    
+    osmids = route_osmids(routes_gdf, routes_summary[0])
+    
+    # Filtra i POIs usando gli osmid
+    pois_near_segments = requested_pois_gdf[requested_pois_gdf['osmid'].isin(osmids)].copy()
+    
+    return routes_summary[0], routes_gdf, pois_near_segments, locA, locB
 
-            # Estrai tutti gli OSMID unici dai segmenti filtrati
-            osmids = set()
-            if 'osmid' in filtered_segments_gdf.columns:
-                for val in filtered_segments_gdf['osmid']:
-                    # Può essere singolo ID o lista
-                    if isinstance(val, list):
-                        osmids.update(val)
-                    else:
-                        osmids.add(val)
-            
-            # Filtra i POIs usando gli osmid
-            pois_near_segments = requested_pois_gdf[requested_pois_gdf['osmid'].isin(osmids)].copy()
+def _process_alternative(route_id, route_segments, requested_pois_gdf, requested_pois, poi_keys_for_segments,
+                         start, end, time_constraint, space_constraint, join_method):
+    """
+    Enrich, summarize and filter one candidate route.
+    """
+    route_gdf = enrich_routes(route_segments, requested_pois_gdf, poi_keys_for_segments, join_method=join_method)
+    route_summary = summarize_route(route_id, route_gdf, start, end, requested_pois)
+    route_summary = filter_segments(route_summary, time_constraint, space_constraint, start, end)
+    
+    # Only the segments that still have POIs after the constraints count for the score
+    matching = dict(route_summary, segments=[seg for seg in route_summary['segments'] if seg['POIs']])
+    osmids = route_osmids(route_gdf, matching)
+    
+    return route_summary, route_gdf, osmids
 
-            
-        return routes_summary[0], routes_gdf, pois_near_segments, locA, locB
+def spatialModuleAlternatives(start, end, pois_list=[], time_constraint=None, space_constraint=None, number_of_routes=3,
+                              segmentation='vertex', min_segment_length=50, join_method='buffer', length_weight=1.0,
+                              max_workers=None, save_dir=None, request_id=None):
+    """
+    Route-alternatives version of spatialModule.
+    
+    Requests up to `number_of_routes` alternatives in a single GraphHopper call and fetches
+    the POIs once for all of them. Each candidate is then enriched, summarized and filtered
+    in a thread pool, and scored by matching POIs against extra length (see score_route).
+    Args:
+        number_of_routes (int, optional): Maximum number of alternatives. Defaults to 3.
+        length_weight (float, optional): Weight of the detour in the score. Defaults to 1.0.
+        max_workers (int, optional): Thread pool size. Defaults to one thread per route.
+        Other arguments as in spatialModule.
+    Returns:
+        tuple: best route summary, segments of all routes, POIs near the best route,
+        start and end locations, and the ranking (list of score dicts, best first).
+    """
+    geolocator = get_geocoder()  # shared cache, seeded by the warm-up snapshot
+    locA = geolocator.geocode(start)
+    locB = geolocator.geocode(end)
+    
+    if not locA or not locB:
+        return "Try again, the locations could not be found."
+    
+    latA, lonA = locA.latitude, locA.longitude
+    latB, lonB = locB.latitude, locB.longitude
+    
+    # ----- GET THE ROUTES -----
+    routes = routing_graphhopper(lonA, latA, lonB, latB, mode='foot', graphhopper_api_key=GRAPHHOPPER_API, number_of_routes=number_of_routes,
+                                 segmentation=segmentation, min_segment_length=min_segment_length)
+    
+    # Alternatives may leave the A-B box, cover all of them with a single POI request
+    bbox = box(min(lonA, lonB), min(latA, latB), max(lonA, lonB), max(latA, latB))
+    bbox = bbox.union(box(*routes.total_bounds)).envelope
+    bbox = bbox.buffer(0.01)
+    bbox = bbox.simplify(0)
+    
+    # ----- POINTS OF INTEREST -----
+    requested_pois, poi_keys_for_segments = requested_pois_from_list(pois_list)
+    requested_pois_gdf = pois(bbox, requested_pois)
+    
+    # ----- ENRICH AND SUMMARIZE THE CANDIDATES CONCURRENTLY -----
+    candidates = list(routes.groupby("route_id"))
+    with ThreadPoolExecutor(max_workers=max_workers or len(candidates)) as executor:
+        futures = [
+            executor.submit(_process_alternative, route_id, route_segments, requested_pois_gdf, requested_pois,
+                            poi_keys_for_segments, start, end, time_constraint, space_constraint, join_method)
+            for route_id, route_segments in candidates
+        ]
+        processed = [future.result() for future in futures]
+    
+    processed = [p for p in processed if p[0]['segments']]
+    if len(processed) == 0:
+        raise ValueError("No routes found. Please try again with different locations.")
+    
+    # ----- SCORE AND RANK -----
+    shortest_length = min(route_summary['length_tot_m'] for route_summary, _, _ in processed)
+    ranking = rank_routes([score_route(route_summary, osmids, shortest_length, length_weight=length_weight)
+                           for route_summary, _, osmids in processed])
+    print(f"Route ranking: {[(r['route_id'], r['score']) for r in ranking]}")
+    
+    best_summary = next(p[0] for p in processed if p[0]['route_id'] == ranking[0]['route_id'])
+    routes_gdf = pd.concat([p[1] for p in processed])
+    
+    if save_dir is not None:
+        save_route_summary(best_summary, save_dir, request_id)
+    
+    osmids = route_osmids(routes_gdf, best_summary)
+    pois_near_segments = requested_pois_gdf[requested_pois_gdf['osmid'].isin(osmids)].copy()
+    
+    return best_summary, routes_gdf, pois_near_segments, locA, locB, ranking
 
 # # %%
 # # Example usage:
@@ -2,31 +2,16 @@
 import geopandas as gpd
 import pandas as pd
 import json
-import folium
+import gzip
+import shapely
 import numpy as np
-from shapely.geometry import Point, Polygon, MultiPolygon
-from geopy.geocoders import Nominatim
+from shapely.geometry import Point, Polygon, MultiPolygon, mapping
 from shapely.geometry import box
-import spacy
 import time
-from folium.features import DivIcon
+import threading
+from .geocoding import get_geocoder
 
-def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point):
-    """
-    Visualizes the routing and POIs on a map.
-    
-    Args:
-        route_gdf (GeoDataFrame): GeoDataFrame containing route geometries.
-        pois_near_segments (GeoDataFrame): GeoDataFrame containing POIs near segments.
-        result (dict): Dictionary containing routing results and POIs.
-        
-    Returns:
-        None
-    """
-    route_gdf = route_gdf.to_crs(epsg=4326)  # Ensure route_gdf is in WGS84
-    pois_near_segments = pois_near_segments.to_crs(epsg=4326)  # Ensure pois_near_segments is in WGS84
-
-    base_icon_mapping = {
+BASE_ICON_MAPPING = {
     "art_centre": ("tourism", "fa-solid fa-landmark"),
     "bakery": ("amenity", "fa-solid fa-bread-slice"),
     "bar": ("amenity", "fa-solid fa-beer"),
@@ -62,22 +47,96 @@ def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
     "supermarket": ("shop", "fa-solid fa-shopping-cart"),
     "temple": ("place_of_worship", "fa-solid fa-om"),
     "toilets": ("amenity", "fa-solid fa-restroom")
-    }
+}
 
-    available_colors = [
-        "red", "blue", "green", "purple", "orange", "darkred", "lightred",
-        "beige", "darkblue", "darkgreen", "cadetblue", "darkpurple", "white",
-        "pink", "lightblue", "lightgreen", "gray", "black", "lightgray",
-        "lightgray", "orange", "cadetblue", "lightgreen", "darkblue", "lightblue",
-        "lightred", "green", "darkgreen", "darkpurple", "beige", "pink", "darkred",
-        "gray", "purple", "blue", "black"
-    ]
+AVAILABLE_COLORS = [
+    "red", "blue", "green", "purple", "orange", "darkred", "lightred",
+    "beige", "darkblue", "darkgreen", "cadetblue", "darkpurple", "white",
+    "pink", "lightblue", "lightgreen", "gray", "black", "lightgray",
+    "lightgray", "orange", "cadetblue", "lightgreen", "darkblue", "lightblue",
+    "lightred", "green", "darkgreen", "darkpurple", "beige", "pink", "darkred",
+    "gray", "purple", "blue", "black"
+]
+
+ICON_MAPPING = {}
+for (key, (category, icon)), color in zip(BASE_ICON_MAPPING.items(), AVAILABLE_COLORS):
+    ICON_MAPPING[key] = (category, icon, color)
+
+def poi_icons(pois_gdf, vectorized=False):
+    """
+    Adds 'icon_key', 'icon', 'color' and 'popup' columns. By default one .loc pass per
+    icon in ICON_MAPPING order, so a POI matching several categories keeps the last
+    matching icon. vectorized=True (the clustered layer) does one Series.map per OSM
+    category column instead, where the later category column wins.
+    """
+    icon_key = pd.Series(None, index=pois_gdf.index, dtype=object)
+    if vectorized:
+        for category in dict.fromkeys(category for category, _, _ in ICON_MAPPING.values()):
+            if category in pois_gdf.columns:
+                category_keys = {key: key for key, (cat, _, _) in ICON_MAPPING.items() if cat == category}
+                icon_key = pois_gdf[category].map(category_keys).combine_first(icon_key)
+    else:
+        for key, (category, _, _) in ICON_MAPPING.items():
+            if category in pois_gdf.columns:
+                icon_key.loc[pois_gdf[category] == key] = key
+
+    pois_gdf['icon_key'] = icon_key
+    pois_gdf['icon'] = icon_key.map({key: icon for key, (_, icon, _) in ICON_MAPPING.items()}).fillna("fa-solid fa-question")
+    pois_gdf['color'] = icon_key.map({key: color for key, (_, _, color) in ICON_MAPPING.items()}).fillna("gray")  # Default color
+
+    if vectorized:
+        fallback = pois_gdf['icon_key']
+    else:
+        # Unnamed POIs are labelled with the first key that shares their icon
+        icon_labels = {}
+        for key, (_, icon, _) in ICON_MAPPING.items():
+            icon_labels.setdefault(icon, key)
+        fallback = pois_gdf['icon'].map(icon_labels)
+    popup = pois_gdf['name'] if 'name' in pois_gdf.columns else pd.Series(None, index=pois_gdf.index, dtype=object)
+    pois_gdf['popup'] = popup.fillna(fallback).fillna("POI").astype(str).str.replace("_", " ").str.title()
     
-    # Filter for the first route
+    return pois_gdf
+
+def poi_points(pois_gdf):
+    """
+    POIs as points (polygon centroids, computed in the local UTM zone), dropping empty and
+    unsupported geometries.
+    """
+    pois_gdf = pois_gdf[pois_gdf.geometry.notna() & pois_gdf.geom_type.isin(['Point', 'Polygon', 'MultiPolygon'])].copy()
+    if len(pois_gdf):
+        utm = pois_gdf.geometry.estimate_utm_crs()
+        pois_gdf['geometry'] = pois_gdf.geometry.to_crs(utm).centroid.to_crs(pois_gdf.crs)
+    return pois_gdf
+
+def poi_feature_collection(pois_gdf):
+    """
+    One GeoJSON FeatureCollection with all the POI markers and their icon properties.
+    """
+    points = pois_gdf.geometry
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [x, y]},
+                "properties": {"popup": popup, "icon": icon.split()[-1].replace("fa-", ""), "markerColor": color}
+            }
+            for x, y, popup, icon, color in zip(points.x, points.y, pois_gdf['popup'], pois_gdf['icon'], pois_gdf['color'])
+        ]
+    }
+
+def map_layers(route_gdf, pois_near_segments, result, buffer_distance=100, vectorized_icons=False):
+    """
+    Layers shown on the RAG map: the selected route, the dissolved buffers of the
+    segments with POIs, and those POIs as points with their icons (see poi_icons).
+    """
+    route_gdf = route_gdf.to_crs(epsg=4326)  # Ensure route_gdf is in WGS84
+    pois_near_segments = pois_near_segments.to_crs(epsg=4326)  # Ensure pois_near_segments is in WGS84
+
+    # Filter for the selected route (the first one unless alternatives were ranked)
+    route_id = result.get('route_id', 0)
     if 'route_id' in route_gdf.columns:
-        route_gdf = route_gdf[route_gdf['route_id'] == 0]
-    
-    route_gdf = route_gdf[route_gdf['route_id'] == 0]  # Filter for the first route
+        route_gdf = route_gdf[route_gdf['route_id'] == route_id]
     # save the buffered routes to another GeoDataFrame
     # select only segmen_id into result
     segment_ids = []
@@ -86,6 +145,10 @@ def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
             segment_ids.append(id['segment_id'])
         
     route_gdf_ = route_gdf[route_gdf['segment_id'].isin(segment_ids)]
+    if 'buffer' not in route_gdf_.columns:
+        # The 'dwithin' join does not build buffers, draw them only for the map
+        route_gdf_ = route_gdf_.copy()
+        route_gdf_['buffer'] = route_gdf_.geometry.to_crs("EPSG:3857").buffer(buffer_distance).to_crs("EPSG:4326")
     buffered_routes = route_gdf_[['buffer']].copy()
     buffered_routes['geometry'] = buffered_routes['buffer']
     buffered_routes = buffered_routes.drop(columns=['buffer'])
@@ -93,60 +156,59 @@ def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
     
     pois_near_segments = pois_near_segments[pois_near_segments['osmid'].isin(route_gdf_['osmid'].unique())]
 
-    icon_mapping = {}
-    for (key, (category, icon)), color in zip(base_icon_mapping.items(), available_colors):
-        icon_mapping[key] = (category, icon, color)
+    pois_near_segments = poi_points(pois_near_segments)
+    pois_near_segments = poi_icons(pois_near_segments, vectorized=vectorized_icons)
+        
+    center = route_gdf.geometry.unary_union.centroid
 
-    pois_near_segments['icon'] = "fa-solid fa-question"
-    pois_near_segments['color'] = "gray"  # Default color
+    return route_gdf, buffered_routes, pois_near_segments, center
 
-    for key, (category, icon, color) in icon_mapping.items():
-        if category in pois_near_segments.columns:
-            pois_near_segments.loc[pois_near_segments[category] == key, "icon"] = icon
-            pois_near_segments.loc[pois_near_segments[category] == key, "color"] = color
+def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point, buffer_distance=100, marker_mode='markers', report=False):
+    """
+    Visualizes the routing and POIs on a map.
+    
+    Args:
+        route_gdf (GeoDataFrame): GeoDataFrame containing route geometries.
+        pois_near_segments (GeoDataFrame): GeoDataFrame containing POIs near segments.
+        result (dict): Dictionary containing routing results and POIs.
+        buffer_distance (float): Buffer size in meters, used when route_gdf has no 'buffer' column.
+        marker_mode (str): 'markers' for one folium.Marker per POI, 'cluster' for a single
+            GeoJSON layer of all POIs inside a MarkerCluster (much smaller HTML for dense areas).
+        report (bool): Print the map build time and rendered HTML size.
         
-    center = route_gdf.geometry.unary_union.centroid 
+    Returns:
+        folium.Map, Point: the map and the route center.
+    """
+    import folium  # only the HTML maps need it, the JSON payloads do not
+    from folium.plugins import MarkerCluster
+    build_start = time.perf_counter()
+    route_gdf, buffered_routes, pois_near_segments, center = map_layers(route_gdf, pois_near_segments, result, buffer_distance,
+                                                                        vectorized_icons=marker_mode == 'cluster')
         
     m = folium.Map((center.y, center.x), zoom_start=14)
 
-    # Aggiungi i POI come marker
-    for _, row in pois_near_segments.iterrows():
-        geom = row['geometry']
-        
-        if geom is None:
-            continue
-
-        # Se è un Point lo usi direttamente, se è un poligono prendi il centroide
-        if isinstance(geom, (Polygon, MultiPolygon)):
-            point = geom.centroid
-        elif isinstance(geom, Point):
-            point = geom
-        else:
-            continue  # ignora geometrie non supportate
-
-        # Crea icona Font Awesome
-        icon_str = row['icon']
-        icon_name = icon_str.split()[-1].replace("fa-", "")
-        icon_color = row['color']  # Usa il colore associato o un default
-
-        # estrae "landmark" da "fa-solid fa-landmark"
-        icon = folium.Icon(icon=icon_name, prefix='fa', color=icon_color)
-
-        # Crea marker con popup
-        import pandas as pd
-
-        if pd.notna(row['name']):
-            popup_text = row['name']
-        else:
-            popup_text = next((key for key, (_, icon, _) in icon_mapping.items() if icon == row['icon']), "POI")
-
-        popup_text = popup_text.replace("_", " ").title()
-            
-        folium.Marker(
-            location=[point.y, point.x],
-            popup=popup_text,
-            icon=icon
-        ).add_to(m)
+    if marker_mode == 'cluster':
+        # All POIs in a single GeoJSON layer, clustered on the client
+        cluster = MarkerCluster(name="POIs").add_to(m)
+        folium.GeoJson(
+            poi_feature_collection(pois_near_segments),
+            marker=folium.Marker(icon=folium.Icon(prefix='fa')),
+            style_function=lambda feature: {"icon": feature["properties"]["icon"], "markerColor": feature["properties"]["markerColor"]},
+            popup=folium.GeoJsonPopup(fields=["popup"], labels=False)
+        ).add_to(cluster)
+    else:
+        # Aggiungi i POI come marker
+        for point, popup_text, icon_str, icon_color in zip(pois_near_segments.geometry, pois_near_segments['popup'],
+                                                           pois_near_segments['icon'], pois_near_segments['color']):
+            # estrae "landmark" da "fa-solid fa-landmark"
+            icon_name = icon_str.split()[-1].replace("fa-", "")
+            icon = folium.Icon(icon=icon_name, prefix='fa', color=icon_color)
+                
+            folium.Marker(
+                location=[point.y, point.x],
+                popup=popup_text,
+                icon=icon
+            ).add_to(m)
 
     buffered_routes.explore(style_kwds={
         'color': 'yellowgreen',
@@ -154,7 +216,7 @@ def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
         'opacity': 0.1
     }, m=m)
 
-    route_gdf[route_gdf['route_id'] == 0].explore(style_kwds={
+    route_gdf.explore(style_kwds={
         'color': 'green',
         'weight': 3,
         'opacity': 1
@@ -172,37 +234,176 @@ def visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
         icon=folium.Icon(color='red', icon='flag-checkered', prefix='fa')
     ).add_to(m)
 
+    if report:
+        build_time = time.perf_counter() - build_start
+        html_size = len(m.get_root().render().encode("utf-8"))
+        print(f"Map built in {build_time:.2f} s ({marker_mode}, {len(pois_near_segments)} POIs), HTML size {html_size / 1024:.1f} KB")
+
     return m, center
+def _quantize(geom, precision=5):
+    """
+    GeoJSON geometry with coordinates rounded to `precision` decimals (5 ~ 1 m).
+    """
+    return mapping(shapely.transform(geom, lambda coords: np.round(coords, precision)))
+
+def _point_feature(lat, lon, precision=5, **properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [round(lon, precision), round(lat, precision)]},
+        "properties": properties
+    }
+
+def map_payload(route_gdf, pois_near_segments, result, start_point, end_point, buffer_distance=100, precision=5, simplify_tolerance=2e-5):
+    """
+    Compact alternative to the folium HTML of visualize_rag: a GeoJSON FeatureCollection
+    with the route, the buffers and the POIs (icon keys and colors, no markup), with
+    quantized coordinates. Every feature has a 'kind' property (route, buffer, poi, start, end).
+    """
+    route_gdf, buffered_routes, pois_near_segments, center = map_layers(route_gdf, pois_near_segments, result, buffer_distance)
+
+    features = [{
+        "type": "Feature",
+        "geometry": _quantize(shapely.line_merge(route_gdf.geometry.unary_union), precision),
+        "properties": {"kind": "route"}
+    }]
+
+    if not buffered_routes.empty:
+        buffer_geom = buffered_routes.geometry.iloc[0].simplify(simplify_tolerance)
+        features.append({"type": "Feature", "geometry": _quantize(buffer_geom, precision), "properties": {"kind": "buffer"}})
+
+    for point, popup, icon_key, icon, color in zip(pois_near_segments.geometry, pois_near_segments['popup'], pois_near_segments['icon_key'],
+                                                   pois_near_segments['icon'], pois_near_segments['color']):
+        features.append(_point_feature(point.y, point.x, precision, kind="poi", name=popup,
+                                       icon_key=icon_key if pd.notna(icon_key) else None,
+                                       icon=icon.split()[-1].replace("fa-", ""), color=color))
+
+    features.append(_point_feature(start_point.latitude, start_point.longitude, precision, kind="start", name="Start"))
+    features.append(_point_feature(end_point.latitude, end_point.longitude, precision, kind="end", name="End"))
+
+    return {
+        "type": "FeatureCollection",
+        "center": [round(center.y, precision), round(center.x, precision)],
+        "features": features
+    }
+
+def encode_map_payload(payload):
+    """
+    Minified JSON of a map payload.
+    """
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+def compare_map_payloads(route_gdf, pois_near_segments, result, start_point, end_point):
+    """
+    Server render time and payload bytes (raw and gzip) of the folium HTML map
+    against the compact GeoJSON payload for the same route.
+    """
+    stats = {}
+
+    render_start = time.perf_counter()
+    m, _ = visualize_rag(route_gdf, pois_near_segments, result, start_point, end_point)
+    html = m._repr_html_().encode("utf-8")
+    stats["html"] = {"render_s": time.perf_counter() - render_start, "bytes": len(html), "gzip_bytes": len(gzip.compress(html))}
+
+    render_start = time.perf_counter()
+    data = encode_map_payload(map_payload(route_gdf, pois_near_segments, result, start_point, end_point)).encode("utf-8")
+    stats["geojson"] = {"render_s": time.perf_counter() - render_start, "bytes": len(data), "gzip_bytes": len(gzip.compress(data))}
+
+    for mode, values in stats.items():
+        print(f"{mode}: rendered in {values['render_s']:.3f} s, {values['bytes'] / 1024:.1f} KB ({values['gzip_bytes'] / 1024:.1f} KB gzip)")
+
+    return stats
+
 # %%
-def visualize_no_rag(text, GRAPHHOPPER_API, center, start_point, end_point):
-        
-    nlp = spacy.load("en_core_web_sm")  # o meglio ancora: un modello Hugging Face
-    geolocator = Nominatim(user_agent="my_app")
+PLACE_LABELS = {"ORG", "LOC", "FAC", "WORK_OF_ART"}
+NER_ONLY_EXCLUDE = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+
+_NLP = None
+_NLP_LOCK = threading.Lock()
+
+def get_nlp(model_name="en_core_web_sm"):
+    """
+    Process-wide spaCy pipeline with only the NER component, loaded on first use.
+    """
+    global _NLP
+    if _NLP is None:
+        with _NLP_LOCK:
+            if _NLP is None:
+                import spacy
+                _NLP = spacy.load(model_name, exclude=NER_ONLY_EXCLUDE)  # o meglio ancora: un modello Hugging Face
+    return _NLP
+
+def extract_place_entities(texts, batch_size=16):
+    """
+    Place-related entities of each text, in order of appearance and without
+    duplicates, running all the texts through a single nlp.pipe call.
+    """
+    entities_per_text = []
+    for doc in get_nlp().pipe(texts, batch_size=batch_size):
+        entities = []
+        for ent in doc.ents:
+            if ent.label_ in PLACE_LABELS:
+                ent_text = ent.text
+                if ent_text.lower().startswith("the "):
+                    ent_text = ent_text[4:]
+                if ent_text not in entities:
+                    entities.append(ent_text)
+        entities_per_text.append(entities)
+    return entities_per_text
+
+def geocode_entities(entity_names, city="Paris", max_workers=4):
+    """
+    Geocode entity names concurrently through the shared rate-limited client.
+    """
+    locations = get_geocoder().geocode_many([f"{name}, {city}" for name in entity_names], max_workers=max_workers)
+
     entities = {}
-    doc = nlp(text)
-
-    # Extract and geocode place-related entities
-    labels_of_interest = {"ORG", "LOC", "FAC", "WORK_OF_ART"}
-
-    for ent in doc.ents:
-        if ent.label_ in labels_of_interest:
-            ent_text = ent.text
-            if ent_text.lower().startswith("the "):
-                ent_text = ent_text[4:]
-
-            if ent_text in entities:
-                continue
-
-            try:
-                loc = geolocator.geocode(ent_text + ", Paris")
-                if loc:
-                    entities[ent_text] = {
-                        'location': (loc.latitude, loc.longitude),
-                        'raw': loc.raw.get('type', 'unknown')
-                    }
-                    time.sleep(1)  # avoid overloading the API
-            except Exception as e:
-                continue
+    for name in entity_names:
+        loc = locations.get(f"{name}, {city}")
+        if loc:
+            entities[name] = {
+                'location': (loc.latitude, loc.longitude),
+                'raw': loc.raw.get('type', 'unknown')
+            }
+    return entities
+
+def visualize_no_rag_many(texts, GRAPHHOPPER_API, center, start_point, end_point):
+    """
+    Maps of several no-RAG responses: one NER batch and one concurrent geocoding
+    round for the entities of all the texts.
+    """
+    entities_per_text = extract_place_entities(texts)
+    geocoded = geocode_entities([name for names in entities_per_text for name in names])
+
+    return [
+        visualize_no_rag(text, GRAPHHOPPER_API, center, start_point, end_point,
+                         entities={name: geocoded[name] for name in names if name in geocoded})
+        for text, names in zip(texts, entities_per_text)
+    ]
+
+def no_rag_map_payload(entities, center, start_point, end_point, precision=5):
+    """
+    Compact GeoJSON payload of the no-RAG map: numbered entity markers, start and end.
+    """
+    features = [
+        _point_feature(data['location'][0], data['location'][1], precision, kind="entity", name=name, number=i)
+        for i, (name, data) in enumerate(entities.items(), start=1)
+    ]
+    features.append(_point_feature(start_point.latitude, start_point.longitude, precision, kind="start", name="Start"))
+    features.append(_point_feature(end_point.latitude, end_point.longitude, precision, kind="end", name="End"))
+
+    return {
+        "type": "FeatureCollection",
+        "center": [round(center.y, precision), round(center.x, precision)],
+        "features": features
+    }
+
+def visualize_no_rag(text, GRAPHHOPPER_API, center, start_point, end_point, entities=None):
+    import folium
+    from folium.features import DivIcon
+
+    if entities is None:
+        # Extract and geocode place-related entities
+        entities = geocode_entities(extract_place_entities([text])[0])
 
     # # Display ordered points
     # print("Found locations:")
@@ -0,0 +1,302 @@
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import networkx as nx
+import shapely
+from shapely.geometry import box
+from shapely.ops import unary_union
+from .enrichment import POI_CATEGORY_MAPPING, pois, load_osmnx
+from .geocoding import get_geocoder
+
+# Snapshot layout: numeric arrays are .npy files opened with mmap_mode='r', POI geometries
+# are a single WKB blob sliced by offsets, so loading does not parse the whole city
+GRAPH_NODES = "graph_nodes.npy"      # (n,) int64 OSM node ids
+GRAPH_XY = "graph_xy.npy"            # (n, 2) float64 lon/lat
+GRAPH_EDGES = "graph_edges.npy"      # (m, 2) int64 positions in GRAPH_NODES
+GRAPH_LENGTHS = "graph_lengths.npy"  # (m,) float64 meters
+POIS_BOUNDS = "pois_bounds.npy"      # (k, 4) float64 minx, miny, maxx, maxy
+POIS_WKB = "pois_wkb.bin"
+POIS_WKB_OFFSETS = "pois_wkb_offsets.npy"
+POIS_ATTRIBUTES = "pois_attributes.json"
+GEOCODES = "geocodes.json"
+MANIFEST = "manifest.json"
+
+# OSM tags naming a POI, for the gazetteer of the geo-partitioned retrieval (alt_name may list several, ';'-separated)
+NAME_TAGS = ("name", "short_name", "alt_name", "name:en")
+
+
+def all_poi_tags():
+    """
+    Overpass tags of every POI type known to categorize_pois, shops included as a whole.
+    """
+    tags = {}
+    for poi_type, category in POI_CATEGORY_MAPPING.items():
+        tags.setdefault(category, []).append(poi_type)
+    tags['shop'] = True
+    return tags
+
+def bbox_tiles(bbox, tile_size=0.01):
+    """
+    Split (minx, miny, maxx, maxy) in a grid of tiles of `tile_size` degrees.
+    """
+    minx, miny, maxx, maxy = bbox
+    xs = np.linspace(minx, maxx, math.ceil((maxx - minx) / tile_size - 1e-9) + 1)
+    ys = np.linspace(miny, maxy, math.ceil((maxy - miny) / tile_size - 1e-9) + 1)
+    return [(float(x0), float(y0), float(x1), float(y1))
+            for x0, x1 in zip(xs[:-1], xs[1:]) for y0, y1 in zip(ys[:-1], ys[1:])]
+
+def _save_graph(graph, snapshot_dir):
+    node_ids = np.fromiter(graph.nodes, dtype=np.int64, count=graph.number_of_nodes())
+    position = {node: i for i, node in enumerate(node_ids.tolist())}
+    xy = np.array([(data['x'], data['y']) for _, data in graph.nodes(data=True)], dtype=np.float64)
+
+    edges = np.array([(position[u], position[v]) for u, v in graph.edges()], dtype=np.int64).reshape(-1, 2)
+    lengths = np.array([data.get('length', np.nan) for _, _, data in graph.edges(data=True)], dtype=np.float64)
+
+    np.save(os.path.join(snapshot_dir, GRAPH_NODES), node_ids)
+    np.save(os.path.join(snapshot_dir, GRAPH_XY), xy)
+    np.save(os.path.join(snapshot_dir, GRAPH_EDGES), edges)
+    np.save(os.path.join(snapshot_dir, GRAPH_LENGTHS), lengths)
+
+def _save_pois(pois_gdf, snapshot_dir):
+    pois_gdf = pois_gdf.to_crs("EPSG:4326").reset_index(drop=True)
+    wkb = shapely.to_wkb(pois_gdf.geometry.values)
+    offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(g) for g in wkb])
+
+    with open(os.path.join(snapshot_dir, POIS_WKB), 'wb') as f:
+        f.write(b"".join(wkb))
+    np.save(os.path.join(snapshot_dir, POIS_WKB_OFFSETS), offsets)
+    np.save(os.path.join(snapshot_dir, POIS_BOUNDS), shapely.bounds(pois_gdf.geometry.values).astype(np.float64))
+
+    attributes = pd.DataFrame(pois_gdf.drop(columns='geometry'))
+    attributes = attributes.astype(object).where(attributes.notnull(), None)
+    with open(os.path.join(snapshot_dir, POIS_ATTRIBUTES), 'w') as f:
+        json.dump(attributes.to_dict(orient='list'), f)
+
+def build_snapshot(city, bbox, snapshot_dir, landmarks=(), tile_size=0.01):
+    """
+    Prefetch what the first requests of the day would otherwise download, for one city:
+    the walking graph of the bbox, the POIs of every categorize_pois type (fetched tile by
+    tile) and the geocodes of a landmark list. Everything is written to `snapshot_dir`.
+    Args:
+        city (str): City name, stored in the manifest.
+        bbox (tuple): (min lon, min lat, max lon, max lat).
+        snapshot_dir (str): Output directory.
+        landmarks (list, optional): Geocoding queries, as the users write them (e.g. "Louvre museum, Paris").
+        tile_size (float, optional): POI tile size in degrees. Defaults to 0.01 (about 1 km).
+    Returns:
+        dict: the snapshot manifest.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    started = time.perf_counter()
+
+    # ----- WALKING GRAPH -----
+    graph = load_osmnx().graph_from_polygon(box(*bbox), network_type='walk')
+    _save_graph(graph, snapshot_dir)
+    print(f"Walking graph: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges")
+
+    # ----- POI TILES -----
+    tags = all_poi_tags()
+    tiles, fetched, tiles_pois = bbox_tiles(bbox, tile_size), [], []
+    for i, tile in enumerate(tiles):
+        try:
+            tiles_pois.append(pois(box(*tile), tags, extra_columns=NAME_TAGS[1:]))
+            fetched.append(tile)
+        except Exception as e:
+            print(f"POI tile {i + 1}/{len(tiles)} {tile} failed: {e}")
+
+    if tiles_pois:
+        pois_gdf = pd.concat(tiles_pois, ignore_index=True)
+        pois_gdf = pois_gdf.drop_duplicates(subset=['element_type', 'osmid']).reset_index(drop=True)
+        pois_gdf = gpd.GeoDataFrame(pois_gdf, geometry='geometry', crs="EPSG:4326")
+    else:
+        pois_gdf = gpd.GeoDataFrame(columns=['element_type', 'osmid', 'name', 'geometry'], geometry='geometry', crs="EPSG:4326")
+    _save_pois(pois_gdf, snapshot_dir)
+    print(f"POIs: {len(pois_gdf)} from {len(fetched)}/{len(tiles)} tiles")
+
+    # ----- LANDMARK GEOCODES -----
+    locations = get_geocoder().geocode_many(landmarks)
+    geocodes = {query: ({"address": loc.address, "latitude": loc.latitude, "longitude": loc.longitude}
+                        if loc is not None else None)
+                for query, loc in locations.items()}
+    with open(os.path.join(snapshot_dir, GEOCODES), 'w') as f:
+        json.dump(geocodes, f, indent=4)
+
+    manifest = {
+        "city": city,
+        "bbox": list(bbox),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build_time_s": round(time.perf_counter() - started, 1),
+        "tiles": len(tiles),
+        "fetched_tiles": fetched,
+        "pois": len(pois_gdf),
+        "graph_nodes": graph.number_of_nodes(),
+        "graph_edges": graph.number_of_edges(),
+        "landmarks": len(geocodes),
+        "geocoded_landmarks": sum(v is not None for v in geocodes.values()),
+    }
+    with open(os.path.join(snapshot_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+class CitySnapshot:
+    """
+    A snapshot written by build_snapshot, loaded with memory-mapped arrays.
+
+    Requests whose bbox lies within the fetched tiles are answered from the snapshot
+    (POIs, walking graph, landmark geocodes); anything else goes to the network as before.
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        path = lambda name: os.path.join(snapshot_dir, name)
+
+        with open(path(MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.area = unary_union([box(*tile) for tile in self.manifest['fetched_tiles']])
+
+        # Walking graph, rebuilt once at boot from the memory-mapped arrays
+        node_ids = np.load(path(GRAPH_NODES), mmap_mode='r')
+        xy = np.load(path(GRAPH_XY), mmap_mode='r')
+        edges = np.load(path(GRAPH_EDGES), mmap_mode='r')
+        lengths = np.load(path(GRAPH_LENGTHS), mmap_mode='r')
+
+        self.graph = nx.MultiDiGraph(crs="epsg:4326")
+        self.graph.add_nodes_from((int(node), {'x': float(x), 'y': float(y)}) for node, (x, y) in zip(node_ids, xy))
+        self.graph.add_edges_from((int(node_ids[u]), int(node_ids[v]), {'length': float(length)})
+                                  for (u, v), length in zip(edges, lengths))
+
+        # POIs: bounds and WKB stay on disk, geometries are decoded per query
+        self._pois_bounds = np.load(path(POIS_BOUNDS), mmap_mode='r')
+        self._pois_offsets = np.load(path(POIS_WKB_OFFSETS), mmap_mode='r')
+        self._pois_wkb = np.memmap(path(POIS_WKB), dtype=np.uint8, mode='r') if self._pois_offsets[-1] > 0 else np.zeros(0, np.uint8)
+        with open(path(POIS_ATTRIBUTES)) as f:
+            self._pois_attributes = pd.DataFrame(json.load(f))
+
+        with open(path(GEOCODES)) as f:
+            self.geocodes = json.load(f)
+
+    def covers(self, polygon):
+        return self.area.covers(polygon)
+
+    def pois(self, polygon, tags, extra_columns=()):
+        """
+        Same result as enrichment.pois(polygon, tags, extra_columns), read from the snapshot.
+        """
+        minx, miny, maxx, maxy = polygon.bounds
+        bounds = self._pois_bounds
+        candidates = np.flatnonzero((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx)
+                                    & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+
+        attributes = self._pois_attributes.iloc[candidates]
+        mask = np.zeros(len(candidates), dtype=bool)
+        for key, values in tags.items():
+            if key not in attributes.columns:
+                continue
+            mask |= attributes[key].notnull().to_numpy() if values is True else attributes[key].isin(values).to_numpy()
+        candidates = candidates[mask]
+
+        geometries = shapely.from_wkb([self._pois_wkb[self._pois_offsets[i]:self._pois_offsets[i + 1]].tobytes()
+                                       for i in candidates])
+        gdf = gpd.GeoDataFrame(self._pois_attributes.iloc[candidates].reset_index(drop=True),
+                               geometry=geometries, crs="EPSG:4326")
+        gdf = gdf[gdf.intersects(polygon)]
+
+        cols = [col for col in ['element_type', 'osmid'] if col in gdf.columns]
+        cols += [col for col in gdf.columns if col in tags.keys()]
+        cols += [col for col in extra_columns if col in gdf.columns and col not in cols]
+        cols += ['name', 'geometry']
+        return gdf[cols].reset_index(drop=True)
+
+    def named_places(self):
+        """
+        (names, latitudes, longitudes) of the named POIs (bounds centers), one row per OSM
+        name and alias tag, and of the geocoded landmarks.
+        """
+        names, lats, lons = [], [], []
+        for tag in NAME_TAGS:
+            if tag not in self._pois_attributes.columns:
+                continue
+            named = np.flatnonzero(self._pois_attributes[tag].notnull().to_numpy())
+            bounds = np.asarray(self._pois_bounds)[named]
+            for value, (minx, miny, maxx, maxy) in zip(self._pois_attributes[tag].iloc[named].astype(str), bounds):
+                for name in value.split(';'):
+                    if name.strip():
+                        names.append(name.strip())
+                        lats.append((miny + maxy) / 2)
+                        lons.append((minx + maxx) / 2)
+        for query, loc in self.geocodes.items():
+            if loc is not None:
+                names.append(query)
+                lats.append(loc['latitude'])
+                lons.append(loc['longitude'])
+        return names, np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64)
+
+    def seed_geocoder(self, geocoder):
+        from geopy.location import Location
+
+        geocoder.seed({query: (Location(loc['address'], (loc['latitude'], loc['longitude']), loc)
+                               if loc is not None else None)
+                       for query, loc in self.geocodes.items()})
+
+    def coverage(self):
+        manifest = self.manifest
+        return {
+            "city": manifest['city'],
+            "created": manifest['created'],
+            "graph_nodes": self.graph.number_of_nodes(),
+            "graph_edges": self.graph.number_of_edges(),
+            "pois": len(self._pois_attributes),
+            "tiles": f"{len(manifest['fetched_tiles'])}/{manifest['tiles']}",
+            "landmarks": f"{manifest['geocoded_landmarks']}/{manifest['landmarks']}",
+        }
+
+
+_SNAPSHOT = None
+_SNAPSHOT_LOCK = threading.Lock()
+
+def load_snapshot(snapshot_dir):
+    """
+    Startup hook: load a snapshot, make it the process-wide one used by enrichment.pois,
+    plan_itinerary and the shared geocoder, and report its coverage.
+    """
+    global _SNAPSHOT
+    started = time.perf_counter()
+    snapshot = CitySnapshot(snapshot_dir)
+    snapshot.seed_geocoder(get_geocoder())
+    with _SNAPSHOT_LOCK:
+        _SNAPSHOT = snapshot
+
+    coverage = snapshot.coverage()
+    print(f"Warm-up snapshot loaded in {time.perf_counter() - started:.1f} s: "
+          + ", ".join(f"{k}={v}" for k, v in coverage.items()))
+    return snapshot
+
+def active_snapshot():
+    return _SNAPSHOT
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a city warm-up snapshot")
+    parser.add_argument('--city', type=str, required=True, help="City name")
+    parser.add_argument('--bbox', type=float, nargs=4, required=True, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument('--out', type=str, required=True, help="Snapshot directory")
+    parser.add_argument('--landmarks', type=str, default=None, help="Text file, one geocoding query per line")
+    parser.add_argument('--tile_size', type=float, default=0.01, help="POI tile size in degrees")
+    args = parser.parse_args()
+
+    landmarks = []
+    if args.landmarks:
+        with open(args.landmarks) as f:
+            landmarks = [line.strip() for line in f if line.strip()]
+
+    manifest = build_snapshot(args.city, tuple(args.bbox), args.out, landmarks=landmarks, tile_size=args.tile_size)
+    print(json.dumps({k: v for k, v in manifest.items() if k != 'fetched_tiles'}, indent=4))
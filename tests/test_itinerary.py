@@ -0,0 +1,26 @@
+import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from spatial_module.itinerary import length_adjacency
+
+
+def parallel_edge_graph():
+    """a -> b joined by two ways (120 m and 80 m), then b -> c (50 m)."""
+    graph = nx.MultiDiGraph()
+    graph.add_edge('a', 'b', length=120.0)
+    graph.add_edge('a', 'b', length=80.0)
+    graph.add_edge('b', 'c', length=50.0)
+    return graph
+
+
+def test_parallel_edges_keep_the_shortest_length():
+    graph = parallel_edge_graph()
+    adjacency = length_adjacency(graph, list(graph.nodes))
+    assert adjacency[0, 1] == 80.0
+    assert adjacency.nnz == 2
+
+
+def test_dijkstra_over_parallel_edges():
+    graph = parallel_edge_graph()
+    distances = dijkstra(length_adjacency(graph, list(graph.nodes)), directed=True, indices=[0])
+    np.testing.assert_allclose(distances[0], [0.0, 80.0, 130.0])
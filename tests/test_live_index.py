@@ -0,0 +1,71 @@
+import os
+import faiss
+import numpy as np
+from ir_module.live_index import IdMap, LiveIndex, idmap_path, log_path
+
+DIM = 8
+
+
+def embed(texts):
+    vectors = np.stack([np.random.default_rng(abs(hash(text)) % 2 ** 32).normal(size=DIM) for text in texts])
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def live_index(tmp_path, n=20):
+    index_path = str(tmp_path / 'index.faiss')
+    doc_ids, texts = [f'doc{i}' for i in range(n)], [f'text {i}' for i in range(n)]
+    faiss.write_index(faiss.IndexFlatIP(DIM), index_path)
+    index = faiss.read_index(index_path)
+    index.add(embed(texts))
+    faiss.write_index(index, index_path)
+    return LiveIndex.migrate(index_path, doc_ids, texts), index_path
+
+
+def search_ids(live, text, k=3):
+    return [live.idmap.get(i) for i in live.search(embed([text]), k)[1][0] if i >= 0]
+
+
+def test_updates_are_logged_and_replayed(tmp_path):
+    live, index_path = live_index(tmp_path)
+    index_mtime = os.path.getmtime(index_path)
+
+    assert live.ingest(['new', 'doc3', 'new'], ['first', 'changed 3', 'new text'], embed)[:2] == (1, 1)
+    assert live.remove(['doc5', 'doc5', 'missing']) == 1
+    assert os.path.getmtime(index_path) == index_mtime and os.path.exists(log_path(index_path))
+
+    reloaded = LiveIndex(index_path)
+    assert reloaded.ntotal == live.ntotal == 20
+    assert search_ids(reloaded, 'new text')[0] == 'new'
+    assert search_ids(reloaded, 'changed 3')[0] == 'doc3'
+    assert 'doc5' not in search_ids(reloaded, 'text 5', k=20)
+    assert [reloaded.idmap.get(i) for i in (3, 20, 21)] == [None, 'doc3', 'new']
+
+
+def test_compact_and_checkpoint(tmp_path):
+    live, index_path = live_index(tmp_path)
+    live.ingest(['doc1'], ['changed 1'], embed)
+    live.remove(['doc2'])
+    assert live.compact() == 2
+    live.save()
+    assert not os.path.exists(log_path(index_path))
+
+    reloaded = LiveIndex(index_path)
+    assert reloaded.index.ntotal == reloaded.ntotal == 19
+    assert search_ids(reloaded, 'changed 1')[0] == 'doc1'
+    assert reloaded.ingest(['doc20'], ['text 20'], embed)[0] == 1
+    assert [reloaded.idmap.get(i) for i in (20, 21)] == ['doc1', 'doc20']
+
+
+def test_torn_log_record_is_ignored(tmp_path):
+    live, index_path = live_index(tmp_path)
+    live.ingest(['a'], ['text a'], embed)
+    size = os.path.getsize(log_path(index_path))
+    live.ingest(['b'], ['text b'], embed)
+    os.truncate(log_path(index_path), size + 50)
+
+    reloaded = LiveIndex(index_path)
+    assert reloaded.ntotal == 21 and search_ids(reloaded, 'text a')[0] == 'a'
+    assert os.path.getsize(log_path(index_path)) == size
+    reloaded.ingest(['b'], ['text b'], embed)
+    assert LiveIndex(index_path).ntotal == 22
+    assert IdMap.load(idmap_path(index_path)).next_id() == 20
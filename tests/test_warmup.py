@@ -0,0 +1,49 @@
+import types
+import geopandas as gpd
+import networkx as nx
+from shapely.geometry import box
+from ir_module.geo_filter import Gazetteer
+from spatial_module import enrichment, warmup
+
+BBOX = (2.33, 48.85, 2.36, 48.86)
+
+
+def fake_osmnx():
+    """graph_from_polygon / geometries_from_polygon returning a tiny walk graph and two POIs with aliases."""
+    graph = nx.MultiDiGraph()
+    graph.add_node(1, x=2.34, y=48.852)
+    graph.add_node(2, x=2.35, y=48.853)
+    graph.add_edge(1, 2, length=750.0)
+
+    def geometries_from_polygon(polygon, tags):
+        gdf = gpd.GeoDataFrame({
+            'element_type': ['way', 'way'],
+            'osmid': [201611261, 20273877],
+            'amenity': ['place_of_worship', None],
+            'tourism': [None, 'museum'],
+            'name': ["Cathédrale Notre-Dame de Paris", "Musée du Louvre"],
+            'short_name': ["Notre-Dame", None],
+            'alt_name': [None, "Louvre;Le Louvre"],
+            'name:en': ["Notre-Dame de Paris", "Louvre Museum"],
+            'wikidata': ["Q2981", "Q19675"],
+        }, geometry=[box(2.349, 48.852, 2.351, 48.854), box(2.335, 48.855, 2.338, 48.858)], crs="EPSG:4326")
+        gdf = gdf[gdf.intersects(polygon)]
+        return gdf.set_index(['element_type', 'osmid'])
+
+    return types.SimpleNamespace(graph_from_polygon=lambda polygon, network_type: graph,
+                                 geometries_from_polygon=geometries_from_polygon)
+
+
+def test_snapshot_keeps_the_alias_names(tmp_path, monkeypatch):
+    ox = fake_osmnx()
+    monkeypatch.setattr(warmup, 'load_osmnx', lambda: ox)
+    monkeypatch.setattr(enrichment, 'load_osmnx', lambda: ox)
+    monkeypatch.setattr(warmup, 'get_geocoder', lambda: types.SimpleNamespace(geocode_many=lambda queries: {}))
+
+    warmup.build_snapshot("Paris", BBOX, str(tmp_path))
+    names, lats, lons = warmup.CitySnapshot(str(tmp_path)).named_places()
+
+    assert sorted(names) == sorted(["Cathédrale Notre-Dame de Paris", "Musée du Louvre", "Notre-Dame",
+                                    "Louvre", "Le Louvre", "Notre-Dame de Paris", "Louvre Museum"])
+    gazetteer = Gazetteer.from_places(names, lats, lons, city="Paris")
+    assert [name for name, _, _ in gazetteer.match("Walk from Notre-Dame to the Louvre")] == ['notre dame', 'louvre']